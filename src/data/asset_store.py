@@ -0,0 +1,181 @@
+""" A store of Planet scene assets shared by every county, ward and
+    season run, so that each scene is downloaded, and each derived
+    image made, exactly once.
+
+    Raw assets keep the names the Planet download gives them; derived
+    assets are addressed by scene ID, asset type and a digest of the
+    parameters they were made with.
+"""
+import asyncio
+import fcntl
+import hashlib
+import json
+import os
+import re
+import shutil
+import threading
+
+# seconds between attempts to take a lock from a coroutine
+LOCK_POLL_INTERVAL = 0.5
+
+# the names download_planet_lib.download gives raw assets
+RAW_ASSET_RE = re.compile(r'^[^.]+(_[a-z_]+\.tif|\.xml)$')
+
+ASSET_STORE_ROOT = os.path.abspath(os.path.join(__file__,
+                                                os.pardir,
+                                                os.pardir,
+                                                os.pardir,
+                                                'data',
+                                                'raw',
+                                                'planet',
+                                                'assets'))
+
+
+def params_digest(params):
+    """ A digest of the processing parameters that does not depend on
+        the order of the keys.
+    """
+    canonical = json.dumps(params, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(canonical.encode('utf-8')).hexdigest()[:16]
+
+
+class StoreLock(object):
+    """ An exclusive lock on `lock_path`, across the threads, coroutines
+        and processes of every run using the store. Held with `with`,
+        or with `async with`, which polls for the lock instead of
+        blocking the event loop.
+    """
+
+    def __init__(self, lock_path, poll_interval=LOCK_POLL_INTERVAL):
+        self.lock_path = lock_path
+        self.poll_interval = poll_interval
+        self.lock_file = None
+
+    def acquire(self, blocking=True):
+        """ Takes the lock; without `blocking`, returns False instead of
+            waiting if it is held elsewhere.
+        """
+        lock_file = open(self.lock_path, 'w')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return False
+
+        self.lock_file = lock_file
+        return True
+
+    def release(self):
+        fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+        self.lock_file.close()
+        self.lock_file = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    async def __aenter__(self):
+        while not self.acquire(blocking=False):
+            await asyncio.sleep(self.poll_interval)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.release()
+
+
+class AssetStore(object):
+    """ Raw assets live in `root`, derived assets in `root`/derived and
+        the lock files in `root`/locks.
+    """
+
+    def __init__(self, root=ASSET_STORE_ROOT):
+        self.root = root
+
+        for folder in ('derived', 'locks'):
+            os.makedirs(os.path.join(root, folder), exist_ok=True)
+
+    def path(self, scene_id, asset_type, params=None):
+        """ Where the asset is stored; raw assets (no `params`) are named
+            like the files that download_planet_lib.download writes.
+        """
+        if params:
+            fname = '{}_{}_{}.tif'.format(scene_id, asset_type, params_digest(params))
+            return os.path.join(self.root, 'derived', fname)
+
+        if 'xml' in asset_type:
+            return os.path.join(self.root, '{}.xml'.format(scene_id))
+
+        return os.path.join(self.root, '{}_{}.tif'.format(scene_id, asset_type))
+
+    def lock(self, path):
+        """ A StoreLock on the asset at `path`.
+        """
+        return StoreLock(os.path.join(self.root, 'locks', os.path.basename(path) + '.lock'))
+
+    def get_or_create(self, scene_id, asset_type, params, create):
+        """ Returns the path of the asset, making it first with
+            `create(tmp_path)` if it is not stored yet. Only one caller
+            makes each asset; the others wait for the lock and reuse it.
+            The temp file is renamed into place, so a stored asset is
+            always complete.
+
+            Returns None if `create` did not write the temp file.
+        """
+        path = self.path(scene_id, asset_type, params)
+        if os.path.exists(path):
+            return path
+
+        with self.lock(path):
+            if os.path.exists(path):
+                return path
+
+            tmp_path = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+            try:
+                create(tmp_path)
+
+                if not os.path.exists(tmp_path):
+                    return None
+
+                os.replace(tmp_path, path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+        return path
+
+    def adopt(self, legacy_dir):
+        """ Brings the raw assets in `legacy_dir`, e.g. a county's assets
+            folder from before the store, into the store, so that they
+            are not downloaded again. Files are hard linked where
+            possible and copied otherwise; `legacy_dir` is left as is.
+
+            Returns the number of assets adopted.
+        """
+        if not os.path.isdir(legacy_dir):
+            return 0
+
+        adopted = 0
+        for fname in sorted(os.listdir(legacy_dir)):
+            src = os.path.join(legacy_dir, fname)
+            dst = os.path.join(self.root, fname)
+
+            if not RAW_ASSET_RE.match(fname) or not os.path.isfile(src) or os.path.exists(dst):
+                continue
+
+            with self.lock(dst):
+                if os.path.exists(dst):
+                    continue
+
+                tmp_path = '{}.{}.{}.tmp'.format(dst, os.getpid(), threading.get_ident())
+                try:
+                    os.link(src, tmp_path)
+                except OSError:
+                    shutil.copyfile(src, tmp_path)
+                os.replace(tmp_path, dst)
+
+            adopted += 1
+
+        return adopted
@@ -0,0 +1,85 @@
+import os
+import shutil
+import tempfile
+import time
+
+from affine import Affine
+import click
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+
+from image_processing import make_cog
+
+
+def write_merged(path, size, n_bands):
+    """ Writes a synthetic float32 image laid out like the plain GTiff
+        gdalwarp writes for a merged AOI: striped and uncompressed.
+    """
+    rng = np.random.RandomState(0)
+    profile = dict(driver='GTiff',
+                   width=size,
+                   height=size,
+                   count=n_bands,
+                   dtype='float32',
+                   crs='EPSG:32637',
+                   transform=Affine(3, 0, 500000, 0, -3, 9900000))
+
+    with rasterio.open(path, 'w', **profile) as dst:
+        for row_off in range(0, size, 256):
+            window = Window(0, row_off, size, min(256, size - row_off))
+            # reflectance from 12 bit digital numbers, like the converted scenes
+            dn = rng.gamma(4, 200, size=(n_bands, window.height, size)).astype(np.uint16)
+            dst.write(dn.astype(np.float32) * 2e-5,
+                      window=window)
+
+
+def time_read(path, repeat, **kwargs):
+    """ Best wall time of `repeat` reads of `path`, each from a freshly
+        opened dataset with an empty block cache.
+    """
+    timings = []
+    for _ in range(repeat):
+        with rasterio.Env(GDAL_CACHEMAX=1):
+            start = time.perf_counter()
+            with rasterio.open(path) as src:
+                src.read(**kwargs)
+            timings.append(time.perf_counter() - start)
+
+    return min(timings)
+
+
+@click.command()
+@click.option('--size', default=8192, type=int, help="Width and height of the synthetic image.")
+@click.option('--n_bands', default=4, type=int, help="Number of bands.")
+@click.option('--compress', default='deflate', help="Compression codec of the COG.")
+@click.option('--repeat', default=3, type=int, help="Number of timed reads of each kind.")
+def benchmark(size, n_bands, compress, repeat):
+    """ Compares read latency of a plain GTiff and a cloud optimized
+        GeoTIFF for full resolution, windowed and overview level reads.
+    """
+    folder = tempfile.mkdtemp()
+
+    try:
+        plain_path = os.path.join(folder, 'plain.tif')
+        cog_path = os.path.join(folder, 'cog.tif')
+
+        write_merged(plain_path, size, n_bands)
+        make_cog(plain_path, compress=compress, dst_path=cog_path)
+
+        print("Image: {} x {}x{} float32".format(n_bands, size, size))
+
+        reads = [('full resolution', {}),
+                 ('512x512 window', dict(window=Window(size // 2, size // 2, 512, 512))),
+                 ('1/16 overview', dict(out_shape=(n_bands, size // 16, size // 16)))]
+
+        for name, path in [('plain GTiff', plain_path), ('COG ' + compress, cog_path)]:
+            print("{} ({:.0f} MB on disk)".format(name, os.path.getsize(path) / 1e6))
+            for read_name, kwargs in reads:
+                print("{:>22}: {:8.3f} s".format(read_name, time_read(path, repeat, **kwargs)))
+    finally:
+        shutil.rmtree(folder)
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,94 @@
+import os
+import shutil
+import tempfile
+import time
+
+from affine import Affine
+import click
+import numpy as np
+import rasterio
+from rio_hist.match import histogram_match
+
+from image_processing import batch_hist_match_worker
+
+
+def write_scenes(folder, n_scenes, size, n_bands):
+    """ Writes `n_scenes` synthetic float32 reflectance scenes with
+        slightly different distributions to `folder`.
+    """
+    rng = np.random.RandomState(0)
+    profile = dict(driver='GTiff',
+                   width=size,
+                   height=size,
+                   count=n_bands,
+                   dtype='float32',
+                   crs='EPSG:32637',
+                   transform=Affine(3, 0, 500000, 0, -3, 9900000))
+
+    paths = []
+    for i in range(n_scenes):
+        paths.append(os.path.join(folder, 'scene_{}.tif'.format(i)))
+        with rasterio.open(paths[-1], 'w', **profile) as dst:
+            dst.write(rng.gamma(2 + i % 5, 0.05, size=(n_bands, size, size)).astype(np.float32))
+
+    return paths
+
+
+def legacy_batch_hist_match(ref_paths, bands):
+    """ The original implementation: a dense stack of every reference
+        image, and rio_hist's histogram_match against the whole stack
+        for every source image and band.
+    """
+    bixs = tuple([int(x) - 1 for x in bands.split(',')])
+
+    refs = []
+    for ref_path in ref_paths:
+        with rasterio.open(ref_path) as ref:
+            refs.append(ref.read())
+    ref = np.stack(refs)
+
+    for src_path in ref_paths:
+        with rasterio.open(src_path) as src:
+            profile = src.profile.copy()
+            target = src.read()
+
+        for b in bixs:
+            target[b] = histogram_match(target[b], ref[:, b, :, :])
+
+        with rasterio.open(os.path.splitext(src_path)[0] + '_legacy.tif', 'w', **profile) as dst:
+            dst.write(target)
+
+
+@click.command()
+@click.option('--n_scenes', default=200, type=int, help="Number of synthetic scenes to match.")
+@click.option('--size', default=256, type=int, help="Width and height of the synthetic scenes.")
+@click.option('--n_jobs', default=4, type=int, help="Worker processes for the parallel run.")
+def benchmark(n_scenes, size, n_jobs):
+    """ Compares the original histogram matching with the streamed
+        reference lookup tables, end to end on a batch of scenes.
+    """
+    folder = tempfile.mkdtemp()
+    bands = '1,2,3,4'
+
+    try:
+        paths = write_scenes(folder, n_scenes, size, 4)
+        print("Scenes: {} x 4 band {}x{} float32".format(n_scenes, size, size))
+
+        runs = [('legacy', lambda: legacy_batch_hist_match(paths, bands)),
+                ('lookup tables', lambda: batch_hist_match_worker(paths, 1.0, {}, bands, 'bgren', False,
+                                                                  masked=False)),
+                ('lookup tables {} jobs'.format(n_jobs),
+                 lambda: batch_hist_match_worker(paths, 1.0, {}, bands, 'bgren', False,
+                                                 masked=False, n_jobs=n_jobs))]
+
+        for name, run in runs:
+            start = time.perf_counter()
+            run()
+            elapsed = time.perf_counter() - start
+            print("{:>22}: {:8.2f} s  {:8.1f} scenes/s".format(name, elapsed, n_scenes / elapsed))
+    finally:
+        shutil.rmtree(folder)
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,84 @@
+import glob
+import os
+import shutil
+import tempfile
+import time
+
+from affine import Affine
+import click
+import numpy as np
+import rasterio
+
+from image_processing import resize_tiffs
+
+
+def write_tiles(folder, n_tiles, size):
+    """ Writes `n_tiles` synthetic 4 band uint16 size x size tiles
+        to `folder`.
+    """
+    rng = np.random.RandomState(0)
+    profile = dict(driver='GTiff',
+                   width=size,
+                   height=size,
+                   count=4,
+                   dtype='uint16',
+                   crs='EPSG:32637',
+                   transform=Affine(3, 0, 500000, 0, -3, 9900000))
+
+    for i in range(n_tiles):
+        with rasterio.open(os.path.join(folder, 'tile_{}.tif'.format(i)), 'w', **profile) as dst:
+            dst.write(rng.randint(0, 2 ** 12, size=(4, size, size)).astype(np.uint16))
+
+    return sorted(glob.glob(os.path.join(folder, 'tile_*.tif')))
+
+
+def time_resizes(name, tiles, output_folder, width, **kwargs):
+    """ Resizes every tile into a fresh `output_folder` and prints
+        the wall time.
+    """
+    shutil.rmtree(output_folder, ignore_errors=True)
+    os.makedirs(output_folder)
+
+    jobs = [(tile, os.path.join(output_folder, os.path.basename(tile)), width, 0)
+            for tile in tiles]
+
+    start = time.perf_counter()
+    resize_tiffs(jobs, **kwargs)
+    elapsed = time.perf_counter() - start
+
+    print("{:>22}: {:8.2f} s  {:8.1f} tiles/s".format(name, elapsed, len(tiles) / elapsed))
+
+
+@click.command()
+@click.option('--n_tiles', default=300, type=int, help="Number of synthetic tiles to resize.")
+@click.option('--size', default=1000, type=int, help="Width and height of the synthetic tiles.")
+@click.option('--width', default=299, type=int, help="Width to resize to; height keeps the aspect ratio.")
+@click.option('--n_threads', default=4, type=int, help="Threads for the threaded in-process resize.")
+def benchmark(n_tiles, size, width, n_threads):
+    """ Compares gdalwarp subprocesses with in-process rasterio warps
+        for resizing a batch of tiles, as merge_scenes does.
+    """
+    folder = tempfile.mkdtemp()
+
+    try:
+        tiles = write_tiles(folder, n_tiles, size)
+        output_folder = os.path.join(folder, 'resized')
+
+        print("Tiles: {} x 4 band {}x{} uint16 -> width {}".format(n_tiles, size, size, width))
+
+        if shutil.which('gdalwarp'):
+            time_resizes('gdalwarp subprocess', tiles, output_folder, width,
+                         n_threads=1, projection=None, in_process=False)
+        else:
+            print("gdalwarp not found, skipping the subprocess run")
+
+        time_resizes('in-process', tiles, output_folder, width,
+                     n_threads=1, projection=None)
+        time_resizes('in-process {} threads'.format(n_threads), tiles, output_folder, width,
+                     n_threads=n_threads, projection=None)
+    finally:
+        shutil.rmtree(folder)
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -1,24 +1,31 @@
 import collections
-from itertools import compress
+from concurrent.futures import ThreadPoolExecutor
 import json
 import os
+import shutil
 from subprocess import check_output, CalledProcessError, STDOUT
 import sys
-import time
+import tempfile
 import traceback
 from xml.dom import minidom
 
 import click
 import dotenv
-from joblib import Parallel, delayed
+from joblib import Parallel, delayed, effective_n_jobs
 import sqlalchemy
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 import shapefile
 
+from asset_store import AssetStore, ASSET_STORE_ROOT
 import download_planet_lib as planet_lib
+from memory_budget import report_peak_rss
+from scene_index import SceneIndex, geometry_bounds, sort_scenes
+from search_cache import SearchCache, SEARCH_CACHE_ROOT
 from image_processing import (
-    resize_for_inceptionv3, resize_for_vgg, batch_hist_match_worker, adjust_image_by_reflectance
+    resize_for_models, batch_hist_match_worker, adjust_image_by_reflectance,
+    resize_tiff, make_cog, mosaic_aoi, RESIZE_THREADS,
+    LazyScene, lazy_batch_hist_match
     )
 
 # get variables from .env file
@@ -189,85 +196,106 @@ def has_local_scene(scene_id, asset_type, asset_dir):
     return os.path.exists(scene_path)
 
 
-def get_sorted_scenes_from_query(query, search_type):
-    scenes = planet_lib.run_search({'item_types': [search_type],
-                                    'filter': query})
+def search_scenes(query, search_type, search_cache=None):
+    search_request = {'item_types': [search_type],
+                      'filter': query}
+
+    if search_cache is not None:
+        return search_cache.search(search_request, planet_lib.run_search)
+    else:
+        return planet_lib.run_search(search_request)
+
+
+def get_sorted_scenes_from_query(query, search_type, search_cache=None):
+    scenes = search_scenes(query, search_type, search_cache)
 
     # gdal uses the order of filenames for merging; by sorting
     # we prefer the most recent image with the least cloud_cover in
     # the final merged image.
-    scenes = sorted(scenes,
-                    key=lambda x: (x['properties']['cloud_cover'], x['properties']['updated']),
-                    reverse=True)
+    return sort_scenes(scenes)
 
-    scene_ids = [s['id'] for s in scenes]
 
-    return scene_ids
+def unwrap_aoi(aoi):
+    if isinstance(aoi, sqlalchemy.engine.result.RowProxy):
+        aoi = aoi[0]
+    return aoi
 
 
-def wait_for_scene_activation(scene_ids, search_type, asset_type, asset_dir):
-    not_local_scenes = []
+def build_regional_scene_index(geojson_aois, search_type, query_kwargs={}, search_cache=None):
+    """ Searches once over the bounding box of all of the AOIs and
+        indexes the footprints of the scenes, so that the scenes of each
+        AOI can be found without searching for it.
+    """
+    bounds = [geometry_bounds(unwrap_aoi(aoi)) for aoi in geojson_aois]
+    bbox = (min(b[0] for b in bounds), min(b[1] for b in bounds),
+            max(b[2] for b in bounds), max(b[3] for b in bounds))
 
-    for sid in scene_ids:
-        if not has_local_scene(sid, asset_type, asset_dir):
-            not_local_scenes.append(sid)
+    q_bbox = build_planet_query(bbox=bbox, **query_kwargs)
+    scenes = search_scenes(q_bbox, search_type, search_cache)
 
-    # mark the scenes we want for activation
-    planet_lib.process_activation(planet_lib.activate,
-                                  not_local_scenes,
-                                  search_type,
-                                  asset_type)
+    print("Indexed {} scenes over the region of {} aois".format(len(scenes), len(geojson_aois)))
+    return SceneIndex(scenes)
 
-    # wait for assets to activate; can take 8-10 mins, we'll wait up to 30 min
-    SLEEP_PERIODS = 120
-    for i in range(SLEEP_PERIODS):
-        activated = planet_lib.process_activation(planet_lib.check_activation,
-                                                  not_local_scenes,
-                                                  search_type,
-                                                  asset_type)
 
-        not_activated = [not a for a in activated]
+def wait_for_scene_activation(scene_ids, search_type, asset_type, asset_dir, log_dir=None):
+    """ Activates the scenes we do not have yet and waits until each of
+        them is active, failed or timed out; see ActivationScheduler.
+        Scenes that fail are logged in `log_dir`, by default `asset_dir`.
+    """
+    not_local_scenes = [sid for sid in scene_ids
+                        if not has_local_scene(sid, asset_type, asset_dir)]
 
-        # update scenes we need to check to just the ones that are not active yet
-        not_local_scenes = list(compress(not_local_scenes, not_activated))
+    scheduler = planet_lib.ActivationScheduler(search_type, asset_type)
+    try:
+        activated = scheduler.wait(not_local_scenes)
+    finally:
+        scheduler.close()
 
-        if all(activated) or len(not_local_scenes) == 0:
-            break
-        else:
-            time.sleep(15)
+    scheduler.report()
 
     if not all(activated):
-        fail_path = os.path.join(asset_dir, 'failed_scenes.log')
-        with open(fail_path, 'w') as fail_log:
-            failed_ids = list(compress(not_local_scenes, activated))
-            fail_log.write('\n'.join(failed_ids))
+        fail_path = os.path.join(log_dir or asset_dir, 'failed_scenes.log')
+        with open(fail_path, 'a') as fail_log:
+            failed_ids = [sid for sid, active in zip(not_local_scenes, activated) if not active]
+            fail_log.write(''.join(sid + '\n' for sid in failed_ids))
         print("Wrote scenes that failed to activate to {}".format(fail_path))
 
 
-def activate_all_of_kenya(search_type, asset_type, asset_dir, query_kwargs={}):
+def activate_all_of_kenya(search_type, asset_type, asset_dir, query_kwargs={}, search_cache=None):
     # get bounding box from shapefile for Kenya
     data_root = os.path.join(PLANET_DATA_ROOT, os.pardir)
     sf = shapefile.Reader(data_root + "/KEN_outline_SHP/ken")
     bbox = sf.bbox
 
     q_bbox = build_planet_query(bbox=bbox, **query_kwargs)
-    scenes = get_sorted_scenes_from_query(q_bbox, search_type=search_type)
-    wait_for_scene_activation(scenes,
-                              search_type=search_type,
-                              asset_type=asset_type,
-                              asset_dir=asset_dir)
+    scenes = get_sorted_scenes_from_query(q_bbox, search_type=search_type, search_cache=search_cache)
+
+    # only request activation; each AOI waits for just its own scenes,
+    # so AOIs whose scenes are active can go ahead without the rest
+    scheduler = planet_lib.ActivationScheduler(search_type, asset_type)
+    try:
+        scheduler.request([sid for sid in scenes
+                           if not has_local_scene(sid, asset_type, asset_dir)])
+    finally:
+        scheduler.close()
 
 
 def download_tiles_from_aoi(planet_query,
                             asset_dir,
                             asset_type,
-                            search_type):
-    """ Activates the scenes in the planet query and downloads
-        them to the asset_dir if they are not there already.
+                            search_type,
+                            search_cache=None,
+                            scene_ids=None,
+                            log_dir=None):
+    """ Activates the scenes in the planet query, or `scene_ids` if
+        they have been found already, and downloads them to the
+        asset_dir if they are not there already. Scenes that fail are
+        logged in `log_dir`, by default `asset_dir`.
     """
 
     # get the planet scenes IDs for our query
-    scene_ids = get_sorted_scenes_from_query(planet_query, search_type)
+    if scene_ids is None:
+        scene_ids = get_sorted_scenes_from_query(planet_query, search_type, search_cache)
 
     # check for scenes that we _don't_ already have
     not_local_scene_ids = [sid for sid in scene_ids if not
@@ -276,34 +304,48 @@ def download_tiles_from_aoi(planet_query,
     wait_for_scene_activation(not_local_scene_ids,
                               search_type=search_type,
                               asset_type=asset_type,
-                              asset_dir=asset_dir)
-
-    downloaded = planet_lib.process_download(asset_dir,
-                                             not_local_scene_ids,
-                                             search_type,
-                                             asset_type,
-                                             False) # overwrite
+                              asset_dir=asset_dir,
+                              log_dir=log_dir)
+
+    # download concurrently; other runs sharing the asset store may be
+    # downloading the same scenes, so each is locked while it downloads
+    store = AssetStore(asset_dir)
+    results = planet_lib.process_download_async(asset_dir,
+                                                not_local_scene_ids,
+                                                search_type,
+                                                asset_type,
+                                                False,  # overwrite
+                                                lock=lambda sid: store.lock(store.path(sid, asset_type)))
+
+    # None means another run downloaded the scene first
+    downloaded = [result is not False for result in results]
 
     if not all(downloaded):
-        fail_path = os.path.join(asset_dir, 'failed_downloads.log')
-        with open(fail_path, 'w') as fail_log:
-            failed_ids = list(compress(not_local_scene_ids, downloaded))
-            fail_log.write(failed_ids)
+        fail_path = os.path.join(log_dir or asset_dir, 'failed_downloads.log')
+        with open(fail_path, 'a') as fail_log:
+            failed_ids = [sid for sid, ok in zip(not_local_scene_ids, downloaded) if not ok]
+            fail_log.write(''.join(sid + '\n' for sid in failed_ids))
         print("Wrote scenes that failed to download to {}".format(fail_path))
 
     return scene_ids
 
 
 def merge_scenes(scene_ids, asset_dir, county_pixel_dir, asset_type, crop, search_type,
-                 match_histograms=False, adjust_reflectance=False, resize_pxs=1000):
-    paths = [os.path.join(asset_dir, '{}_{}.tif'.format(sid, asset_type)) \
-             for sid in scene_ids]
-
-    resized_paths = [os.path.join(asset_dir, 'resized', '{}_{}.tif'.format(sid, asset_type)) \
-             for sid in scene_ids]
+                 match_histograms=False, adjust_reflectance=False, resize_pxs=1000,
+                 memory_budget=None, cog_compress=None, lazy=False):
+    store = AssetStore(asset_dir)
+    paths = [store.path(sid, asset_type) for sid in scene_ids]
+
+    # resized and reflectance adjusted scenes are stored once per set of
+    # parameters and shared with every other AOI and run that needs them
+    params = {}
+    if resize_pxs is not None:
+        params['resize_pxs'] = resize_pxs
+    if adjust_reflectance:
+        params['reflectance'] = True
 
-    if not os.path.exists(os.path.join(asset_dir, 'resized')):
-        os.makedirs(os.path.join(asset_dir, 'resized'))
+    # failures are logged per county, not in the shared store
+    log_dir = os.path.dirname(county_pixel_dir)
 
     gj_path = os.path.join(county_pixel_dir, 'geojson_epsg32637_{}.geojson'.format(crop))
     shape_path = os.path.join(county_pixel_dir, 'epsg4326.shp')
@@ -313,26 +355,7 @@ def merge_scenes(scene_ids, asset_dir, county_pixel_dir, asset_type, crop, searc
                                pixel_id + '_{}.tif'.format(asset_type))
 
     with open(os.path.join(county_pixel_dir, pixel_id + '_scenes.txt'), 'w') as scene_file:
-        scene_file.write("\n".join(resized_paths))
-
-    # resize all of the images
-    if resize_pxs is not None:
-        for to_resize_in, to_resize_out in zip(paths, resized_paths):
-            if not os.path.exists(to_resize_out):
-                try:
-                    check_output(['gdalwarp',
-                          '-ts',
-                          str(resize_pxs),
-                          str(0),  # height is calculated
-                          to_resize_in,
-                          to_resize_out],
-                         stderr=STDOUT)
-                except CalledProcessError as e:
-                    print(e.output)
-                    raise
-    else:
-        # just use the normal paths in the future, since we don't resize
-        resized_paths = paths
+        scene_file.write("\n".join(store.path(sid, asset_type, params) for sid in scene_ids))
 
     if asset_type == 'visual':
         bands = "1,2,3"
@@ -347,58 +370,106 @@ def merge_scenes(scene_ids, asset_dir, county_pixel_dir, asset_type, crop, searc
     else:
         raise ValueError("Unsupported asset type {}. Try 'visual' or 'analytic'.".format(asset_type))
 
-    if adjust_reflectance:
-        refl_paths = []
-        for sid, image_path, xml_path in zip(scene_ids, resized_paths, paths):
-            reflectance_coeffs = get_reflectance_info(sid, xml_path, search_type)
-            res, res_path = adjust_image_by_reflectance(image_path, reflectance_coeffs, list(reflectance_coeffs.keys()))
-            if res:
-                refl_paths.append(res_path)
+    hist_matched_dir = None
+    if lazy:
+        # resize, reflectance and histogram matching are applied as the
+        # mosaic reads the scenes, instead of writing copies of them
+        matched_paths = []
+        for sid, path in zip(scene_ids, paths):
+            coeffs = get_reflectance_info(sid, path, search_type, log_dir) if adjust_reflectance else None
+            matched_paths.append(LazyScene(path,
+                                           size=(resize_pxs, 0) if resize_pxs is not None else None,
+                                           coeffs=coeffs))
+
+        if match_histograms:
+            matched_paths = lazy_batch_hist_match(matched_paths,
+                                                  bands,
+                                                  masked=asset_type == 'visual',  # analytic tiffs have no mask
+                                                  memory_budget=memory_budget)
     else:
-        refl_paths = resized_paths
-
-    if match_histograms:
-        matched_paths = batch_hist_match_worker(refl_paths,
-                                                1.0,
-                                                {},
-                                                bands,
-                                                'rgb' if asset_type == 'visual' else 'bgren',
-                                                False,
-                                                masked=asset_type == 'visual')  # analytic tiffs have no mask
-    else:
-        matched_paths = refl_paths
+        def derive_scene(sid, path):
+            if adjust_reflectance:
+                # the image is resized in the same pass
+                def create(tmp_path):
+                    reflectance_coeffs = get_reflectance_info(sid, path, search_type, log_dir)
+                    adjust_image_by_reflectance(path,
+                                                reflectance_coeffs,
+                                                list(reflectance_coeffs.keys()),
+                                                dst_path=tmp_path,
+                                                size=(resize_pxs, 0) if resize_pxs is not None else None)
+            else:
+                def create(tmp_path):
+                    resize_tiff(path, tmp_path, resize_pxs, 0, projection=None)  # height is calculated
+
+            return store.get_or_create(sid, asset_type, params, create)
+
+        if params:
+            # reflectance adjustment fetches metadata from the API one scene at a time
+            n_threads = 1 if adjust_reflectance else RESIZE_THREADS
+            with ThreadPoolExecutor(max_workers=n_threads) as pool:
+                derived_paths = list(pool.map(derive_scene, scene_ids, paths))
+
+            refl_paths = [p for p in derived_paths if p is not None]
+        else:
+            refl_paths = paths
+
+        if adjust_reflectance:
+            report_peak_rss('reflectance adjustment', memory_budget)
+
+        if match_histograms:
+            # the matched copies only feed this mosaic; they are removed
+            # once it is written
+            hist_matched_dir = tempfile.mkdtemp(prefix='hist_matched_', dir=county_pixel_dir)
+            try:
+                matched_paths = batch_hist_match_worker(refl_paths,
+                                                        1.0,
+                                                        {},
+                                                        bands,
+                                                        'rgb' if asset_type == 'visual' else 'bgren',
+                                                        False,
+                                                        masked=asset_type == 'visual',  # analytic tiffs have no mask
+                                                        dst_dir=hist_matched_dir,
+                                                        memory_budget=memory_budget)
+            except Exception:
+                shutil.rmtree(hist_matched_dir, ignore_errors=True)
+                raise
+
+            report_peak_rss('histogram matching', memory_budget)
+        else:
+            matched_paths = refl_paths
+
+    # clip and mosaic in-process, reading only the parts of the scenes
+    # that the pixel polygon needs; later scenes take priority
+    with open(gj_path) as gj_file:
+        aoi_geometries = [f['geometry'] for f in json.load(gj_file)['features']]
 
     try:
-        check_output(['gdalwarp',
-                      '-of',
-                      'GTiff',
-                      '-cutline',
-                      gj_path,
-                      '-crop_to_cutline',
-                      '-overwrite'] +
-                      matched_paths +
-                      [output_tiff],
-                     stderr=STDOUT)
+        used_paths = mosaic_aoi(matched_paths, aoi_geometries, output_tiff, aoi_crs='EPSG:32637')
+    finally:
+        if hist_matched_dir is not None:
+            shutil.rmtree(hist_matched_dir, ignore_errors=True)
+    print("Read {} of {} scenes for {}".format(len(used_paths), len(matched_paths), pixel_id))
 
-    except CalledProcessError as e:
-        print(e.output)
-        raise
+    if cog_compress:
+        make_cog(output_tiff, compress=cog_compress)
 
     return output_tiff
 
 
-def get_reflectance_info(sid, path, search_type):
+def get_reflectance_info(sid, path, search_type, log_dir=None):
     directory = os.path.dirname(path)
 
     fname = '{}.xml'.format(sid)
 
-    wait_for_scene_activation([sid], search_type, 'analytic_xml', directory)
+    wait_for_scene_activation([sid], search_type, 'analytic_xml', directory, log_dir=log_dir)
 
-    planet_lib.process_download(directory,
-                                [sid],
-                                search_type,
-                                'analytic_xml',
-                                False)
+    store = AssetStore(directory)
+    planet_lib.process_download_async(directory,
+                                      [sid],
+                                      search_type,
+                                      'analytic_xml',
+                                      False,
+                                      lock=lambda sid: store.lock(store.path(sid, 'analytic_xml')))
 
     xml_path = os.path.join(directory, fname)
     xmldoc = minidom.parse(xml_path)
@@ -439,10 +510,22 @@ def create_dirs_query_and_download(county_data,
                                    resize,
                                    model_resize,
                                    aoi_index,
-                                   total_aois):
+                                   total_aois,
+                                   memory_budget=None,
+                                   cog_compress=None,
+                                   lazy=False,
+                                   max_connections=None,
+                                   search_cache=None,
+                                   scene_ids=None):
     print("Starting aoi creation for aoi '{}' ({}/{})  <=====".format(os.path.basename(county_data),
                                                                       aoi_index+1,
                                                                       total_aois))
+    # this worker's share of the connections to the Planet API
+    if max_connections and planet_lib.get_session().max_connections != max_connections:
+        planet_lib.configure_session(max_connections)
+
+    requests_before, connections_before = planet_lib.get_session().stats.snapshot()
+
     try:
         county_pixel_dir = os.path.join(county_data,
                                         aoi['id'] + '_' + season)
@@ -453,7 +536,7 @@ def create_dirs_query_and_download(county_data,
         write_and_reproject_per_pixel_geojson(aoi, county_pixel_dir, crop_name)
 
         if collect_crop_yield_only:
-            return
+            return 0, 0
 
         # get the representation of the query
         planet_query = build_planet_query(geojson_aoi=aoi,
@@ -464,7 +547,10 @@ def create_dirs_query_and_download(county_data,
         scene_ids = download_tiles_from_aoi(planet_query,
                                             asset_dir,
                                             asset_type=asset_type,
-                                            search_type=search_type)
+                                            search_type=search_type,
+                                            search_cache=search_cache,
+                                            scene_ids=scene_ids,
+                                            log_dir=county_data)
 
         output_path = merge_scenes(scene_ids,
                                    asset_dir,
@@ -474,12 +560,16 @@ def create_dirs_query_and_download(county_data,
                                    search_type=search_type,
                                    match_histograms=match_hist,
                                    adjust_reflectance=reflectance,
-                                   resize_pxs=resize)
+                                   resize_pxs=resize,
+                                   memory_budget=memory_budget,
+                                   cog_compress=cog_compress,
+                                   lazy=lazy)
 
         # These are the most common sizes for many pre-trained CNNs
         if model_resize:
-            resize_for_inceptionv3(output_path)
-            resize_for_vgg(output_path)
+            for resized_path in resize_for_models(output_path):
+                if cog_compress:
+                    make_cog(resized_path, compress=cog_compress)
 
         print("Merged scenes into ====> {}".format(output_path))
 
@@ -490,6 +580,10 @@ def create_dirs_query_and_download(county_data,
         with open(os.path.join(county_pixel_dir, "FAILURE.txt"), 'w') as f:
             f.write(traceback.format_exc())
 
+    # the requests and connections this aoi used, for the run summary
+    requests_after, connections_after = planet_lib.get_session().stats.snapshot()
+    return requests_after - requests_before, connections_after - connections_before
+
 
 def joblib_wrapper(county_data,
                    aoi,
@@ -505,10 +599,18 @@ def joblib_wrapper(county_data,
                    resize,
                    model_resize,
                    aoi_index,
-                   total_aois):
+                   total_aois,
+                   memory_budget=None,
+                   cog_compress=None,
+                   lazy=False,
+                   max_connections=None,
+                   search_cache=None,
+                   scene_index=None):
 
-    if isinstance(aoi, sqlalchemy.engine.result.RowProxy):
-        aoi = aoi[0]
+    aoi = unwrap_aoi(aoi)
+
+    # look the scenes up here, so the workers are not sent the index
+    scene_ids = scene_index.scene_ids(aoi) if scene_index is not None else None
 
     return delayed(create_dirs_query_and_download)(county_data,
                                                    aoi,
@@ -524,7 +626,13 @@ def joblib_wrapper(county_data,
                                                    resize,
                                                    model_resize,
                                                    aoi_index,
-                                                   total_aois)
+                                                   total_aois,
+                                                   memory_budget,
+                                                   cog_compress,
+                                                   lazy,
+                                                   max_connections,
+                                                   search_cache,
+                                                   scene_ids)
 
 
 def run_queries_for_each_aoi(geojson_aois,
@@ -540,24 +648,53 @@ def run_queries_for_each_aoi(geojson_aois,
                              reflectance,
                              resize,
                              model_resize,
-                             n_jobs):
+                             n_jobs,
+                             memory_budget=None,
+                             cog_compress=None,
+                             lazy=False,
+                             max_connections=None,
+                             search_cache=None,
+                             scene_index=None):
+    # every worker needs at least one connection
+    if max_connections is not None and effective_n_jobs(n_jobs) > max_connections:
+        print("Running {} jobs instead of {} so that each has one of the {} connections".format(
+            max_connections, effective_n_jobs(n_jobs), max_connections))
+        n_jobs = max_connections
+
+    # each of the parallel workers gets an equal share of the budget
+    # and of the connections
+    if memory_budget is not None:
+        memory_budget = memory_budget / effective_n_jobs(n_jobs)
+    if max_connections is not None:
+        max_connections = max_connections // effective_n_jobs(n_jobs)
+
     with Parallel(n_jobs=n_jobs) as parallel:
-        parallel([joblib_wrapper(county_data,
-                                 aoi,
-                                 season,
-                                 crop_name,
-                                 collect_crop_yield_only,
-                                 extra_query_kwargs,
-                                 asset_dir,
-                                 asset_type,
-                                 search_type,
-                                 match_hist,
-                                 reflectance,
-                                 resize,
-                                 model_resize,
-                                 ix,
-                                 len(geojson_aois)) \
-                  for ix, aoi in enumerate(geojson_aois)])
+        connection_stats = parallel([joblib_wrapper(county_data,
+                                                    aoi,
+                                                    season,
+                                                    crop_name,
+                                                    collect_crop_yield_only,
+                                                    extra_query_kwargs,
+                                                    asset_dir,
+                                                    asset_type,
+                                                    search_type,
+                                                    match_hist,
+                                                    reflectance,
+                                                    resize,
+                                                    model_resize,
+                                                    ix,
+                                                    len(geojson_aois),
+                                                    memory_budget,
+                                                    cog_compress,
+                                                    lazy,
+                                                    max_connections,
+                                                    search_cache,
+                                                    scene_index) \
+                                     for ix, aoi in enumerate(geojson_aois)])
+
+    # connection reuse over every aoi of every worker
+    planet_lib.report_connections(sum(requests for requests, _ in connection_stats),
+                                  sum(connections for _, connections in connection_stats))
 
 
 @click.command()
@@ -579,6 +716,15 @@ def run_queries_for_each_aoi(geojson_aois,
 @click.option('--match_hist', is_flag=True, help="Normalize histograms for scenes that will be joined.")
 @click.option('--reflectance', is_flag=True, help="Multiply pixel values by TOA reflectance coefficients.")
 @click.option('--n_jobs', default=1, type=int, help="Number of jobs. default=1, use -1 for all cores.")
+@click.option('--memory_budget', default=None, type=float, help="Memory budget in MB shared by all of the jobs for reflectance adjustment and histogram matching.")
+@click.option('--lazy', is_flag=True, help="Resize, adjust reflectance and match histograms while mosaicking instead of writing copies of the scenes.")
+@click.option('--max_connections', default=planet_lib.MAX_CONNECTIONS, type=int, help="Connections to the Planet API open at once, shared by all of the jobs.")
+@click.option('--search_cache', 'search_cache_dir', default=SEARCH_CACHE_ROOT, help="Folder of cached Planet search results.")
+@click.option('--search_ttl', default=None, type=float, help="Hours before a cached search result is searched for again. default: never.")
+@click.option('--offline', is_flag=True, help="Only use cached search results; AOIs whose searches are not cached fail.")
+@click.option('--regional_search', is_flag=True, help="Search once over the bounding box of all of the aois and find the scenes of each aoi in a local spatial index.")
+@click.option('--asset_store', default=ASSET_STORE_ROOT, help="Folder of the scene asset store shared by all runs. Scenes in the county's old assets folder (data/raw/planet/<county>/assets) are linked into it.")
+@click.option('--cog', 'cog_compress', default=None, help="Write merged and model resized images as cloud optimized GeoTIFFs with this compression codec (e.g. deflate, lzw, zstd).")
 def download_county_crop_tiles(county_name,
                                crop_table,
                                crop_name,
@@ -596,7 +742,16 @@ def download_county_crop_tiles(county_name,
                                collect_crop_yield_only,
                                match_hist,
                                reflectance,
-                               n_jobs):
+                               n_jobs,
+                               memory_budget,
+                               lazy,
+                               max_connections,
+                               search_cache_dir,
+                               search_ttl,
+                               offline,
+                               regional_search,
+                               asset_store,
+                               cog_compress):
     """ This script downloads planet labs data for the crop_table in county_name
         and saves it as the crop_name.
 
@@ -645,22 +800,45 @@ def download_county_crop_tiles(county_name,
     county_data = os.path.join(PLANET_DATA_ROOT,
                                county_name)
 
-    asset_dir = os.path.join(county_data,
-                             'assets')
+    # scenes are shared by every county, ward and season run
+    asset_dir = asset_store
 
     os.makedirs(asset_dir, exist_ok=True)
 
+    # scenes downloaded before the store are in the county's own assets
+    # folder; bring them in rather than downloading them again
+    legacy_dir = os.path.join(county_data, 'assets')
+    adopted = AssetStore(asset_dir).adopt(legacy_dir)
+    if adopted:
+        print("Linked or copied {} scenes from {} into the asset store; "
+              "the files in {} are left in place".format(adopted, legacy_dir, legacy_dir))
+
+    # the catalogue for past seasons does not change, so reruns reuse
+    # the search results instead of searching again
+    search_cache = SearchCache(search_cache_dir,
+                               ttl=search_ttl * 3600 if search_ttl is not None else None,
+                               offline=offline)
+
     # if we're working on all of Kenya, scene activation can take a very long
     # time we'll frontload activating off of the scenes in the country
     if county_name == 'Kenya' and not collect_crop_yield_only:
         activate_all_of_kenya(search_type,
                               asset_type,
                               asset_dir,
-                              query_kwargs=extra_query_kwargs)
+                              query_kwargs=extra_query_kwargs,
+                              search_cache=search_cache)
 
         if activate_only:
             return
 
+    # one search for the region instead of one for each aoi
+    scene_index = None
+    if regional_search and not collect_crop_yield_only:
+        scene_index = build_regional_scene_index(geojson_aois,
+                                                 search_type,
+                                                 query_kwargs=extra_query_kwargs,
+                                                 search_cache=search_cache)
+
     run_queries_for_each_aoi(geojson_aois,
                              county_data,
                              season,
@@ -674,7 +852,13 @@ def download_county_crop_tiles(county_name,
                              reflectance,
                              resize,
                              model_resize,
-                             n_jobs)
+                             n_jobs,
+                             memory_budget,
+                             cog_compress,
+                             lazy,
+                             max_connections,
+                             search_cache,
+                             scene_index)
 
 
 def bbox_to_coords(bbox):
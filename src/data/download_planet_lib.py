@@ -4,20 +4,200 @@
 from __future__ import print_function
 
 import argparse
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import hashlib
 import os
+import re
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
 import shutil
 import json
+import threading
+import time
+
+import numpy as np
 
 from retrying import retry
 
 import dotenv
 
-ASSET_URL = 'https://api.planet.com/data/v1/item-types/{}/items/{}/assets/'
-SEARCH_URL = 'https://api.planet.com/data/v1/quick-search'
+API_ROOT = 'https://api.planet.com/data/v1'
+ASSET_URL = API_ROOT + '/item-types/{}/items/{}/assets/'
+SEARCH_URL = API_ROOT + '/quick-search'
+
+# requests in flight at once from an AsyncPlanetClient
+MAX_CONCURRENCY = 16
+
+# connections open at once in each process, over all hosts and per host
+MAX_CONNECTIONS = 32
+MAX_CONNECTIONS_PER_HOST = 16
+
+# bytes per read from a download stream
+DOWNLOAD_CHUNK = 1024 * 1024
+
+# times a download resumes after its connection drops
+DOWNLOAD_ATTEMPTS = 10
+
+# assets at least this large are downloaded in `segments` parallel
+# byte ranges when more than one segment is asked for
+SEGMENT_MIN_BYTES = 64 * 1024 * 1024
+
+# seconds before a scene's first activation check; the interval grows
+# by POLL_BACKOFF every time the scene is still pending
+POLL_INTERVAL = 5.0
+POLL_INTERVAL_MAX = 60.0
+POLL_BACKOFF = 1.5
+
+# seconds a scene may take to activate before it counts as failed
+ACTIVATION_TIMEOUT = 30 * 60
+
+
+class ConnectionStats(object):
+    """ Counts the requests sent and the connections opened for them; a
+        request that did not open a connection reused a kept-alive one.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.connections = 0
+
+    def count_request(self):
+        with self.lock:
+            self.requests += 1
+
+    def count_connection(self):
+        with self.lock:
+            self.connections += 1
+
+    def snapshot(self):
+        """ (requests, connections) so far, e.g. to be returned from a
+            pool worker and added up with `report_connections`.
+        """
+        with self.lock:
+            return self.requests, self.connections
+
+    def reuse_rate(self):
+        return reuse_rate(*self.snapshot())
+
+
+def reuse_rate(requests, connections):
+    if not requests:
+        return None
+    return max(requests - connections, 0) / requests
+
+
+def report_connections(requests, connections):
+    rate = reuse_rate(requests, connections)
+    print("Connections: {} requests over {} connections, {} reused".format(
+        requests,
+        connections,
+        'n/a' if rate is None else '{:.0%}'.format(rate)))
+
+
+def counting_pool_class(pool_class, stats):
+    """ `pool_class` with connections that count in `stats` each time
+        they connect or reconnect.
+    """
+    class CountingConnection(pool_class.ConnectionCls):
+        def connect(self):
+            stats.count_connection()
+            return super(CountingConnection, self).connect()
+
+    return type(pool_class.__name__, (pool_class,), {'ConnectionCls': CountingConnection})
+
+
+class PooledAdapter(HTTPAdapter):
+    """ Keep-alive pools of at most `per_host` connections to each host,
+        with at most `max_connections` requests holding a connection at
+        once over all of the hosts. Requests wait for a free connection
+        instead of opening more. A streamed response holds its
+        connection until it is closed.
+    """
+
+    def __init__(self, max_connections=MAX_CONNECTIONS, per_host=MAX_CONNECTIONS_PER_HOST):
+        self.stats = ConnectionStats()
+        self.slots = threading.BoundedSemaphore(max_connections)
+        super(PooledAdapter, self).__init__(pool_connections=max_connections,
+                                            pool_maxsize=per_host,
+                                            pool_block=True)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super(PooledAdapter, self).init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': counting_pool_class(HTTPConnectionPool, self.stats),
+            'https': counting_pool_class(HTTPSConnectionPool, self.stats)}
+
+    def send(self, request, stream=False, **kwargs):
+        self.slots.acquire()
+        try:
+            response = super(PooledAdapter, self).send(request, stream=stream, **kwargs)
+        except Exception:
+            self.slots.release()
+            raise
+
+        self.stats.count_request()
+
+        if not stream:
+            # read the body now so the connection goes back to its pool;
+            # the slot is freed even if the body does not arrive in full
+            try:
+                response.content
+            finally:
+                self.slots.release()
+            return response
+
+        released = threading.Event()
+        close = response.close
+
+        def close_and_release():
+            close()
+            if not released.is_set():
+                released.set()
+                self.slots.release()
+
+        response.close = close_and_release
+        return response
+
+
+class PooledSession(requests.Session):
+    """ A Session on a PooledAdapter for http and https. It is safe to
+        share between threads, but not between processes; see `session`.
+    """
+
+    def __init__(self, max_connections=MAX_CONNECTIONS, per_host=MAX_CONNECTIONS_PER_HOST):
+        super(PooledSession, self).__init__()
+        self.pid = os.getpid()
+        self.max_connections = max_connections
+        self.per_host = per_host
+        self.adapter = PooledAdapter(max_connections, per_host)
+        for prefix in ('https://', 'http://'):
+            self.mount(prefix, self.adapter)
+
+    @property
+    def stats(self):
+        return self.adapter.stats
+
+    def send(self, request, **kwargs):
+        try:
+            return super(PooledSession, self).send(request, **kwargs)
+        except requests.exceptions.TooManyRedirects as e:
+            # the last response is raised with rather than closed, which
+            # would keep its connection slot if it was streamed
+            if e.response is not None:
+                e.response.close()
+            raise
+
+    def report(self):
+        report_connections(*self.stats.snapshot())
+
 
 # set up auth
-SESSION = requests.Session()
+SESSION = PooledSession()
+SESSION_LOCK = threading.Lock()
 
 # get variables from .env file
 dotenv.load_dotenv(dotenv.find_dotenv())
@@ -25,10 +205,44 @@ dotenv.load_dotenv(dotenv.find_dotenv())
 SESSION.auth = (os.environ.get('PL_API_KEY'), '')
 
 
+def get_session():
+    """ The PooledSession shared by every thread of this process. A forked
+        pool worker makes its own, with the same auth and limits, instead
+        of using the sockets of its parent.
+    """
+    global SESSION
+
+    with SESSION_LOCK:
+        if SESSION.pid != os.getpid():
+            configure_session()
+
+    return SESSION
+
+
+def configure_session(max_connections=None, per_host=None):
+    """ Replaces this process's session with one with new connection
+        limits, e.g. a share of the total for each of several workers.
+    """
+    global SESSION
+
+    auth = SESSION.auth
+    max_connections = max_connections or SESSION.max_connections
+    per_host = min(per_host or SESSION.per_host, max_connections)
+
+    SESSION = PooledSession(max_connections, per_host)
+    SESSION.auth = auth
+
+    return SESSION
+
+
 class RateLimitException(Exception):
     pass
 
 
+class DownloadError(Exception):
+    pass
+
+
 def handle_page(page):
     try:
         scenes = [{'id': item['id'],
@@ -71,7 +285,7 @@ def check_status(result, msg=None):
 def run_search(search_request):
     print('Running query')
 
-    result = SESSION.post(SEARCH_URL, json=search_request)
+    result = get_session().post(SEARCH_URL, json=search_request)
 
     check_status(result)
 
@@ -80,7 +294,7 @@ def run_search(search_request):
 
     while page['_links'].get('_next') is not None:
         page_url = page['_links'].get('_next')
-        page = SESSION.get(page_url).json()
+        page = get_session().get(page_url).json()
         ids = handle_page(page)
         final_list += ids
 
@@ -95,7 +309,7 @@ def run_search(search_request):
 def activate(item_id, item_type, asset_type):
     item_id = item_id.strip('"')
 
-    result = SESSION.get(ASSET_URL.format(item_type, item_id))
+    result = get_session().get(ASSET_URL.format(item_type, item_id))
 
     check_status(result)
 
@@ -112,7 +326,7 @@ def activate(item_id, item_type, asset_type):
         item_activation_url = result.json()[asset_type]['_links']['activate']
 
         print('Activating {} {} for {}'.format(item_type, asset_type, item_id))
-        result = SESSION.post(item_activation_url)
+        result = get_session().post(item_activation_url)
 
         return check_status(result, 'Activation process started successfully')
 
@@ -123,7 +337,7 @@ def activate(item_id, item_type, asset_type):
     retry_on_exception=retry_if_rate_limit_error,
     stop_max_attempt_number=5)
 def check_activation(item_id, item_type, asset_type):
-    result = SESSION.get(ASSET_URL.format(item_type, item_id))
+    result = get_session().get(ASSET_URL.format(item_type, item_id))
 
     check_status(result)
 
@@ -142,39 +356,168 @@ def check_activation(item_id, item_type, asset_type):
         return False
 
 
+def file_size(path):
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+
+def file_md5(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(partial(f.read, DOWNLOAD_CHUNK), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def response_total_size(result):
+    """ The full size of the resource from a 200 or 206 response, or
+        None if the server does not say.
+    """
+    content_range = result.headers.get('Content-Range')
+    if content_range:
+        match = re.match(r'bytes \d+-\d+/(\d+)', content_range)
+        return int(match.group(1)) if match else None
+
+    content_length = result.headers.get('Content-Length')
+    return int(content_length) if content_length is not None else None
+
+
+def fetch_range(url, part_path, start=0, end=None, http=None):
+    """ Downloads bytes `start` to `end` (inclusive; None for the end of
+        the resource) of `url` into `part_path`. Whatever is already in
+        `part_path` is kept and the rest is requested with an HTTP Range
+        header, so a dropped connection is resumed where it stopped.
+
+        Returns the full size of the resource, if the server gives it.
+    """
+    http = http or get_session()
+    total = None
+
+    for attempt in range(DOWNLOAD_ATTEMPTS):
+        offset = start + file_size(part_path)
+        expected_end = end if end is not None else (total - 1 if total is not None else None)
+        if expected_end is not None and offset > expected_end:
+            return total
+
+        headers = {}
+        if offset > 0 or end is not None:
+            headers['Range'] = 'bytes={}-{}'.format(offset, '' if end is None else end)
+
+        try:
+            with http.get(url, headers=headers, stream=True) as result:
+                check_status(result)
+
+                if result.status_code == 416 and end is None:
+                    # `part_path` already holds the whole resource
+                    match = re.match(r'bytes \*/(\d+)', result.headers.get('Content-Range', ''))
+                    return int(match.group(1)) if match else None
+
+                result.raise_for_status()
+
+                if result.status_code == 206:
+                    mode = 'ab'
+                elif start == 0 and end is None:
+                    # the server ignored the range; start over
+                    mode = 'wb'
+                else:
+                    raise DownloadError('{} does not support byte ranges'.format(url))
+
+                total = response_total_size(result)
+
+                with open(part_path, mode) as f:
+                    for chunk in result.iter_content(chunk_size=DOWNLOAD_CHUNK):
+                        f.write(chunk)
+
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.ChunkedEncodingError,
+                requests.exceptions.Timeout) as e:
+            print('Connection dropped after {} bytes, resuming ({})'.format(start + file_size(part_path), e))
+            continue
+
+        expected_end = end if end is not None else (total - 1 if total is not None else None)
+        if expected_end is None or start + file_size(part_path) > expected_end:
+            return total
+
+        print('Download of {} stopped at {} bytes, resuming'.format(url, start + file_size(part_path)))
+
+    raise DownloadError('Could not download {} in {} attempts'.format(url, DOWNLOAD_ATTEMPTS))
+
+
+def fetch_segments(url, part_path, total, segments, http=None):
+    """ Downloads `url` of `total` bytes into `part_path` as `segments`
+        byte ranges in parallel, each resumable on its own.
+    """
+    bounds = np.linspace(0, total, segments + 1).astype(np.int64)
+    segment_paths = ['{}.{}'.format(part_path, i) for i in range(segments)]
+
+    with ThreadPoolExecutor(max_workers=segments) as pool:
+        futures = [pool.submit(fetch_range, url, segment_path, start, stop - 1, http)
+                   for segment_path, start, stop in zip(segment_paths, bounds[:-1], bounds[1:])]
+        for future in futures:
+            future.result()
+
+    with open(part_path, 'wb') as f:
+        for segment_path in segment_paths:
+            with open(segment_path, 'rb') as segment:
+                shutil.copyfileobj(segment, f, DOWNLOAD_CHUNK)
+
+    for segment_path in segment_paths:
+        os.remove(segment_path)
+
+
+def local_asset_path(path, item_id, asset_type):
+    if 'xml' in asset_type:
+        fname = '{}.xml'.format(item_id)
+    else:
+        fname = '{}_{}.tif'.format(item_id, asset_type)
+    return os.path.join(path, fname)
+
+
 @retry(
     wait_exponential_multiplier=1000,
     wait_exponential_max=10000,
     retry_on_exception=retry_if_rate_limit_error,
     stop_max_attempt_number=5)
-def download(url, path, item_id, asset_type, overwrite):
-    if 'xml' in asset_type:
-        fname = '{}.xml'.format(item_id)
-    else:
-        fname = '{}_{}.tif'.format(item_id, asset_type)
-    local_path = os.path.join(path, fname)
+def download(url, path, item_id, asset_type, overwrite, md5_digest=None, segments=1,
+             segment_min_bytes=SEGMENT_MIN_BYTES, http=None):
+    """ Downloads the asset at `url` into `path`. The bytes go to a .part
+        file that survives interruptions and is resumed with HTTP Range
+        requests, in `segments` parallel ranges for large assets. The
+        .part file is checked against the size the server reports and
+        `md5_digest`, if given, before it is renamed into place, so a
+        truncated download never looks like a finished one.
+    """
+    local_path = local_asset_path(path, item_id, asset_type)
+    part_path = local_path + '.part'
+    http = http or get_session()
 
     if not overwrite and os.path.exists(local_path):
         print('File {} exists - skipping ...'.format(local_path))
     else:
         print('Downloading file to {}'.format(local_path))
-        # memory-efficient download, per
-        # stackoverflow.com/questions/16694907/how-to-download-large-file-in-python-with-requests-py
-        r = requests.get(url, stream=True)
-        with open(local_path, 'wb') as f:
-            shutil.copyfileobj(r.raw, f)
 
-        return True
+        total = None
+        if segments > 1:
+            with http.head(url, allow_redirects=True) as result:
+                if result.ok and result.headers.get('Accept-Ranges') == 'bytes':
+                    total = response_total_size(result)
 
-    #     if check_status(result):
-    #         f = open(local_path, 'wb')
-    #         for chunk in result.iter_content(chunk_size=512 * 1024):
-    #             # filter out keep-alive new chunks
-    #             if chunk:
-    #                 f.write(chunk)
-    #         f.close()
+        if total is not None and total >= segment_min_bytes:
+            fetch_segments(url, part_path, total, segments, http)
+        else:
+            total = fetch_range(url, part_path, http=http)
+
+        size = file_size(part_path)
+        if total is not None and size != total:
+            os.remove(part_path)
+            raise DownloadError('{} has {} bytes, expected {}'.format(part_path, size, total))
+
+        if md5_digest is not None and file_md5(part_path) != md5_digest:
+            os.remove(part_path)
+            raise DownloadError('{} does not match its md5 digest'.format(part_path))
 
-    # return True
+        os.replace(part_path, local_path)
+
+        return True
 
 
 def process_activation(func, id_list, item_type, asset_type):
@@ -198,11 +541,16 @@ def process_download(path, id_list, item_type, asset_type, overwrite):
 
     # now start downloading each file
     for item_id in id_list:
-        result = SESSION.get(ASSET_URL.format(item_type, item_id))
+        result = get_session().get(ASSET_URL.format(item_type, item_id))
 
         if result.json()[asset_type]['status'] == 'active':
             download_url = result.json()[asset_type]['location']
-            result = download(download_url, path, item_id, asset_type, overwrite)
+            try:
+                result = download(download_url, path, item_id, asset_type, overwrite,
+                                  md5_digest=result.json()[asset_type].get('md5_digest'))
+            except DownloadError as e:
+                print(e)
+                result = False
         else:
             result = False
 
@@ -211,6 +559,307 @@ def process_download(path, id_list, item_type, asset_type, overwrite):
     return results
 
 
+class AsyncPlanetClient(object):
+    """ An asyncio client for search, activate, check and download with
+        at most `max_concurrency` requests in flight.
+
+        The requests are the same blocking calls as above, made on one
+        shared `session` from a thread pool. A PooledSession, the
+        default, keeps its own connection limits; any other session gets
+        a connection pool sized to match the thread pool. A 429
+        or 502 (see `check_status`) is retried with the same capped
+        exponential backoff as the retry decorators, without holding a
+        concurrency slot while waiting.
+    """
+
+    def __init__(self, session=None, max_concurrency=MAX_CONCURRENCY, api_root=API_ROOT,
+                 wait_multiplier=1.0, wait_max=10.0, loop=None):
+        self.session = session or get_session()
+        self.max_concurrency = max_concurrency
+        self.asset_url = api_root + '/item-types/{}/items/{}/assets/'
+        self.search_url = api_root + '/quick-search'
+        self.wait_multiplier = wait_multiplier
+        self.wait_max = wait_max
+
+        if not isinstance(self.session, PooledSession):
+            adapter = HTTPAdapter(pool_connections=max_concurrency, pool_maxsize=max_concurrency)
+            for prefix in ('https://', 'http://'):
+                self.session.mount(prefix, adapter)
+
+        self.loop = loop or asyncio.new_event_loop()
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency)
+
+        # made on first use, in the running loop
+        self.semaphore = None
+
+    def close(self):
+        self.executor.shutdown()
+        self.loop.close()
+
+    def run(self, coro):
+        """ Runs a coroutine of this client to completion.
+        """
+        return self.loop.run_until_complete(coro)
+
+    async def call(self, func, *args, **kwargs):
+        """ Runs a blocking `func` in the thread pool, in a concurrency slot.
+        """
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async with self.semaphore:
+            return await self.loop.run_in_executor(self.executor, partial(func, *args, **kwargs))
+
+    async def request(self, method, url, max_attempts=5, **kwargs):
+        """ A request that is retried on 429 and 502 responses.
+        """
+        for attempt in range(1, max_attempts + 1):
+            result = await self.call(self.session.request, method, url, **kwargs)
+
+            try:
+                check_status(result)
+                return result
+            except RateLimitException:
+                if attempt == max_attempts:
+                    raise
+
+            await asyncio.sleep(min(self.wait_multiplier * 2 ** attempt, self.wait_max))
+
+    async def search(self, search_request):
+        """ `run_search`: all of the pages of a quick search.
+        """
+        print('Running query')
+
+        result = await self.request('POST', self.search_url, max_attempts=25, json=search_request)
+        page = result.json()
+        final_list = handle_page(page)
+
+        while page['_links'].get('_next') is not None:
+            result = await self.request('GET', page['_links'].get('_next'), max_attempts=25)
+            page = result.json()
+            final_list += handle_page(page)
+
+        return final_list
+
+    async def activate(self, item_id, item_type, asset_type):
+        """ `activate`: True if activation was requested.
+        """
+        item_id = item_id.strip('"')
+
+        result = await self.request('GET', self.asset_url.format(item_type, item_id))
+
+        try:
+            status = result.json()[asset_type]['status']
+        except KeyError:
+            print('Asset type {} not available for {}. Skipping...'.format(asset_type, item_id))
+            return True
+
+        if status == 'active':
+            print('Item already active: {}'.format(item_id))
+            return False
+
+        item_activation_url = result.json()[asset_type]['_links']['activate']
+
+        print('Activating {} {} for {}'.format(item_type, asset_type, item_id))
+        result = await self.request('POST', item_activation_url)
+
+        return check_status(result, 'Activation process started successfully')
+
+    async def check_activation(self, item_id, item_type, asset_type):
+        """ `check_activation`: True if the asset is active.
+        """
+        result = await self.request('GET', self.asset_url.format(item_type, item_id))
+
+        try:
+            status = result.json()[asset_type]['status']
+        except KeyError:
+            print('Asset type {} not available for {}. Skipping...'.format(asset_type, item_id))
+            return True
+
+        print('{}: {}'.format(item_id, status))
+
+        if status == 'active':
+            return True
+        else:
+            print('Item not yet active: {}'.format(item_id))
+            return False
+
+    async def status(self, item_id, item_type, asset_type):
+        """ The activation status of the asset, or None if the item does
+            not have it.
+        """
+        result = await self.request('GET', self.asset_url.format(item_type, item_id))
+
+        try:
+            return result.json()[asset_type]['status']
+        except KeyError:
+            return None
+
+    async def download(self, item_id, item_type, asset_type, path, overwrite, lock=None):
+        """ `process_download` for one item: True if it was downloaded,
+            None if it already was and False if it is not active yet or
+            the download failed.
+
+            `lock(item_id)`, if given, is an async context manager that is
+            held for the download, e.g. so that runs sharing `path` do
+            not download the same item at once.
+        """
+        if lock is not None:
+            async with lock(item_id):
+                return await self.download(item_id, item_type, asset_type, path, overwrite)
+
+        if not overwrite and os.path.exists(local_asset_path(path, item_id, asset_type)):
+            return None
+
+        result = await self.request('GET', self.asset_url.format(item_type, item_id))
+
+        if result.json()[asset_type]['status'] != 'active':
+            return False
+
+        download_url = result.json()[asset_type]['location']
+        try:
+            return await self.call(download, download_url, path, item_id, asset_type, overwrite,
+                                   md5_digest=result.json()[asset_type].get('md5_digest'),
+                                   http=self.session)
+        except DownloadError as e:
+            print(e)
+            return False
+
+    async def gather(self, method, id_list, *args):
+        """ Calls `method` for every item in `id_list` concurrently and
+            returns the results in the same order.
+        """
+        return await asyncio.gather(*[method(item_id, *args) for item_id in id_list])
+
+
+class ActivationScheduler(object):
+    """ Activates scenes and polls them concurrently until they are
+        active, failed or time out.
+
+        Each scene has its own poll interval that starts at
+        `poll_interval` and grows by `backoff` up to `poll_interval_max`
+        while it is pending. Scenes that activate quickly are noticed
+        quickly, and slow ones do not cost a request every round. `wait`
+        returns as soon as the scenes it was given are settled, whatever
+        other scenes are still pending.
+    """
+
+    def __init__(self, item_type, asset_type, client=None,
+                 poll_interval=POLL_INTERVAL,
+                 poll_interval_max=POLL_INTERVAL_MAX,
+                 backoff=POLL_BACKOFF,
+                 timeout=ACTIVATION_TIMEOUT):
+        self.item_type = item_type
+        self.asset_type = asset_type
+        self.owns_client = client is None
+        self.client = client or AsyncPlanetClient()
+        self.poll_interval = poll_interval
+        self.poll_interval_max = poll_interval_max
+        self.backoff = backoff
+        self.timeout = timeout
+
+        self.requested = {}  # scene id -> time activation was requested
+        self.active = {}  # scene id -> seconds it took to activate
+        self.failed = set()
+
+    def close(self):
+        if self.owns_client:
+            self.client.close()
+
+    async def request_activation(self, item_id):
+        if item_id not in self.requested:
+            await self.client.activate(item_id, self.item_type, self.asset_type)
+            self.requested[item_id] = time.time()
+
+    async def wait_for(self, item_id):
+        """ True once the scene is active, False if it failed or timed out.
+        """
+        await self.request_activation(item_id)
+
+        interval = self.poll_interval
+        while True:
+            if item_id in self.active:
+                return True
+            if item_id in self.failed:
+                return False
+
+            status = await self.client.status(item_id, self.item_type, self.asset_type)
+            elapsed = time.time() - self.requested[item_id]
+
+            # like check_activation, a missing asset does not hold things up
+            if status is None or status == 'active':
+                self.active[item_id] = elapsed
+                return True
+
+            if status == 'failed' or elapsed > self.timeout:
+                self.failed.add(item_id)
+                return False
+
+            await asyncio.sleep(interval)
+            interval = min(interval * self.backoff, self.poll_interval_max)
+
+    def request(self, id_list):
+        """ Requests activation of the scenes without waiting for them.
+        """
+        self.client.run(self.client.gather(self.request_activation, id_list))
+
+    def wait(self, id_list):
+        """ Activates the scenes and waits for them; returns whether
+            each one is active.
+        """
+        return self.client.run(self.client.gather(self.wait_for, id_list))
+
+    def summary(self):
+        """ Counts of active, pending and failed scenes, and percentiles
+            of the seconds the active ones took to activate.
+        """
+        times = np.array(sorted(self.active.values()))
+        summary = {'active': len(self.active),
+                   'pending': len(set(self.requested) - set(self.active) - self.failed),
+                   'failed': len(self.failed)}
+
+        for q in (50, 90, 100):
+            summary['p{}_time_to_active'.format(q)] = (float(np.percentile(times, q))
+                                                       if times.size else None)
+
+        return summary
+
+    def report(self):
+        summary = self.summary()
+        percentiles = ', '.join('p{} {}'.format(q, 'n/a' if summary['p{}_time_to_active'.format(q)] is None
+                                                else '{:.0f}s'.format(summary['p{}_time_to_active'.format(q)]))
+                                for q in (50, 90, 100))
+        print("Activation: {} active, {} pending, {} failed; time to active {}".format(
+            summary['active'], summary['pending'], summary['failed'], percentiles))
+
+
+def process_activation_async(method_name, id_list, item_type, asset_type,
+                             max_concurrency=MAX_CONCURRENCY):
+    """ `process_activation` with an AsyncPlanetClient; `method_name` is
+        'activate' or 'check_activation'.
+    """
+    client = AsyncPlanetClient(max_concurrency=max_concurrency)
+    try:
+        return client.run(client.gather(getattr(client, method_name), id_list, item_type, asset_type))
+    finally:
+        client.close()
+
+
+def process_download_async(path, id_list, item_type, asset_type, overwrite,
+                           max_concurrency=MAX_CONCURRENCY, lock=None):
+    """ `process_download` with an AsyncPlanetClient; see its `download`
+        for `lock`.
+    """
+    # ensure directory structure exists
+    os.makedirs(path, exist_ok=True)
+
+    client = AsyncPlanetClient(max_concurrency=max_concurrency)
+    try:
+        return client.run(client.gather(client.download, id_list, item_type, asset_type, path, overwrite, lock))
+    finally:
+        client.close()
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--idlist', help='Location of file containing image ids (one per line) to process')
@@ -251,24 +900,25 @@ if __name__ == '__main__':
         print('%d available images' % len(id_list))
 
     elif args.activate:
-        results = process_activation(activate, id_list, args.item, args.asset)
+        results = process_activation_async('activate', id_list, args.item, args.asset)
         msg = 'Requested activation for {} of {} items'
         print(msg.format(results.count(True), len(results)))
 
     # check activation status of all data returned by search query
     elif args.check:
-        results = process_activation(check_activation, id_list, args.item,
-                                     args.asset)
+        results = process_activation_async('check_activation', id_list, args.item,
+                                           args.asset)
 
         msg = '{} of {} items are active'
         print(msg.format(results.count(True), len(results)))
 
     # download all data returned by search query
     elif args.download:
-        results = process_download(args.download, id_list, args.item,
-                                   args.asset, args.overwrite)
+        results = process_download_async(args.download, id_list, args.item,
+                                         args.asset, args.overwrite)
         msg = 'Successfully downloaded {} of {} files to {}. {} were not activated yet.'
         print(msg.format(results.count(True), len(results), args.download, results.count(False)))
+        get_session().report()
 
     else:
         parser.error('Error: no action supplied. Please check help (--help) or revise command.')
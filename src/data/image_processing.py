@@ -1,30 +1,102 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 import glob
+import json
 import logging
 import os
-import shutil
+import re
 from subprocess import check_output, CalledProcessError, STDOUT
+import time
 
+import click
+from joblib import Parallel, delayed, effective_n_jobs
 import numpy as np
 
 import rasterio
 
-from rasterio.transform import guard_transform
-from rio_hist.match import histogram_match, calculate_mask
-from rio_hist.utils import cs_backward, read_mask
+from rasterio import features
+from rasterio.crs import CRS
+from rasterio.shutil import copy as rio_copy
+from rasterio.transform import Affine, array_bounds, from_bounds, guard_transform
+from rasterio.vrt import WarpedVRT
+from rasterio.warp import calculate_default_transform, reproject, transform_geom, Resampling
+from rasterio.windows import Window
+from rasterio.windows import from_bounds as window_from_bounds
 
 from tqdm import tqdm
 
+from memory_budget import available_memory
+
 logger = logging.getLogger(__file__)
 
-def resize_tiff(input_path, output_path, width, height, projection='EPSG:32637'):
-    """ Uses gdalwarp to resize the tiff image at `input_path`
-        to `width` x `height` and stores it at the `output_path`.
+# pixels per window when no memory budget is given
+CHUNK_PIXELS = 2 ** 22
+
+# threads for batches of in-process resizes; GDAL releases the GIL
+# while warping, so these run concurrently
+RESIZE_THREADS = 4
+
+# input sizes of the pre-trained CNNs we export images for
+MODEL_SIZES = (299,  # InceptionV3
+               224)  # VGG16 and VGG19
+
+# tag recording the parameters a resized image was made with
+RESIZE_PARAMS_TAG = 'RESIZE_PARAMS'
+
+# filenames that `sized_output_path` produces
+SIZED_PATH_RE = re.compile(r'_\d+x\d+$')
+
+# creation options for the float32 images we rewrite
+TILED_PROFILE = dict(tiled=True,
+                     blockxsize=256,
+                     blockysize=256,
+                     compress='deflate',
+                     predictor=3)  # floating point predictor
+
+# tile size of cloud optimized GeoTIFF outputs; overviews are built
+# until the smallest one fits in a single tile
+COG_BLOCKSIZE = 512
+
+# bins per band of the streamed reference histograms
+REFERENCE_BINS = 2 ** 12
+
+
+def budget_row_windows(src, bytes_per_pixel, memory_budget):
+    """ Yields full width windows over `src` with as many rows as fit
+        in `memory_budget` (MB) at `bytes_per_pixel`, and at least one.
+    """
+    available = available_memory(memory_budget)
+
+    if available is None:
+        pixels = CHUNK_PIXELS
+    else:
+        pixels = available // bytes_per_pixel
+
+    rows = int(max(1, pixels // src.width))
+
+    for row_off in range(0, src.height, rows):
+        yield Window(0, row_off, src.width, min(rows, src.height - row_off))
+
+
+def resize_tiff(input_path, output_path, width, height, projection='EPSG:32637',
+                in_process=True):
+    """ Resizes the tiff image at `input_path` to `width` x `height`
+        in `projection` (None keeps the projection of the input) and
+        stores it at the `output_path`. Like gdalwarp -ts, a width or
+        height of 0 is calculated from the aspect ratio.
+
+        Runs in-process with `warp_tiff` unless `in_process` is False,
+        in which case it shells out to gdalwarp.
     """
+    if in_process:
+        return warp_tiff(input_path, output_path, width, height, projection)
+
+    projection_args = ['-t_srs', projection] if projection else []
+
     try:
-        check_output(['gdalwarp',
-                      '-t_srs',
-                      projection,
-                      '-ts',
+        check_output(['gdalwarp'] +
+                     projection_args +
+                     ['-ts',
                       str(width),
                       str(height),
                       '-overwrite',
@@ -36,16 +108,196 @@ def resize_tiff(input_path, output_path, width, height, projection='EPSG:32637')
         print(e.output)
         raise
 
+    return output_path
+
+
+def warp_tiff(input_path, output_path, width, height, projection=None,
+              resampling=Resampling.nearest):
+    """ The in-process equivalent of
+        `gdalwarp -t_srs projection -ts width height -overwrite`, built on
+        rasterio's reproject. Nearest neighbour resampling is the
+        gdalwarp default.
+    """
+    with rasterio.open(input_path) as src:
+        dst_crs = CRS.from_user_input(projection) if projection else src.crs
+
+        _, default_width, default_height = calculate_default_transform(src.crs,
+                                                                       dst_crs,
+                                                                       src.width,
+                                                                       src.height,
+                                                                       *src.bounds)
+        if not width:
+            width = max(1, int(round(default_width * height / float(default_height))))
+        if not height:
+            height = max(1, int(round(default_height * width / float(default_width))))
+
+        transform, width, height = calculate_default_transform(src.crs,
+                                                               dst_crs,
+                                                               src.width,
+                                                               src.height,
+                                                               *src.bounds,
+                                                               dst_width=width,
+                                                               dst_height=height)
+
+        profile = src.meta.copy()
+        profile.update(driver='GTiff',
+                       crs=dst_crs,
+                       transform=transform,
+                       width=width,
+                       height=height)
+
+        with rasterio.open(output_path, 'w', **profile) as dst:
+            for i in src.indexes:
+                reproject(rasterio.band(src, i),
+                          rasterio.band(dst, i),
+                          resampling=resampling)
+
+    return output_path
+
+
+def resize_tiffs(jobs, n_threads=RESIZE_THREADS, **kwargs):
+    """ Runs `resize_tiff` for every (input_path, output_path, width,
+        height) tuple in `jobs` in one process with a pool of
+        `n_threads` threads. `kwargs` are passed to `resize_tiff`.
+
+        Returns the output paths.
+    """
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        futures = [pool.submit(resize_tiff, *job, **kwargs) for job in jobs]
+        return [f.result() for f in futures]
+
+
+def is_merged_output(path):
+    """ Whether `path` is the merged image of an AOI, <aoi>_<asset>.tif
+        in the AOI's own folder, rather than a scene or a copy of one
+        in a subfolder such as hist_matched/ or assets/.
+    """
+    aoi = os.path.basename(os.path.dirname(path))
+    name = os.path.splitext(os.path.basename(path))[0]
+
+    return re.match(re.escape(aoi) + r'_[a-z]+$', name) is not None
+
+
+def sized_output_path(input_path, width, height):
+    """ The path a `width` x `height` copy of `input_path` is
+        stored at: the same folder with _{width}x{height} appended
+        to the filename.
+    """
+    path, ext = os.path.splitext(input_path)
+    return "{}_{}x{}{}".format(path, width, height, ext)
+
+
+def resize_params(width, height, projection, resampling):
+    """ The parameters a resized image is made with, as stored in its
+        RESIZE_PARAMS tag.
+    """
+    return json.dumps({'width': width,
+                       'height': height,
+                       'projection': projection,
+                       'resampling': Resampling(resampling).name},
+                      sort_keys=True)
+
+
+def is_up_to_date(input_path, output_path, params):
+    """ Make-style check: the output exists, is at least as new as the
+        input and was made with the same `params`.
+    """
+    if not os.path.exists(output_path):
+        return False
+
+    if os.path.getmtime(output_path) < os.path.getmtime(input_path):
+        return False
+
+    try:
+        with rasterio.open(output_path) as src:
+            return src.tags().get(RESIZE_PARAMS_TAG) == params
+    except rasterio.errors.RasterioIOError:
+        return False
+
+
+def warp_to_sizes(input_path, targets, projection='EPSG:32637',
+                  resampling=Resampling.nearest):
+    """ Resizes the tiff image at `input_path` to several sizes at once.
+        `targets` is a list of (output_path, width, height) tuples.
+
+        The source is read and reprojected to `projection` once, at its
+        native resolution, and every size is resampled from that array,
+        so adding a size does not add another read of the source. The
+        parameters are stored in each output's RESIZE_PARAMS tag.
+    """
+    with rasterio.open(input_path) as src:
+        dst_crs = CRS.from_user_input(projection) if projection else src.crs
+        profile = src.meta.copy()
+
+        if dst_crs == src.crs:
+            transform, width, height = src.transform, src.width, src.height
+            arr = src.read()
+        else:
+            transform, width, height = calculate_default_transform(src.crs,
+                                                                   dst_crs,
+                                                                   src.width,
+                                                                   src.height,
+                                                                   *src.bounds)
+            arr = np.zeros((src.count, height, width), dtype=src.dtypes[0])
+            reproject(src.read(),
+                      arr,
+                      src_transform=src.transform,
+                      src_crs=src.crs,
+                      src_nodata=src.nodata,
+                      dst_transform=transform,
+                      dst_crs=dst_crs,
+                      dst_nodata=src.nodata,
+                      resampling=resampling)
+
+    bounds = array_bounds(height, width, transform)
+
+    for output_path, out_width, out_height in targets:
+        out_transform = from_bounds(*bounds, width=out_width, height=out_height)
+        out = np.zeros((arr.shape[0], out_height, out_width), dtype=arr.dtype)
+
+        reproject(arr,
+                  out,
+                  src_transform=transform,
+                  src_crs=dst_crs,
+                  src_nodata=profile['nodata'],
+                  dst_transform=out_transform,
+                  dst_crs=dst_crs,
+                  dst_nodata=profile['nodata'],
+                  resampling=resampling)
+
+        profile.update(driver='GTiff',
+                       crs=dst_crs,
+                       transform=out_transform,
+                       width=out_width,
+                       height=out_height)
+
+        with rasterio.open(output_path, 'w', **profile) as dst:
+            dst.write(out)
+            dst.update_tags(**{RESIZE_PARAMS_TAG: resize_params(out_width,
+                                                                out_height,
+                                                                projection,
+                                                                resampling)})
+
+    return [output_path for output_path, _, _ in targets]
+
+
+def resize_for_models(input_path, sizes=MODEL_SIZES):
+    """ Pre-trained CNNs take square images of a fixed size. This helper
+        resizes a tiff to every size in `sizes` with a single read of the
+        source and outputs those files in the same folder with _{s}x{s}
+        appended to the filename.
+    """
+    return warp_to_sizes(input_path,
+                         [(sized_output_path(input_path, size, size), size, size)
+                          for size in sizes])
+
 
 def resize_for_inceptionv3(input_path):
     """ The InceptionV3 model takes images that are 299x299. This helper
         uses GDAL to resize tiffs to the proper size and output those
         files in the same folder with _299x299 appended to the filename.
     """
-    path, ext = os.path.splitext(input_path)
-    output_path = "{}{}{}".format(path, '_299x299', ext)
-
-    resize_tiff(input_path, output_path, 299, 299)
+    resize_for_models(input_path, [299])
 
 
 def resize_for_vgg(input_path):
@@ -53,194 +305,653 @@ def resize_for_vgg(input_path):
         uses GDAL to resize tiffs to the proper size and output those
         files in the same folder with _224x224 appended to the filename.
     """
-    path, ext = os.path.splitext(input_path)
-    output_path = "{}{}{}".format(path, '_224x224', ext)
-
-    resize_tiff(input_path, output_path, 224, 224)
+    resize_for_models(input_path, [224])
 
 
 def resize_all_in_dir(dir_path,
-                      ext='.tiff',
+                      ext='.tif',
                       recursive=True,
-                      resize_func=resize_for_inceptionv3):
-    """ Resizes all of the images in `dir_path` with `ext`
-        using `resize_func`.
+                      sizes=(299,),
+                      projection='EPSG:32637',
+                      n_jobs=RESIZE_THREADS,
+                      force=False,
+                      merged_only=True):
+    """ Resizes all of the images in `dir_path` with `ext` to every
+        size in `sizes`, like `resize_for_models`, in a pool of `n_jobs`
+        threads. Outputs that are newer than their input and were made
+        with the same parameters are skipped unless `force` is set.
+
+        With `merged_only`, only the merged images of the AOIs are
+        resized (see `is_merged_output`), not the scenes and scene
+        copies that live in the same tree.
+
+        Returns the output paths that were written.
     """
-    for filename in glob.glob(os.path.join(dir_path, '**', '*.{}'.format(ext)),
-                              recursive=recursive):
-        resize_func(filename)
+    pattern = os.path.join(dir_path, '**', '*.' + ext.lstrip('.'))
+    inputs = sorted(f for f in glob.glob(pattern, recursive=recursive)
+                    if not SIZED_PATH_RE.search(os.path.splitext(f)[0]) and
+                    (is_merged_output(f) or not merged_only))
+
+    jobs = []
+    for input_path in inputs:
+        targets = [(sized_output_path(input_path, size, size), size, size)
+                   for size in sizes]
+        stale = [t for t in targets
+                 if force or not is_up_to_date(input_path,
+                                               t[0],
+                                               resize_params(t[1], t[2], projection, Resampling.nearest))]
+        if stale:
+            jobs.append((input_path, stale))
+
+    print("Resizing {} of {} images in {}".format(len(jobs), len(inputs), dir_path))
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+        futures = [pool.submit(warp_to_sizes, input_path, targets, projection)
+                   for input_path, targets in jobs]
+        written = [p for f in tqdm(futures) for p in f.result()]
+    elapsed = max(time.perf_counter() - start, 1e-9)
+
+    n_bytes = sum(os.path.getsize(input_path) for input_path, _ in jobs)
+    print("Resized {} files ({:.1f} MB) in {:.1f} s: {:.1f} files/s, {:.1f} MB/s".format(
+        len(jobs), n_bytes / 1e6, elapsed, len(jobs) / elapsed, n_bytes / 1e6 / elapsed))
+
+    return written
+
+
+@contextmanager
+def resized_view(src, size):
+    """ A view of the open dataset `src` resized to the (width, height)
+        `size` with nearest neighbour resampling, or `src` itself if
+        `size` is None. Like gdalwarp -ts, a width or height of 0 is
+        calculated from the aspect ratio.
+    """
+    if size is None:
+        yield src
+        return
+
+    width, height = size
+    if not width:
+        width = max(1, int(round(src.width * height / float(src.height))))
+    if not height:
+        height = max(1, int(round(src.height * width / float(src.width))))
+
+    transform = src.transform * Affine.scale(src.width / float(width),
+                                             src.height / float(height))
+
+    with WarpedVRT(src,
+                   crs=src.crs,
+                   transform=transform,
+                   width=width,
+                   height=height,
+                   resampling=Resampling.nearest) as vrt:
+        yield vrt
+
+
+def snap_window(bounds, transform):
+    """ The integer Window of the pixels of the north up `transform`
+        grid that (left, bottom, right, top) `bounds` touches.
+    """
+    left, bottom, right, top = bounds
+    col_start, row_start = ~transform * (left, top)
+    col_stop, row_stop = ~transform * (right, bottom)
+
+    # tolerate floating point error on bounds that sit on the grid
+    col_start, row_start = [int(np.floor(x + 1e-6)) for x in (col_start, row_start)]
+    col_stop, row_stop = [int(np.ceil(x - 1e-6)) for x in (col_stop, row_stop)]
+
+    return Window(col_start, row_start, col_stop - col_start, row_stop - row_start)
+
+
+@contextmanager
+def reprojected_view(src, crs):
+    """ A view of the open dataset `src` in `crs`, or `src` itself if it
+        is already in `crs`.
+    """
+    if src.crs == crs:
+        yield src
+        return
+
+    with WarpedVRT(src, crs=crs, resampling=Resampling.nearest) as vrt:
+        yield vrt
+
 
+class LazyScene(object):
+    """ A scene with a resize, reflectance coefficients and per band
+        lookup tables that are applied as it is read, instead of being
+        written out as copies of the scene. Reads are nearest neighbour,
+        so these commute with the reprojection and windowing of the
+        mosaic; the scene is only realized where `mosaic_aoi` reads it.
 
-def adjust_image_by_reflectance(p, coeffs, bands, keep_raw=False):
+        `coeffs` maps band numbers to coefficients, like the
+        reflectance coefficients of `adjust_image_by_reflectance`, and
+        selects those bands. `luts` maps 0-based band positions of the
+        result to (edges, values) tables.
+    """
+
+    def __init__(self, path, size=None, coeffs=None, luts=None):
+        self.path = path
+        self.size = size
+        self.coeffs = coeffs
+        self.luts = luts or {}
+
+    def with_luts(self, luts):
+        return LazyScene(self.path, self.size, self.coeffs, luts)
+
+    @contextmanager
+    def open(self, crs=None):
+        with rasterio.open(self.path) as src, \
+                resized_view(src, self.size) as resized, \
+                reprojected_view(resized, crs or resized.crs) as view:
+            yield LazyView(view, self.coeffs, self.luts)
+
+
+class LazyView(object):
+    """ The dataset-like view of an open LazyScene; anything other than
+        the band count, metadata and pixel reads comes from `dataset`.
+    """
+
+    def __init__(self, dataset, coeffs=None, luts=None):
+        self.dataset = dataset
+        self.indexes = list(coeffs) if coeffs else list(dataset.indexes)
+        self.scale = (np.array([coeffs[i] for i in self.indexes], dtype=np.float32)[:, None, None]
+                      if coeffs else None)
+        self.luts = luts or {}
+
+    def __getattr__(self, name):
+        return getattr(self.dataset, name)
+
+    @property
+    def transformed(self):
+        return self.scale is not None or bool(self.luts)
+
+    @property
+    def count(self):
+        return len(self.indexes)
+
+    @property
+    def meta(self):
+        meta = self.dataset.meta.copy()
+        meta['count'] = self.count
+        if self.transformed:
+            meta['dtype'] = 'float32'
+        return meta
+
+    def read(self, window=None, out_shape=None, resampling=Resampling.nearest):
+        arr = self.dataset.read(self.indexes,
+                                window=window,
+                                out_shape=out_shape,
+                                resampling=resampling)
+        if not self.transformed:
+            return arr
+
+        arr = arr.astype(np.float32)
+        if self.scale is not None:
+            arr *= self.scale
+
+        for b, (edges, lut) in self.luts.items():
+            arr[b] = np.interp(arr[b], edges, lut)
+
+        return arr
+
+
+@contextmanager
+def open_scene(scene, crs=None):
+    """ Opens a path or a LazyScene for reading, in `crs` if given.
+    """
+    if isinstance(scene, LazyScene):
+        with scene.open(crs) as view:
+            yield view
+    else:
+        with rasterio.open(scene) as src, reprojected_view(src, crs or src.crs) as view:
+            yield view
+
+
+def lazy_batch_hist_match(scenes, bands, match_proportion=1.0, masked=True,
+                          memory_budget=None):
+    """ `batch_hist_match_worker` for LazyScenes: returns the scenes with
+        lookup tables that match them to the histogram across all of
+        them, instead of writing _hist_matched copies.
+
+        The histograms of all scenes share one range, so each scene's
+        histogram is also its share of the reference and two streamed
+        passes over the scenes are enough.
+    """
+    bixs = tuple([int(x) - 1 for x in bands.split(',')])
+
+    lo, hi = value_range(scenes, masked, memory_budget)
+
+    histograms = []
+    for scene in scenes:
+        histogram = ReferenceHistogram(lo, hi)
+        for arr, valid in iter_reference_windows([scene], masked, memory_budget):
+            histogram.update(arr, valid)
+        histograms.append(histogram)
+
+    reference = ReferenceHistogram(lo, hi)
+    reference.counts = np.sum([h.counts for h in histograms], axis=0)
+    ref_tables = {b: reference.quantile_table(b) for b in bixs}
+
+    return [scene.with_luts({b: histogram.lookup_table(b, *ref_tables[b],
+                                                       match_proportion=match_proportion)
+                             for b in bixs})
+            for scene, histogram in zip(scenes, histograms)]
+
+
+def mosaic_aoi(paths, aoi_geometries, output_path, aoi_crs='EPSG:32637'):
+    """ The in-process equivalent of
+        `gdalwarp -cutline aoi -crop_to_cutline paths output_path`, on
+        the grid of the last scene, where the geojson `aoi_geometries`
+        are in `aoi_crs`.
+
+        As with gdalwarp, later paths take priority over earlier ones, so
+        the mosaic is composed from the last scene back and stops reading
+        once every AOI pixel is filled. Scenes whose footprints miss the
+        AOI are skipped, and of the rest only the window that intersects
+        the AOI is read, so a small AOI costs a few blocks per scene
+        instead of whole scenes. `paths` can also hold LazyScenes, which
+        are only realized here.
+
+        Returns the paths of the scenes that were read.
+    """
+    with open_scene(paths[-1]) as last:
+        out_crs = last.crs
+        grid_transform = last.transform
+        profile = last.meta.copy()
+
+    geometries = [transform_geom(aoi_crs, out_crs, g) for g in aoi_geometries]
+    aoi_bounds = np.array([features.bounds(g) for g in geometries])
+    window = snap_window((aoi_bounds[:, 0].min(), aoi_bounds[:, 1].min(),
+                          aoi_bounds[:, 2].max(), aoi_bounds[:, 3].max()),
+                         grid_transform)
+
+    height, width = max(1, window.height), max(1, window.width)
+    out_transform = grid_transform * Affine.translation(window.col_off, window.row_off)
+    out_bounds = array_bounds(height, width, out_transform)
+
+    nodata = profile['nodata']
+    out = np.full((profile['count'], height, width),
+                  0 if nodata is None else nodata,
+                  dtype=profile['dtype'])
+
+    # pixels outside the cutline count as done
+    filled = features.geometry_mask(geometries, (height, width), out_transform)
+
+    used_paths = []
+    for path in reversed(paths):
+        if filled.all():
+            break
+
+        with open_scene(path, out_crs) as view:
+            west, south, east, north = view.bounds
+            overlap = (max(west, out_bounds[0]), max(south, out_bounds[1]),
+                       min(east, out_bounds[2]), min(north, out_bounds[3]))
+            if overlap[0] >= overlap[2] or overlap[1] >= overlap[3]:
+                continue
+
+            part = snap_window(overlap, out_transform).intersection(Window(0, 0, width, height))
+            rows, cols = part.toslices()
+            if filled[rows, cols].all():
+                continue
+
+            src_window = window_from_bounds(*array_bounds(part.height, part.width,
+                                                          out_transform * Affine.translation(part.col_off,
+                                                                                             part.row_off)),
+                                            transform=view.transform)
+            data = view.read(window=src_window,
+                             out_shape=(view.count, part.height, part.width),
+                             resampling=Resampling.nearest)
+            valid = view.dataset_mask(window=src_window,
+                                      out_shape=(part.height, part.width)) > 0
+
+        todo = valid & ~filled[rows, cols]
+        out[:, rows, cols][:, todo] = data[:, todo]
+        filled[rows, cols] |= todo
+        used_paths.append(path)
+
+    profile.update(driver='GTiff',
+                   width=width,
+                   height=height,
+                   transform=out_transform)
+
+    with rasterio.open(output_path, 'w', **profile) as dst:
+        dst.write(out)
+
+    return used_paths
+
+
+def overview_factors(width, height, blocksize=COG_BLOCKSIZE):
+    """ Decimation factors 2, 4, 8, ... down to the first overview of a
+        `width` x `height` image that fits in one `blocksize` tile.
+    """
+    factors = []
+    factor = 2
+    while max(width, height) / float(factor // 2) > blocksize:
+        factors.append(factor)
+        factor *= 2
+
+    return factors
+
+
+def make_cog(path, compress='deflate', dst_path=None, blocksize=COG_BLOCKSIZE,
+             resampling=Resampling.average):
+    """ Rewrites the image at `path` (or writes it to `dst_path`) as a
+        cloud optimized GeoTIFF: internally tiled, compressed with
+        `compress`, with overviews stored ahead of the full resolution
+        data, so windowed and decimated reads only touch the blocks they
+        need.
+
+        The overviews are built on a tiled copy that is then copied with
+        COPY_SRC_OVERVIEWS, which also works with GDAL builds that
+        predate the COG driver. The result is renamed into place.
+    """
+    dst_path = dst_path or path
+    ovr_path = dst_path + '.ovr.tmp'
+    tmp_path = dst_path + '.tmp'
+
+    with rasterio.open(path) as src:
+        factors = overview_factors(src.width, src.height, blocksize)
+        floating = np.dtype(src.dtypes[0]).kind == 'f'
+
+    options = dict(tiled=True,
+                   blockxsize=blocksize,
+                   blockysize=blocksize,
+                   compress=compress)
+    if compress.lower() in ('deflate', 'lzw', 'zstd'):
+        options['predictor'] = 3 if floating else 2
+
+    try:
+        rio_copy(path, ovr_path, driver='GTiff', **options)
+
+        with rasterio.open(ovr_path, 'r+') as dst:
+            if factors:
+                dst.build_overviews(factors, resampling)
+                dst.update_tags(ns='rio_overview', resampling=resampling.name)
+
+        rio_copy(ovr_path, tmp_path, driver='GTiff', copy_src_overviews=True, **options)
+    finally:
+        if os.path.exists(ovr_path):
+            os.remove(ovr_path)
+
+    os.replace(tmp_path, dst_path)
+
+    return dst_path
+
+
+def adjust_image_by_reflectance(p, coeffs, bands, keep_raw=False, dst_path=None, size=None,
+                                creation_options=TILED_PROFILE):
     """ Overwrites a raw image with values multiplied by the
         provided reflectance coefficient for each band.
+
+        The image is converted one output block at a time into a tiled,
+        compressed temp file that is then renamed over the original. With
+        a `dst_path` the result is written there instead and the raw
+        image is left alone. A (width, height) `size` resizes the image
+        in the same pass, so the scene is only decoded once.
     """
+    dst_path = dst_path or p
+    tmp_path = dst_path + '.tmp'
+
     try:
-        with rasterio.open(p) as src:
-            updated_bands = []
-            for i in bands:
-                band = src.read(i)
-                new_band = (i, band.astype(np.float32) * coeffs[i])
-                updated_bands.append(new_band)
-
-            kwargs = src.meta
+        with rasterio.open(p) as src, resized_view(src, size) as view:
+            kwargs = src.meta.copy()
+            kwargs.update(creation_options)
+            kwargs.update(
+                driver='GTiff',
+                dtype=np.float32,
+                count=len(bands),
+                width=view.width,
+                height=view.height,
+                transform=view.transform)
+
+            scale = np.array([coeffs[i] for i in bands], dtype=np.float32)[:, None, None]
+
+            with rasterio.open(tmp_path, 'w', **kwargs) as dst:
+                for _, window in dst.block_windows(1):
+                    block = view.read(bands, window=window).astype(np.float32)
+                    block *= scale
+                    dst.write(block, window=window)
+
     except rasterio.errors.RasterioIOError:
         print("Bad data, rasterio could not process {}".format(p))
-        return False, ''
 
-    kwargs.update(
-        dtype=np.float32,
-        count=len(bands))
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
 
-    if not keep_raw:
-        os.remove(p)
-    else:
+        return False, ''
+
+    if keep_raw and dst_path == p:
         # store the original raw version
-        shutil.move(p, p + "_raw")
+        raw_path = p + "_raw"
+        if os.path.exists(raw_path):
+            os.remove(raw_path)
+        os.link(p, raw_path)
 
-    # rewrite in same location
-    with rasterio.open(p, 'w', **kwargs) as dst:
-        for i, band_data in updated_bands:
-            dst.write_band(i, band_data)
+    # rewrite in place; readers see either the old or the new file
+    os.replace(tmp_path, dst_path)
 
-    return True, p
+    return True, dst_path
 
 
 def batch_hist_match_worker(ref_paths, match_proportion,
                             creation_options, bands, color_space, plot,
                             masked=True,
-                            dst_suffix='_hist_matched'):
+                            dst_suffix='_hist_matched',
+                            dst_dir=None,
+                            memory_budget=None,
+                            n_jobs=1):
 
     """Matches the histogram of every image in ref_paths
        to the average histogram across all of the included images.
 
-       Outputs each file with _hist_matched appended to the filename.
+       Outputs each file with _hist_matched appended to the filename,
+       next to the input or in `dst_dir`.
+
+       The reference histogram is accumulated while streaming over the
+       images in windows that fit in `memory_budget` (MB), so it takes
+       O(bands x REFERENCE_BINS) memory however many images there are.
+       Its quantile table is computed once per band and the images are
+       then matched independently, and streamed in the same way, in
+       `n_jobs` worker processes that share the budget.
 
        Modified from:
        https://github.com/mapbox/rio-hist/blob/81e3d5f0f59ba1e4e15f8850592a818501957ed2/rio_hist/match.py
     """
 
-    # we need one sample to setup the processing
-    src_path = ref_paths[0]
+    bixs = tuple([int(x) - 1 for x in bands.split(',')])
+
+    reference = ReferenceHistogram.from_paths(ref_paths, masked, memory_budget)
+    ref_tables = {b: reference.quantile_table(b) for b in bixs}
+
+    # each of the parallel workers gets an equal share of the budget
+    worker_budget = None
+    if memory_budget is not None:
+        worker_budget = memory_budget / effective_n_jobs(n_jobs)
+
+    print("Matching histograms...")
+    return Parallel(n_jobs=n_jobs)(delayed(match_source_histograms)(src_path,
+                                                                    ref_tables,
+                                                                    bixs,
+                                                                    match_proportion,
+                                                                    creation_options,
+                                                                    masked,
+                                                                    dst_suffix,
+                                                                    dst_dir,
+                                                                    worker_budget)
+                                   for src_path in tqdm(ref_paths))
+
+
+def match_source_histograms(src_path, ref_tables, bixs, match_proportion,
+                            creation_options, masked=True, dst_suffix='_hist_matched',
+                            dst_dir=None, memory_budget=None):
+    """ Matches the bands `bixs` of the image at `src_path` to the
+        (values, quantiles) table for each band in `ref_tables` and
+        writes the result with `dst_suffix` appended to the filename,
+        next to the input or in `dst_dir`.
+
+        The image is streamed in windows that fit in `memory_budget`
+        (MB): once for its own histograms, which give a lookup table per
+        band from `ReferenceHistogram.lookup_table`, and once to apply
+        them.
+    """
+    try:
+        source = ReferenceHistogram.from_paths([src_path], masked, memory_budget)
+        luts = {b: source.lookup_table(b, *ref_tables[b], match_proportion=match_proportion)
+                for b in bixs}
+        n_valid = source.counts[0].sum()
+    except ValueError:
+        # no valid pixels, which are written unchanged
+        luts, n_valid = None, 0
 
     with rasterio.open(src_path) as src:
         profile = src.profile.copy()
-        src_arr = src.read(masked=masked)
 
-        if src_arr.dtype != np.float32:
-            raise("Currently, this only supports float32")
+        # like rio_hist's calculate_mask, only write a mask if some
+        # pixels are masked
+        has_mask = masked and n_valid < src.width * src.height
 
-        if masked:
-            src_mask, src_fill = calculate_mask(src, src_arr)
-            src_arr = src_arr.filled()
-        else:
-            src_mask, src_fill = None, None
+        # profile['dtype'] = 'uint8'
+        profile['nodata'] = None
+        profile['transform'] = guard_transform(profile['transform'])
+        profile.update(creation_options)
 
-    ref_out = np.zeros([len(ref_paths)] + list(src_arr.shape), dtype=src_arr.dtype)
+        input_base_filepath = os.path.splitext(os.path.abspath(src_path))[0]
+        if dst_dir is not None:
+            os.makedirs(dst_dir, exist_ok=True)
+            input_base_filepath = os.path.join(dst_dir, os.path.basename(input_base_filepath))
+        dst_path = '{}{}.tif'.format(input_base_filepath, dst_suffix)
 
-    # no bands, just masks
-    ref_mask_out = np.zeros([len(ref_paths)] + list(src_arr.shape[1:]), dtype=src_arr.dtype)
+        logger.info("Writing raster {}".format(dst_path))
+        with rasterio.open(dst_path, 'w', **profile) as dst:
+            # the bands as read, their float64 matches and the mask
+            bytes_per_pixel = len(bixs) * (np.dtype(src.dtypes[0]).itemsize + 8) + 1
 
-    n_bands = src_arr.shape[0]
+            for window in budget_row_windows(src, bytes_per_pixel, memory_budget):
+                arr = src.read([b + 1 for b in bixs], window=window)
+                valid = src.dataset_mask(window=window) > 0 if has_mask else None
 
-    for i, ref_path in enumerate(ref_paths):
-        # import pdb;pdb.set_trace();
-        try:
-            with rasterio.open(ref_path, 'r') as ref:
-                ref_arr = ref.read(masked=masked)
+                for band, b in zip(arr, bixs):
+                    if luts is None:
+                        matched = band
+                    else:
+                        edges, lut = luts[b]
+                        matched = np.interp(band, edges, lut)
 
-                if masked:
-                    ref_mask, ref_fill = calculate_mask(ref, ref_arr)
-                    ref_arr = ref_arr.filled()
-                else:
-                    ref_mask, ref_fill = None, None
+                    # masked pixels are left unchanged
+                    if valid is not None:
+                        matched = np.where(valid, matched, band)
 
-                ref_out[i, :, :, :] = ref_arr
+                    dst.write(matched.astype(profile['dtype']), b + 1, window=window)
 
-                if ref_mask is None:
-                    ref_mask_out = None
-                else:
-                    ref_mask_out[i, :, :] = ref_mask
-        except:
-            import pdb;pdb.set_trace()
+                if has_mask:
+                    # write to extra band
+                    dst.write((valid * 255).astype('uint8'), bixs[-1] + 2, window=window)
 
-    bixs = tuple([int(x) - 1 for x in bands.split(',')])
+    return dst_path
 
-    # arrnorm_raw = ref_out / np.iinfo(ref_out.dtype).max
-    ref = ref_out #[:, bixs, :, :]
 
-    output_paths = []
+class ReferenceHistogram(object):
+    """ Per band histograms of the valid pixels across a set of reference
+        images, over [lo, hi) per band in `bins` equal bins.
+    """
 
-    print("Matching histograms...")
-    for src_path in tqdm(ref_paths):
-        with rasterio.open(src_path) as src:
-            profile = src.profile.copy()
-            src_arr = src.read(masked=masked)
-
-            if masked:
-                src_mask, src_fill = calculate_mask(src, src_arr)
-                src_arr = src_arr.filled()
-            else:
-                src_mask, src_fill = None, None
-
-        # src = cs_forward(src_arr, color_space, band_range=range(n_bands))
-        src = src_arr
-
-        target = src.copy()
-        for i, b in enumerate(bixs):
-            logger.debug("Processing band {}".format(b))
-            src_band = src[b]
-            ref_band = ref[:, b, :, :]
-
-            # Re-apply 2D mask to each band
-            if src_mask is not None:
-                logger.debug("apply src_mask to band {}".format(b))
-                src_band = np.ma.asarray(src_band)
-                src_band.mask = src_mask
-                src_band.fill_value = src_fill
-
-            if ref_mask_out is not None:
-                logger.debug("apply ref_mask to band {}".format(b))
-                ref_band = np.ma.asarray(ref_band)
-                ref_band.mask = ref_mask_out
-                ref_band.fill_value = ref_fill
-
-            target[b] = histogram_match(src_band, ref_band, match_proportion)
-
-        target_rgb = target # cs_backward(target, color_space)
-
-        # re-apply src_mask to target_rgb and write ndv
-        if src_mask is not None:
-            logger.debug("apply src_mask to target_rgb")
-            if not np.ma.is_masked(target_rgb):
-                target_rgb = np.ma.asarray(target_rgb)
-            target_rgb.mask = np.array((src_mask, src_mask, src_mask))
-            target_rgb.fill_value = src_fill
-
-        profile['count'] = n_bands
+    def __init__(self, lo, hi, bins=REFERENCE_BINS):
+        self.lo = np.asarray(lo, dtype=np.float64)
+        self.hi = np.maximum(np.asarray(hi, dtype=np.float64), self.lo + 1e-6)
+        self.bins = bins
+        self.counts = np.zeros((len(self.lo), bins), dtype=np.int64)
+
+    @classmethod
+    def from_paths(cls, ref_paths, masked=True, memory_budget=None, bins=REFERENCE_BINS):
+        """ Streams over `ref_paths` (paths or LazyScenes) twice, once for
+            the range of every band and once for the histograms.
+        """
+        reference = cls(*value_range(ref_paths, masked, memory_budget), bins=bins)
+        for arr, valid in iter_reference_windows(ref_paths, masked, memory_budget):
+            reference.update(arr, valid)
+
+        return reference
+
+    def update(self, arr, valid):
+        """ Adds the pixels of the (bands, rows, cols) `arr` where the
+            (rows, cols) `valid` is True.
+        """
+        scale = self.bins / (self.hi - self.lo)
+
+        for b, band in enumerate(arr):
+            idx = ((band[valid].astype(np.float64) - self.lo[b]) * scale[b]).astype(np.int64)
+            np.clip(idx, 0, self.bins - 1, out=idx)
+            self.counts[b] += np.bincount(idx, minlength=self.bins)
+
+    def quantile_table(self, b):
+        """ (values, quantiles) of the piecewise linear CDF of band `b`,
+            through the lower edge of the first occupied bin and the
+            upper edge of every occupied bin.
+        """
+        edges = np.linspace(self.lo[b], self.hi[b], self.bins + 1)
+        counts = self.counts[b]
+        occupied = counts > 0
+
+        values = np.concatenate([edges[:-1][occupied][:1], edges[1:][occupied]])
+        quantiles = np.concatenate([[0.], np.cumsum(counts[occupied]) / float(counts.sum())])
+
+        return values, quantiles
+
+    def lookup_table(self, b, ref_values, ref_quantiles, match_proportion=1.0):
+        """ (edges, values) of the lookup table that matches band `b` of
+            these histograms to a reference (values, quantiles) table:
+            the CDF at the bin edges mapped through the reference table,
+            like `rio_hist.match.histogram_match` without sorting the
+            pixels. Apply it with np.interp.
+        """
+        edges = np.linspace(self.lo[b], self.hi[b], self.bins + 1)
+        counts = self.counts[b]
+
+        s_quantiles = np.concatenate([[0.], np.cumsum(counts)]) / float(max(counts.sum(), 1))
+        lut = np.interp(s_quantiles, ref_quantiles, ref_values)
+
+        if match_proportion is not None and match_proportion != 1:
+            lut = edges - ((edges - lut) * match_proportion)
+
+        return edges, lut
+
+
+def value_range(ref_paths, masked, memory_budget):
+    """ The (lo, hi) arrays of the valid values of every band across
+        `ref_paths` (paths or LazyScenes).
+    """
+    lo, hi = None, None
+    for arr, valid in iter_reference_windows(ref_paths, masked, memory_budget):
+        if not valid.any():
+            continue
 
-        # profile['dtype'] = 'uint8'
-        profile['nodata'] = None
-        profile['transform'] = guard_transform(profile['transform'])
-        profile.update(creation_options)
+        arr_lo = np.array([band[valid].min() for band in arr])
+        arr_hi = np.array([band[valid].max() for band in arr])
+        lo = arr_lo if lo is None else np.minimum(lo, arr_lo)
+        hi = arr_hi if hi is None else np.maximum(hi, arr_hi)
 
-        input_base_filepath = os.path.splitext(os.path.abspath(src_path))[0]
-        dst_path = '{}{}.tif'.format(input_base_filepath, dst_suffix)
+    if lo is None:
+        raise ValueError("The reference images have no valid pixels")
 
-        logger.info("Writing raster {}".format(dst_path))
-        with rasterio.open(dst_path, 'w', **profile) as dst:
-            for b in bixs:
-                dst.write(target_rgb[b], b + 1)
+    return lo, hi
 
-            if src_mask is not None:
-                gdal_mask = (np.invert(src_mask) * 255).astype('uint8')
 
-                # write to extra band
-                dst.write(gdal_mask, bixs[-1] + 2)
+def iter_reference_windows(ref_paths, masked, memory_budget):
+    """ Yields (arr, valid) for windows over every image in `ref_paths`
+        (paths or LazyScenes), where valid is the dataset mask if `masked`
+        and all True otherwise.
+    """
+    for ref_path in ref_paths:
+        with open_scene(ref_path) as ref:
+            for window in budget_row_windows(ref, (ref.count + 1) * 8, memory_budget):
+                arr = ref.read(window=window)
 
-        output_paths.append(dst_path)
+                if masked:
+                    valid = ref.dataset_mask(window=window) > 0
+                else:
+                    valid = np.ones(arr.shape[1:], dtype=bool)
 
-    return output_paths
+                yield arr, valid
 
 
 def cs_forward(arr, cs='rgb', band_range=range(3)):
@@ -269,3 +980,27 @@ def cs_forward(arr, cs='rgb', band_range=range(3)):
         return convert_arr(arrnorm,
                            src=ColorSpace.rgb,
                            dst=ColorSpace.xyz)
+
+
+@click.command()
+@click.argument('dir_path', type=click.Path(exists=True))
+@click.option('--ext', default='.tif', help="Extension of the images to resize.")
+@click.option('--size', 'sizes', default=MODEL_SIZES, type=int, multiple=True,
+              help="Output width and height; repeat for several sizes.")
+@click.option('--projection', default='EPSG:32637', help="Projection of the resized images.")
+@click.option('--n_jobs', default=RESIZE_THREADS, type=int, help="Number of resize threads.")
+@click.option('--force', is_flag=True, help="Resize images even if the outputs are up to date.")
+@click.option('--all_images', is_flag=True,
+              help="Resize every image in the tree, not only the merged <aoi>_<asset> images.")
+def main(dir_path, ext, sizes, projection, n_jobs, force, all_images):
+    resize_all_in_dir(dir_path,
+                      ext=ext,
+                      sizes=sizes,
+                      projection=projection,
+                      n_jobs=n_jobs,
+                      force=force,
+                      merged_only=not all_images)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+""" Memory budgets for the raster stages in src/data and src/features:
+    how much of a budget is left for read windows on top of what the
+    process is using, and reporting of the peak against the budget.
+"""
+import os
+import resource
+import sys
+import warnings
+
+
+class MemoryBudgetWarning(UserWarning):
+    pass
+
+
+def peak_rss():
+    """ Peak resident memory of this process so far, in bytes.
+    """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # kilobytes on linux, bytes on macOS
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+# what the process used before any raster was read; the peak is still
+# the current usage this early
+BASELINE_RSS = peak_rss()
+
+
+def resident_memory():
+    """ Resident memory of this process now, in bytes. Where /proc is not
+        available this is the baseline measured at startup, so that the
+        budget covers the working set on top of it.
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return BASELINE_RSS
+
+
+def available_memory(memory_budget):
+    """ Bytes left in `memory_budget` (MB) on top of what this process
+        is using now, or None if there is no budget. Warns if the process
+        already uses the whole budget.
+    """
+    if memory_budget is None:
+        return None
+
+    rss = resident_memory()
+    available = memory_budget * 2 ** 20 - rss
+
+    if available <= 0:
+        warnings.warn("The memory budget of {:.0f} MB is below the {:.0f} MB this process "
+                      "already uses; reading the smallest windows possible.".format(memory_budget,
+                                                                                    rss / 2 ** 20),
+                      MemoryBudgetWarning)
+
+    return max(0, available)
+
+
+def report_peak_rss(stage, memory_budget, rss=None):
+    """ Prints the peak RSS of a stage next to its memory budget.
+    """
+    rss = peak_rss() if rss is None else rss
+    budget = 'none' if memory_budget is None else '{:.0f} MB'.format(memory_budget)
+
+    print("{}: peak RSS {:.0f} MB, memory budget {}".format(stage, rss / 2 ** 20, budget))
@@ -0,0 +1,74 @@
+""" A spatial index of the footprints of Planet scenes, so that one
+    search over a whole region can stand in for a search for each of
+    the AOIs in it.
+
+    The index is a shapely STRtree; it returns the scenes whose
+    footprints intersect an AOI, in the order of the search results.
+"""
+import numbers
+
+from shapely.geometry import shape
+from shapely.strtree import STRtree
+
+
+def sort_scenes(scenes):
+    """ The IDs of the scenes in the order they are merged in, by
+        cloud_cover and then update time, descending.
+    """
+    scenes = sorted(scenes,
+                    key=lambda x: (x['properties']['cloud_cover'], x['properties']['updated']),
+                    reverse=True)
+
+    return [s['id'] for s in scenes]
+
+
+def geometry_bounds(geometry):
+    """ (xmin, ymin, xmax, ymax) of a GeoJSON geometry or Feature.
+    """
+    if 'geometry' in geometry:
+        geometry = geometry['geometry']
+
+    return shape(geometry).bounds
+
+
+class SceneIndex(object):
+    """ The footprints of the scenes from a search, as returned by
+        `download_planet_lib.run_search`.
+
+        Only the scenes are pickled; the index is built again where it
+        is unpickled.
+    """
+
+    def __init__(self, scenes):
+        self.scenes = scenes
+        self.footprints = [shape(scene['geometry']) for scene in self.scenes]
+        self.positions = {id(footprint): i for i, footprint in enumerate(self.footprints)}
+        self.tree = STRtree(self.footprints)
+
+    def __getstate__(self):
+        return {'scenes': self.scenes}
+
+    def __setstate__(self, state):
+        self.__init__(state['scenes'])
+
+    def intersecting(self, geometry):
+        """ The scenes whose footprints intersect the GeoJSON `geometry`,
+            in the order of the search results.
+        """
+        if 'geometry' in geometry:
+            geometry = geometry['geometry']
+
+        aoi = shape(geometry)
+
+        # shapely 2 returns indices, earlier versions the geometries
+        hits = [int(hit) if isinstance(hit, numbers.Integral) else self.positions[id(hit)]
+                for hit in self.tree.query(aoi)]
+        hits = [i for i in hits if self.footprints[i].intersects(aoi)]
+
+        return [self.scenes[i] for i in sorted(hits)]
+
+    def scene_ids(self, geometry):
+        """ What `get_sorted_scenes_from_query` returns for a search of
+            `geometry` with the same filters as the regional search.
+        """
+        return sort_scenes(self.intersecting(geometry))
@@ -0,0 +1,97 @@
+""" A cache of Planet search results on disk, so that rerunning a county
+    or a season does not search the catalogue again for the same AOIs.
+
+    Results are keyed by a digest of the whole search request (item
+    types and the geometry, date range and cloud cover filters), written
+    in a canonical form so the order of the keys does not matter.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+
+SEARCH_CACHE_ROOT = os.path.abspath(os.path.join(__file__,
+                                                 os.pardir,
+                                                 os.pardir,
+                                                 os.pardir,
+                                                 'data',
+                                                 'raw',
+                                                 'planet',
+                                                 'search_cache'))
+
+
+class SearchCacheMiss(Exception):
+    pass
+
+
+def search_digest(search_request):
+    """ A digest of the search request that does not depend on the order
+        of the keys.
+    """
+    canonical = json.dumps(search_request, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
+
+class SearchCache(object):
+    """ Search results stored as JSON in `root`. Results older than `ttl`
+        seconds are searched for again; None keeps them forever. In
+        `offline` mode nothing is searched for and a request that is not
+        cached raises SearchCacheMiss.
+    """
+
+    def __init__(self, root=SEARCH_CACHE_ROOT, ttl=None, offline=False):
+        self.root = root
+        self.ttl = ttl
+        self.offline = offline
+
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, search_request):
+        return os.path.join(self.root, '{}.json'.format(search_digest(search_request)))
+
+    def get(self, search_request):
+        """ The cached results of the search, or None if they are not
+            cached or have expired.
+        """
+        path = self.path(search_request)
+
+        try:
+            if self.ttl is not None and time.time() - os.path.getmtime(path) > self.ttl:
+                return None
+
+            with open(path) as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        # guard against digest collisions; compared as JSON, since
+        # tuples in the request come back as lists
+        if cached['request'] != json.loads(json.dumps(search_request)):
+            return None
+
+        return cached['scenes']
+
+    def put(self, search_request, scenes):
+        path = self.path(search_request)
+        tmp_path = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+
+        with open(tmp_path, 'w') as f:
+            json.dump({'request': search_request, 'scenes': scenes}, f)
+
+        os.replace(tmp_path, path)
+
+    def search(self, search_request, run_search):
+        """ The results of `run_search(search_request)`, from the cache if
+            they are there.
+        """
+        scenes = self.get(search_request)
+
+        if scenes is None:
+            if self.offline:
+                raise SearchCacheMiss('Search {} is not cached'.format(search_digest(search_request)))
+
+            scenes = run_search(search_request)
+            self.put(search_request, scenes)
+
+        return scenes
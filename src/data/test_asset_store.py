@@ -0,0 +1,96 @@
+from concurrent.futures import ThreadPoolExecutor
+import os
+import time
+
+import asyncio
+
+import asset_store
+
+
+def test_paths_are_keyed_by_scene_asset_and_params(tmpdir):
+    store = asset_store.AssetStore(str(tmpdir))
+
+    assert store.path('s1', 'analytic') == str(tmpdir.join('s1_analytic.tif'))
+    assert store.path('s1', 'analytic_xml') == str(tmpdir.join('s1.xml'))
+
+    resized = store.path('s1', 'analytic', {'resize_pxs': 1000, 'reflectance': True})
+    assert resized == store.path('s1', 'analytic', {'reflectance': True, 'resize_pxs': 1000})
+    assert resized != store.path('s1', 'analytic', {'resize_pxs': 500, 'reflectance': True})
+    assert resized != store.path('s2', 'analytic', {'resize_pxs': 1000, 'reflectance': True})
+    assert os.path.dirname(resized) == str(tmpdir.join('derived'))
+
+
+def test_get_or_create_makes_each_asset_once(tmpdir):
+    store = asset_store.AssetStore(str(tmpdir))
+    calls = []
+
+    def create(tmp_path):
+        calls.append(tmp_path)
+        time.sleep(0.05)
+        with open(tmp_path, 'w') as f:
+            f.write('resized')
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        paths = list(pool.map(lambda _: store.get_or_create('s1', 'analytic', {'resize_pxs': 10}, create),
+                              range(8)))
+
+    assert len(calls) == 1
+    assert len(set(paths)) == 1
+    with open(paths[0]) as f:
+        assert f.read() == 'resized'
+
+    # no temp files are left behind, and a failed create stores nothing
+    assert os.listdir(str(tmpdir.join('derived'))) == [os.path.basename(paths[0])]
+    assert store.get_or_create('s2', 'analytic', {'resize_pxs': 10}, lambda tmp_path: None) is None
+    assert os.listdir(str(tmpdir.join('derived'))) == [os.path.basename(paths[0])]
+
+
+def test_adopt_brings_in_legacy_raw_assets(tmpdir):
+    legacy = tmpdir.mkdir('Nakuru').mkdir('assets')
+    legacy.join('s1_analytic.tif').write('s1')
+    legacy.join('s1.xml').write('xml')
+    legacy.join('s2_analytic.tif.part').write('partial')
+    legacy.join('failed_downloads.log').write('s3')
+    legacy.mkdir('resized').join('s1_analytic.tif').write('resized')
+
+    store = asset_store.AssetStore(str(tmpdir.join('store')))
+    tmpdir.join('store', 's1.xml').write('already stored')
+
+    assert store.adopt(str(legacy)) == 1
+    assert tmpdir.join('store', 's1_analytic.tif').read() == 's1'
+    assert tmpdir.join('store', 's1.xml').read() == 'already stored'
+    assert not tmpdir.join('store', 's2_analytic.tif.part').exists()
+    assert not tmpdir.join('store', 'failed_downloads.log').exists()
+    assert legacy.join('s1_analytic.tif').exists()
+
+    assert store.adopt(str(legacy)) == 0
+    assert store.adopt(str(tmpdir.join('missing'))) == 0
+
+
+def test_async_lock_waits_without_blocking_the_loop(tmpdir):
+    store = asset_store.AssetStore(str(tmpdir))
+    path = store.path('s1', 'analytic')
+    events = []
+
+    async def locked():
+        async with store.lock(path):
+            events.append('locked')
+
+    async def other_work():
+        events.append('other work')
+        await asyncio.sleep(0.1)
+        lock.release()
+
+    async def both():
+        await asyncio.wait_for(asyncio.gather(locked(), other_work()), 5)
+
+    lock = store.lock(path)
+    lock.acquire()
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(both())
+    finally:
+        loop.close()
+
+    assert events == ['other work', 'locked']
@@ -0,0 +1,414 @@
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+import os
+from socketserver import ThreadingMixIn
+import threading
+import time
+
+import pytest
+import requests
+
+import asset_store
+import download_planet_lib as planet_lib
+
+
+class FakePlanetServer(ThreadingMixIn, HTTPServer):
+    """ Serves the parts of the Planet data API the client uses, with
+        `failures` 429 responses for the item IDs in it first. Downloads
+        of the item IDs in `disconnects` send that many bytes, at most,
+        before dropping the connection, once per listed size.
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), FakePlanetHandler)
+        self.root = 'http://127.0.0.1:{}'.format(self.server_address[1])
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.requests = []
+        self.failures = {}
+        self.status = {}
+        self.activate_after = {}
+        self.assets = {}
+        self.md5 = {}
+        self.disconnects = {}
+        self.delay = 0.02
+
+
+class FakePlanetHandler(BaseHTTPRequestHandler):
+    # keep connections alive between requests
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, body, code=200):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def handle_request(self, method):
+        server = self.server
+        with server.lock:
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+            server.requests.append((method, self.path))
+
+        try:
+            time.sleep(server.delay)
+            self.route(method)
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+    def route(self, method):
+        server = self.server
+        parts = self.path.strip('/').split('/')
+
+        if parts[0] == 'redirect':
+            # redirects to itself forever
+            self.send_response(302)
+            self.send_header('Location', server.root + self.path)
+            self.send_header('Content-Length', '0')
+            return self.end_headers()
+
+        if parts[0] == 'quick-search':
+            page = int(parts[1]) if len(parts) > 1 else 0
+            links = {'_next': server.root + '/quick-search/{}'.format(page + 1)} if page < 2 else {}
+            feature = {'id': 'scene{}'.format(page),
+                       'properties': {'updated': '2016-08-0{}'.format(page + 1), 'cloud_cover': 0.01}}
+            return self.send_json({'features': [feature], '_links': links})
+
+        item_id = parts[3] if parts[0] == 'item-types' else parts[1]
+
+        with server.lock:
+            failures = server.failures.get(item_id, 0)
+            if failures:
+                server.failures[item_id] = failures - 1
+        if failures:
+            return self.send_json({}, code=429)
+
+        if parts[0] == 'item-types':
+            with server.lock:
+                status = server.status.get(item_id, 'inactive')
+
+                # becomes active after some number of checks
+                if status == 'activating' and item_id in server.activate_after:
+                    server.activate_after[item_id] -= 1
+                    if server.activate_after[item_id] < 0:
+                        status = server.status[item_id] = 'active'
+            md5 = server.md5.get(item_id)
+            if md5 is None and item_id in server.assets:
+                md5 = hashlib.md5(server.assets[item_id]).hexdigest()
+            return self.send_json({'analytic': {'status': status,
+                                                '_links': {'activate': server.root + '/activate/' + item_id},
+                                                'location': server.root + '/download/' + item_id,
+                                                'md5_digest': md5}})
+        elif parts[0] == 'activate':
+            with server.lock:
+                if server.status.get(item_id, 'inactive') == 'inactive':
+                    server.status[item_id] = 'activating'
+            return self.send_json({}, code=202)
+        elif parts[0] == 'download':
+            self.send_asset(method, server.assets[item_id], item_id)
+
+    def send_asset(self, method, data, item_id):
+        start, end = 0, len(data) - 1
+        byte_range = self.headers.get('Range')
+        if byte_range:
+            first, last = byte_range.split('=')[1].split('-')
+            start, end = int(first), int(last) if last else len(data) - 1
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */{}'.format(len(data)))
+                self.send_header('Content-Length', '0')
+                return self.end_headers()
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, len(data)))
+        else:
+            self.send_response(200)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+
+        if method == 'HEAD':
+            return
+
+        body = data[start:end + 1]
+        with self.server.lock:
+            cutoffs = self.server.disconnects.get(item_id)
+            cutoff = cutoffs.pop(0) if cutoffs else None
+
+        if cutoff is not None:
+            self.wfile.write(body[:cutoff])
+            self.wfile.flush()
+            self.close_connection = True
+        else:
+            self.wfile.write(body)
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_HEAD(self):
+        self.handle_request('HEAD')
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        self.rfile.read(length)
+        self.handle_request('POST')
+
+
+@pytest.fixture
+def fake_planet():
+    server = FakePlanetServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def client(fake_planet):
+    client = planet_lib.AsyncPlanetClient(session=requests.Session(),
+                                          max_concurrency=4,
+                                          api_root=fake_planet.root,
+                                          wait_multiplier=0.01)
+    yield client
+    client.close()
+
+
+def test_pooled_session_reuses_connections(fake_planet):
+    fake_planet.delay = 0
+    session = planet_lib.PooledSession()
+
+    for _ in range(20):
+        session.get(fake_planet.root + '/item-types/REOrthoTile/items/a/assets/')
+
+    assert session.stats.requests == 20
+    assert session.stats.connections == 1
+    assert session.stats.reuse_rate() == 0.95
+
+
+def test_pooled_session_caps_connections_across_threads(fake_planet):
+    session = planet_lib.PooledSession(max_connections=3, per_host=2)
+    url = fake_planet.root + '/item-types/REOrthoTile/items/{}/assets/'
+
+    with ThreadPoolExecutor(max_workers=12) as pool:
+        list(pool.map(lambda i: session.get(url.format(i)), range(36)))
+
+    assert fake_planet.max_in_flight == 2
+    assert session.stats.connections <= 2
+
+
+def test_pooled_session_frees_slots_after_failed_requests(fake_planet):
+    fake_planet.delay = 0
+    fake_planet.assets['a'] = b'a' * 1000
+    fake_planet.disconnects['a'] = [100, 100, 100]
+    session = planet_lib.PooledSession(max_connections=2, per_host=2)
+    session.max_redirects = 3
+    results = []
+
+    def failing_then_working_requests():
+        # truncated bodies
+        for _ in range(3):
+            with pytest.raises(requests.exceptions.RequestException):
+                session.get(fake_planet.root + '/download/a')
+
+        # too many redirects of a streamed response
+        for _ in range(3):
+            with pytest.raises(requests.exceptions.TooManyRedirects):
+                session.get(fake_planet.root + '/redirect/a', stream=True)
+
+        results.append(session.get(fake_planet.root + '/download/a').content)
+
+    # a leaked slot would block forever, so run them where we can time out
+    thread = threading.Thread(target=failing_then_working_requests, daemon=True)
+    thread.start()
+    thread.join(timeout=10)
+
+    assert results == [b'a' * 1000]
+
+
+def test_streamed_download_releases_its_connection(fake_planet, tmpdir):
+    fake_planet.delay = 0
+    fake_planet.assets.update({'a': b'a' * 1000, 'b': b'b' * 1000})
+    session = planet_lib.PooledSession(max_connections=1, per_host=1)
+
+    for item_id in ('a', 'b'):
+        assert planet_lib.download(fake_planet.root + '/download/' + item_id, str(tmpdir),
+                                   item_id, 'analytic', False, http=session)
+
+    assert session.stats.connections == 1
+
+
+def test_forked_worker_gets_its_own_session(monkeypatch):
+    parent = planet_lib.PooledSession(max_connections=8, per_host=4)
+    parent.auth = ('key', '')
+    parent.pid = -1
+    monkeypatch.setattr(planet_lib, 'SESSION', parent)
+
+    session = planet_lib.get_session()
+
+    assert session is not parent
+    assert session.pid == os.getpid()
+    assert session.auth == ('key', '')
+    assert (session.max_connections, session.per_host) == (8, 4)
+    assert planet_lib.get_session() is session
+
+
+def test_async_client_bounds_concurrency_and_retries(fake_planet, client):
+    ids = ['item{}'.format(i) for i in range(20)]
+    fake_planet.status.update({'item0': 'active', 'item1': 'active'})
+    fake_planet.failures.update({'item2': 2, 'item3': 1})
+
+    activated = client.run(client.gather(client.activate, ids, 'REOrthoTile', 'analytic'))
+    assert activated == [False, False] + [True] * 18
+
+    # the 429s were retried, and never more than 4 requests were in flight
+    assert fake_planet.max_in_flight <= 4
+    assert fake_planet.requests.count(('POST', '/activate/item2')) == 1
+    assert len([r for r in fake_planet.requests if r[1].endswith('/item2/assets/')]) == 3
+
+    checked = client.run(client.gather(client.check_activation, ids[:3], 'REOrthoTile', 'analytic'))
+    assert checked == [True, True, False]
+
+
+def test_async_client_gives_up_after_max_attempts(fake_planet, client):
+    fake_planet.failures['item0'] = 10
+
+    with pytest.raises(planet_lib.RateLimitException):
+        client.run(client.check_activation('item0', 'REOrthoTile', 'analytic'))
+
+
+def test_async_client_search_and_download(fake_planet, client, tmpdir):
+    scenes = client.run(client.search({'item_types': ['REOrthoTile'], 'filter': {}}))
+    assert [s['id'] for s in scenes] == ['scene0', 'scene1', 'scene2']
+
+    fake_planet.status.update({'a': 'active', 'b': 'active'})
+    fake_planet.assets.update({'a': b'a' * 1000, 'b': b'b' * 2000})
+
+    results = client.run(client.gather(client.download, ['a', 'b', 'c'],
+                                       'REOrthoTile', 'analytic', str(tmpdir), False))
+    assert results == [True, True, False]
+
+    with open(str(tmpdir.join('b_analytic.tif')), 'rb') as f:
+        assert f.read() == b'b' * 2000
+
+
+def test_async_download_locks_each_item(fake_planet, client, tmpdir):
+    fake_planet.status.update({'a': 'active', 'b': 'active'})
+    fake_planet.assets.update({'a': b'a' * 1000, 'b': b'b' * 1000})
+    store = asset_store.AssetStore(str(tmpdir))
+
+    results = client.run(client.gather(client.download, ['a', 'a', 'b'], 'REOrthoTile', 'analytic',
+                                       str(tmpdir), False,
+                                       lambda item_id: store.lock(store.path(item_id, 'analytic'))))
+
+    # the second download of 'a' waits for the first and finds it done
+    assert sorted(results, key=str) == [None, True, True]
+    assert fake_planet.requests.count(('GET', '/download/a')) == 1
+    assert tmpdir.join('a_analytic.tif').read_binary() == b'a' * 1000
+
+
+def test_activation_scheduler_backs_off_per_scene(fake_planet, client):
+    fake_planet.delay = 0
+    fake_planet.status.update({'ready': 'active', 'broken': 'failed'})
+    fake_planet.activate_after.update({'quick': 1, 'slow': 8})
+
+    scheduler = planet_lib.ActivationScheduler('REOrthoTile', 'analytic', client=client,
+                                               poll_interval=0.01, poll_interval_max=0.05, backoff=2)
+    assert scheduler.wait(['ready', 'quick', 'slow', 'broken']) == [True, True, True, False]
+
+    summary = scheduler.summary()
+    assert (summary['active'], summary['pending'], summary['failed']) == (3, 0, 1)
+    assert summary['p50_time_to_active'] <= summary['p100_time_to_active']
+
+    def checks(item_id):
+        return fake_planet.requests.count(('GET', '/item-types/REOrthoTile/items/{}/assets/'.format(item_id)))
+
+    # one check for activation, then one per poll until active
+    assert checks('ready') == 2
+    assert checks('quick') == 1 + 2
+    assert checks('slow') == 1 + 9
+
+    # scenes that never activate time out
+    scheduler = planet_lib.ActivationScheduler('REOrthoTile', 'analytic', client=client,
+                                               poll_interval=0.01, timeout=0.05)
+    assert scheduler.wait(['never']) == [False]
+    assert scheduler.summary()['failed'] == 1
+
+
+def test_activation_scheduler_requests_without_waiting(fake_planet, client):
+    fake_planet.delay = 0
+    fake_planet.status['ready'] = 'active'
+
+    scheduler = planet_lib.ActivationScheduler('REOrthoTile', 'analytic', client=client)
+    scheduler.request(['a', 'b', 'ready'])
+
+    assert set(scheduler.requested) == {'a', 'b', 'ready'}
+    assert fake_planet.status == {'a': 'activating', 'b': 'activating', 'ready': 'active'}
+    assert sorted(path for method, path in fake_planet.requests if method == 'POST') == ['/activate/a', '/activate/b']
+
+
+def test_download_resumes_after_disconnects(fake_planet, tmpdir):
+    fake_planet.delay = 0
+    data = os.urandom(100000)
+    fake_planet.assets['a'] = data
+    fake_planet.disconnects['a'] = [30000, 10000, 0]
+    url = fake_planet.root + '/download/a'
+
+    assert planet_lib.download(url, str(tmpdir), 'a', 'analytic', False,
+                               md5_digest=hashlib.md5(data).hexdigest())
+
+    with open(str(tmpdir.join('a_analytic.tif')), 'rb') as f:
+        assert f.read() == data
+    assert not tmpdir.join('a_analytic.tif.part').exists()
+
+    ranges = [path for method, path in fake_planet.requests if method == 'GET']
+    assert len(ranges) == 4
+
+
+def test_download_resumes_from_part_file(fake_planet, tmpdir):
+    fake_planet.delay = 0
+    data = os.urandom(50000)
+    fake_planet.assets['a'] = data
+    tmpdir.join('a_analytic.tif.part').write_binary(data[:20000])
+
+    assert planet_lib.download(fake_planet.root + '/download/a', str(tmpdir), 'a', 'analytic', False)
+
+    with open(str(tmpdir.join('a_analytic.tif')), 'rb') as f:
+        assert f.read() == data
+
+
+def test_download_rejects_md5_mismatch(fake_planet, client, tmpdir):
+    fake_planet.delay = 0
+    fake_planet.status['a'] = 'active'
+    fake_planet.assets['a'] = b'a' * 1000
+    fake_planet.md5['a'] = hashlib.md5(b'b' * 1000).hexdigest()
+
+    result = client.run(client.download('a', 'REOrthoTile', 'analytic', str(tmpdir), False))
+
+    assert result is False
+    assert not tmpdir.join('a_analytic.tif').exists()
+    assert not tmpdir.join('a_analytic.tif.part').exists()
+
+
+def test_download_in_segments(fake_planet, tmpdir):
+    fake_planet.delay = 0
+    data = os.urandom(100001)
+    fake_planet.assets['a'] = data
+    fake_planet.disconnects['a'] = [5000]
+
+    assert planet_lib.download(fake_planet.root + '/download/a', str(tmpdir), 'a', 'analytic', False,
+                               segments=4, segment_min_bytes=0)
+
+    with open(str(tmpdir.join('a_analytic.tif')), 'rb') as f:
+        assert f.read() == data
+    assert tmpdir.listdir() == [tmpdir.join('a_analytic.tif')]
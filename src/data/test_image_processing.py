@@ -0,0 +1,307 @@
+import os
+
+from affine import Affine
+import numpy as np
+import pytest
+import rasterio
+from rio_hist.match import histogram_match
+
+import image_processing
+from memory_budget import MemoryBudgetWarning
+
+
+def write_tif(path, arr, **kwargs):
+    profile = dict(driver='GTiff',
+                   width=arr.shape[2],
+                   height=arr.shape[1],
+                   count=arr.shape[0],
+                   dtype=arr.dtype,
+                   crs='EPSG:32637',
+                   transform=Affine(5, 0, 500000, 0, -5, 9900000))
+    profile.update(kwargs)
+
+    with rasterio.open(path, 'w', **profile) as dst:
+        dst.write(arr)
+
+
+@pytest.fixture
+def raw_scene(tmpdir):
+    rng = np.random.RandomState(0)
+    arr = rng.randint(0, 2 ** 12, size=(5, 60, 40)).astype(np.uint16)
+
+    path = str(tmpdir.join('scene_analytic.tif'))
+    write_tif(path, arr)
+    return path, arr
+
+
+def test_adjust_image_by_reflectance_in_blocks(raw_scene):
+    path, arr = raw_scene
+    coeffs = {i: 0.01 * i for i in range(1, 6)}
+
+    ok, out_path = image_processing.adjust_image_by_reflectance(path,
+                                                               coeffs,
+                                                               list(coeffs),
+                                                               keep_raw=True,
+                                                               creation_options=dict(tiled=True,
+                                                                                     blockxsize=16,
+                                                                                     blockysize=16,
+                                                                                     compress='deflate'))
+
+    assert ok and out_path == path
+    assert not os.path.exists(path + '.tmp')
+
+    with rasterio.open(path + '_raw') as src:
+        np.testing.assert_array_equal(src.read(), arr)
+
+    with rasterio.open(path) as src:
+        assert src.block_shapes[0] == (16, 16)
+        assert src.compression.value == 'DEFLATE'
+        adjusted = src.read()
+
+    expected = np.stack([arr[i - 1].astype(np.float32) * coeffs[i] for i in range(1, 6)])
+    np.testing.assert_allclose(adjusted, expected)
+
+
+def test_adjust_image_by_reflectance_fused_with_resize(raw_scene, tmpdir):
+    path, arr = raw_scene
+    coeffs = {i: 0.5 for i in range(1, 6)}
+
+    resized_path = str(tmpdir.join('resized.tif'))
+    image_processing.resize_tiff(path, resized_path, 20, 0, projection=None)
+
+    fused_path = str(tmpdir.join('fused.tif'))
+    ok, out_path = image_processing.adjust_image_by_reflectance(path,
+                                                               coeffs,
+                                                               list(coeffs),
+                                                               dst_path=fused_path,
+                                                               size=(20, 0))
+    assert ok and out_path == fused_path
+
+    # the raw image is left alone
+    with rasterio.open(path) as src:
+        np.testing.assert_array_equal(src.read(), arr)
+
+    with rasterio.open(fused_path) as fused, rasterio.open(resized_path) as resized:
+        assert fused.shape == resized.shape == (30, 20)
+        assert fused.transform.almost_equals(resized.transform)
+        np.testing.assert_allclose(fused.read(), resized.read().astype(np.float32) * 0.5)
+
+
+def test_batch_hist_match_streams_reference_histogram(tmpdir):
+    rng = np.random.RandomState(1)
+    arrs = [rng.gamma(2 + i, 0.05, size=(3, 200, 150)).astype(np.float32) for i in range(3)]
+
+    paths = []
+    for i, arr in enumerate(arrs):
+        paths.append(str(tmpdir.join('scene_{}.tif'.format(i))))
+        write_tif(paths[-1], arr)
+
+    # one row windows over the references
+    with pytest.warns(MemoryBudgetWarning):
+        out_paths = image_processing.batch_hist_match_worker(paths, 1.0, {}, '1,2,3', 'bgren', False,
+                                                             masked=False,
+                                                             memory_budget=1,
+                                                             n_jobs=2)
+
+    reference = np.stack(arrs)
+    for arr, out_path in zip(arrs, out_paths):
+        with rasterio.open(out_path) as src:
+            matched = src.read()
+
+        for b in range(3):
+            expected = histogram_match(arr[b], reference[:, b])
+            value_range = reference[:, b].max() - reference[:, b].min()
+            error = np.abs(matched[b] - expected)
+
+            # within a couple of bins, except in the sparse tails
+            assert np.mean(error <= 2 * value_range / image_processing.REFERENCE_BINS) > 0.99
+            assert error.max() <= 0.05 * value_range
+
+
+def test_resize_tiffs_keeps_aspect_ratio(raw_scene, tmpdir):
+    path, arr = raw_scene
+    out_paths = [str(tmpdir.join('resized_{}.tif'.format(i))) for i in range(3)]
+
+    results = image_processing.resize_tiffs([(path, out, 20, 0) for out in out_paths],
+                                            n_threads=2,
+                                            projection=None)
+    assert results == out_paths
+
+    for out in out_paths:
+        with rasterio.open(out) as dst:
+            assert (dst.count, dst.height, dst.width) == (5, 30, 20)
+            assert dst.crs.to_string() == 'EPSG:32637'
+            assert dst.dtypes[0] == 'uint16'
+
+            # nearest neighbour keeps the original values
+            resized = dst.read()
+            assert np.isin(resized[0], arr[0]).all()
+
+
+def test_resize_for_models_matches_single_resizes(raw_scene, tmpdir):
+    path, arr = raw_scene
+
+    out_paths = image_processing.resize_for_models(path, [30, 16])
+    assert out_paths == [image_processing.sized_output_path(path, s, s) for s in (30, 16)]
+
+    for out_path, size in zip(out_paths, (30, 16)):
+        single_path = str(tmpdir.join('single_{}.tif'.format(size)))
+        image_processing.resize_tiff(path, single_path, size, size)
+
+        with rasterio.open(out_path) as multi, rasterio.open(single_path) as single:
+            assert multi.shape == (size, size)
+            assert multi.crs == single.crs
+            np.testing.assert_array_equal(multi.read(), single.read())
+
+    # reprojecting still gives every requested size
+    for out_path in image_processing.warp_to_sizes(path,
+                                                   [(str(tmpdir.join('a.tif')), 12, 12),
+                                                    (str(tmpdir.join('b.tif')), 8, 8)],
+                                                   projection='EPSG:4326'):
+        with rasterio.open(out_path) as dst:
+            assert dst.crs.to_string() == 'EPSG:4326'
+            assert dst.count == 5
+
+
+def test_resize_all_in_dir_skips_up_to_date_outputs(raw_scene, tmpdir):
+    path, arr = raw_scene
+    for name in ('a', 'b'):
+        write_tif(str(tmpdir.mkdir(name).join(name + '_analytic.tif')), arr)
+    os.remove(path)
+
+    written = image_processing.resize_all_in_dir(str(tmpdir), sizes=[16], n_jobs=2)
+    assert len(written) == 2
+
+    # resized outputs are not picked up as inputs, and nothing is stale
+    assert image_processing.resize_all_in_dir(str(tmpdir), sizes=[16]) == []
+
+    # a newer input is redone
+    a_path = str(tmpdir.join('a', 'a_analytic.tif'))
+    out_mtime = os.path.getmtime(image_processing.sized_output_path(a_path, 16, 16))
+    os.utime(a_path, (out_mtime + 10, out_mtime + 10))
+    assert image_processing.resize_all_in_dir(str(tmpdir), sizes=[16]) == \
+        [image_processing.sized_output_path(a_path, 16, 16)]
+
+    # so is an output made with other parameters
+    b_path = str(tmpdir.join('b', 'b_analytic.tif'))
+    assert image_processing.resize_all_in_dir(str(tmpdir), sizes=[16], projection='EPSG:4326') == \
+        [image_processing.sized_output_path(p, 16, 16) for p in (a_path, b_path)]
+
+
+def test_resize_all_in_dir_only_resizes_merged_images(raw_scene, tmpdir):
+    path, arr = raw_scene
+    aoi_dir = tmpdir.mkdir('county').mkdir('aoi')
+    merged_path = str(aoi_dir.join('aoi_analytic.tif'))
+    write_tif(merged_path, arr)
+
+    # scene copies next to and below the merged image
+    write_tif(str(aoi_dir.mkdir('hist_matched').join('aoi_analytic.tif')), arr)
+    write_tif(str(tmpdir.join('county').mkdir('assets').join('20160801_analytic.tif')), arr)
+    os.remove(path)
+
+    assert image_processing.resize_all_in_dir(str(tmpdir), sizes=[16]) == \
+        [image_processing.sized_output_path(merged_path, 16, 16)]
+
+    assert len(image_processing.resize_all_in_dir(str(tmpdir), sizes=[16], merged_only=False)) == 2
+
+
+def test_make_cog(tmpdir):
+    arr = np.random.RandomState(2).uniform(0, 1, size=(2, 520, 600)).astype(np.float32)
+    path = str(tmpdir.join('merged.tif'))
+    write_tif(path, arr)
+
+    assert image_processing.overview_factors(600, 520, 128) == [2, 4, 8]
+    assert image_processing.overview_factors(100, 80, 128) == []
+
+    assert image_processing.make_cog(path, compress='lzw', blocksize=128) == path
+    assert os.listdir(str(tmpdir)) == ['merged.tif']
+
+    with rasterio.open(path) as src:
+        assert src.block_shapes[0] == (128, 128)
+        assert src.compression.value == 'LZW'
+        assert src.overviews(1) == [2, 4, 8]
+        np.testing.assert_array_equal(src.read(), arr)
+
+        # decimated reads come from the overviews
+        assert src.read(1, out_shape=(65, 75)).shape == (65, 75)
+
+
+def square(x0, y0, size):
+    return {'type': 'Polygon',
+            'coordinates': [[(x0, y0), (x0 + size, y0), (x0 + size, y0 + size),
+                             (x0, y0 + size), (x0, y0)]]}
+
+
+def test_mosaic_aoi_reads_priority_scenes_in_aoi(tmpdir):
+    # 40x40 scenes of 5m pixels; scene c is far from the AOI
+    origins = {'a': (500000, 9900000), 'b': (500100, 9900000), 'c': (510000, 9900000)}
+    paths = []
+    for value, name in enumerate(['a', 'b', 'c'], start=1):
+        paths.append(str(tmpdir.join('{}.tif'.format(name))))
+        x0, y0 = origins[name]
+        write_tif(paths[-1], np.full((2, 40, 40), value, dtype=np.uint16),
+                  transform=Affine(5, 0, x0, 0, -5, y0))
+
+    # AOI straddles a and b, from 50m to 150m east and 100m tall
+    aoi = square(500050, 9900000 - 100, 100)
+    out_path = str(tmpdir.join('aoi.tif'))
+
+    used = image_processing.mosaic_aoi(paths, [aoi], out_path)
+    assert used == [paths[1], paths[0]]
+
+    with rasterio.open(out_path) as src:
+        assert src.shape == (20, 20)
+        assert src.transform.almost_equals(Affine(5, 0, 500050, 0, -5, 9900000))
+        mosaic = src.read(1)
+
+    # b has priority where the scenes overlap
+    assert (mosaic[:, :10] == 1).all()
+    assert (mosaic[:, 10:] == 2).all()
+
+    # a scene covering the whole AOI is the only one read
+    assert image_processing.mosaic_aoi(paths[:2], [square(500110, 9900000 - 50, 40)], out_path) == \
+        [paths[1]]
+
+
+def test_lazy_scenes_match_materialized_copies(tmpdir):
+    rng = np.random.RandomState(3)
+    coeffs = {1: 2e-5, 2: 3e-5, 3: 4e-5}
+
+    paths = []
+    for i, x0 in enumerate([500000, 500100]):
+        paths.append(str(tmpdir.join('scene_{}.tif'.format(i))))
+        write_tif(paths[-1], rng.randint(0, 2 ** 12, size=(3, 80, 80)).astype(np.uint16) * (i + 1),
+                  transform=Affine(2.5, 0, x0, 0, -2.5, 9900000))
+
+    aoi = square(500050, 9900000 - 150, 200)
+
+    # resized and reflectance adjusted copies, then the mosaic
+    copies = []
+    for path in paths:
+        copies.append(path.replace('.tif', '_refl.tif'))
+        image_processing.adjust_image_by_reflectance(path, coeffs, list(coeffs),
+                                                     dst_path=copies[-1], size=(40, 0))
+    materialized_path = str(tmpdir.join('materialized.tif'))
+    image_processing.mosaic_aoi(copies, [aoi], materialized_path)
+
+    scenes = [image_processing.LazyScene(path, size=(40, 0), coeffs=coeffs) for path in paths]
+    lazy_path = str(tmpdir.join('lazy.tif'))
+    image_processing.mosaic_aoi(scenes, [aoi], lazy_path)
+
+    with rasterio.open(materialized_path) as materialized, rasterio.open(lazy_path) as lazy:
+        assert lazy.profile['dtype'] == 'float32'
+        assert lazy.transform.almost_equals(materialized.transform)
+        np.testing.assert_array_equal(lazy.read(), materialized.read())
+
+    # histogram matching as lookup tables on the lazy scenes
+    matched_copies = image_processing.batch_hist_match_worker(copies, 1.0, {}, '1,2,3', 'bgren', False,
+                                                              masked=False)
+    image_processing.mosaic_aoi(matched_copies, [aoi], materialized_path)
+
+    matched_scenes = image_processing.lazy_batch_hist_match(scenes, '1,2,3', masked=False)
+    image_processing.mosaic_aoi(matched_scenes, [aoi], lazy_path)
+
+    with rasterio.open(materialized_path) as materialized, rasterio.open(lazy_path) as lazy:
+        expected = materialized.read()
+        value_range = expected.max() - expected.min()
+        np.testing.assert_allclose(lazy.read(), expected, atol=0.01 * value_range)
@@ -0,0 +1,71 @@
+import pickle
+import random
+
+from shapely.geometry import shape
+
+import scene_index
+
+
+def square(x, y, size):
+    return {'type': 'Polygon',
+            'coordinates': [[[x, y], [x + size, y], [x + size, y + size], [x, y + size], [x, y]]]}
+
+
+def scene(scene_id, geometry, cloud_cover=0.01, updated='2016-08-01'):
+    return {'id': scene_id,
+            'geometry': geometry,
+            'properties': {'cloud_cover': cloud_cover, 'updated': updated}}
+
+
+def regional_scenes():
+    rng = random.Random(0)
+    scenes = [scene('s{}'.format(i), square(36 + rng.uniform(0, 1), rng.uniform(0, 1), 0.2),
+                    cloud_cover=rng.choice([0.0, 0.01, 0.02]),
+                    updated='2016-08-{:02d}'.format(rng.randint(1, 28)))
+              for i in range(60)]
+
+    # a diamond whose bounding box covers more than its footprint
+    scenes.append(scene('diamond', {'type': 'Polygon',
+                                    'coordinates': [[[37.5, 0.0], [38.0, 0.5], [37.5, 1.0],
+                                                     [37.0, 0.5], [37.5, 0.0]]]}))
+    return scenes
+
+
+def test_scene_ids_match_a_search_of_each_aoi():
+    scenes = regional_scenes()
+    index = scene_index.SceneIndex(scenes)
+
+    rng = random.Random(1)
+    for _ in range(200):
+        aoi = {'type': 'Feature', 'id': 'aoi', 'geometry': square(36 + rng.uniform(0, 2), rng.uniform(0, 1.2), 0.01)}
+
+        searched = [s for s in scenes if shape(aoi['geometry']).intersects(shape(s['geometry']))]
+        assert index.scene_ids(aoi) == scene_index.sort_scenes(searched)
+
+
+def test_exact_footprints_are_used():
+    index = scene_index.SceneIndex(regional_scenes())
+
+    # inside the diamond's bounding box, outside the diamond
+    assert 'diamond' not in index.scene_ids(square(37.9, 0.9, 0.05))
+    assert 'diamond' in index.scene_ids(square(37.45, 0.45, 0.05))
+
+    # touching an edge counts, as it does for a Planet geometry filter
+    assert 'diamond' in index.scene_ids(square(38.0, 0.45, 0.1))
+
+
+def test_multipolygon_aois():
+    index = scene_index.SceneIndex(regional_scenes())
+    aoi = {'type': 'MultiPolygon',
+           'coordinates': [square(37.9, 0.9, 0.05)['coordinates'],
+                           square(37.45, 0.45, 0.05)['coordinates']]}
+
+    assert 'diamond' in index.scene_ids(aoi)
+
+
+def test_index_survives_pickling():
+    index = scene_index.SceneIndex(regional_scenes())
+    aoi = square(36.5, 0.5, 0.1)
+
+    assert pickle.loads(pickle.dumps(index)).scene_ids(aoi) == index.scene_ids(aoi)
+
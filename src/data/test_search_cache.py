@@ -0,0 +1,76 @@
+import os
+import time
+
+import pytest
+
+import search_cache
+
+
+def search_request(cloud_cover=0.05):
+    return {'item_types': ['REOrthoTile'],
+            'filter': {'type': 'AndFilter',
+                       'config': [{'type': 'GeometryFilter',
+                                   'field_name': 'geometry',
+                                   'config': {'type': 'Polygon',
+                                              'coordinates': [[[36.0, 0.1], [36.0, 0.0], [36.1, 0.0],
+                                                               [36.1, 0.1], [36.0, 0.1]]]}},
+                                  {'type': 'RangeFilter',
+                                   'field_name': 'cloud_cover',
+                                   'config': {'lte': cloud_cover}}]}}
+
+
+class FakeSearch(object):
+
+    def __init__(self):
+        self.requests = []
+
+    def __call__(self, request):
+        self.requests.append(request)
+        return [{'id': 'scene{}'.format(len(self.requests)),
+                 'properties': {'updated': '2016-08-01', 'cloud_cover': 0.01}}]
+
+
+def test_reruns_make_no_search_calls(tmpdir):
+    run_search = FakeSearch()
+
+    first = search_cache.SearchCache(str(tmpdir)).search(search_request(), run_search)
+    rerun = search_cache.SearchCache(str(tmpdir)).search(search_request(), run_search)
+
+    assert rerun == first
+    assert len(run_search.requests) == 1
+
+    search_cache.SearchCache(str(tmpdir)).search(search_request(cloud_cover=0.1), run_search)
+    assert len(run_search.requests) == 2
+
+
+def test_digest_does_not_depend_on_key_order():
+    request = search_request()
+    reordered = {'filter': request['filter'], 'item_types': request['item_types']}
+
+    assert search_cache.search_digest(request) == search_cache.search_digest(reordered)
+    assert search_cache.search_digest(request) != search_cache.search_digest(search_request(0.1))
+
+
+def test_expired_results_are_searched_again(tmpdir):
+    run_search = FakeSearch()
+    cache = search_cache.SearchCache(str(tmpdir), ttl=60)
+
+    cache.search(search_request(), run_search)
+    old = time.time() - 120
+    os.utime(cache.path(search_request()), (old, old))
+
+    assert cache.search(search_request(), run_search)[0]['id'] == 'scene2'
+    assert len(run_search.requests) == 2
+
+
+def test_offline_mode_never_searches(tmpdir):
+    run_search = FakeSearch()
+    search_cache.SearchCache(str(tmpdir)).search(search_request(), run_search)
+
+    offline = search_cache.SearchCache(str(tmpdir), offline=True)
+    assert offline.search(search_request(), run_search)[0]['id'] == 'scene1'
+
+    with pytest.raises(search_cache.SearchCacheMiss):
+        offline.search(search_request(cloud_cover=0.1), run_search)
+
+    assert len(run_search.requests) == 1
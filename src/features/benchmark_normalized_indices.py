@@ -0,0 +1,77 @@
+import time
+import tracemalloc
+import warnings
+
+import click
+import numpy as np
+
+from normalized_indices import summary_stats, summary_stats_series, INDEX_NAMES
+
+
+def legacy_summary_stats_series(a_b_tuples):
+    """ The original implementation: one full size measure per index,
+        followed by several passes in `summary_stats`.
+    """
+    measure_arr = np.zeros_like(a_b_tuples[0][0])
+
+    results = []
+    for a, b in a_b_tuples:
+        np.true_divide((a - b), (a + b), measure_arr)
+        results.append(summary_stats(measure_arr))
+
+    return results
+
+
+def fused_summary_stats_series(a_b_tuples):
+    return summary_stats_series('benchmark', a_b_tuples, INDEX_NAMES)
+
+
+def time_and_peak_memory(func, *args):
+    """ Returns the wall time and the peak memory numpy allocated
+        while running func(*args).
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+
+    func(*args)
+
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return elapsed, peak
+
+
+@click.command()
+@click.option('--size', default=10000, type=int, help="Width and height of the synthetic bands.")
+@click.option('--repeat', default=3, type=int, help="Number of timed runs of each implementation.")
+def benchmark(size, repeat):
+    """ Compares the legacy and fused normalized index kernels on
+        synthetic size x size float32 bands.
+    """
+    rng = np.random.RandomState(0)
+    b, g, r, re, nir = [rng.uniform(0, 1, size=(size, size)).astype(np.float32)
+                        for _ in range(5)]
+
+    # nodata border like the one gdalwarp leaves outside the cutline
+    for band in (b, g, r, re, nir):
+        band[:size // 10] = 0
+
+    a_b_tuples = [(nir, re), (r, b), (g, re)]
+
+    print("Bands: 5 x {0}x{0} float32 ({1:.0f} MB)".format(size, 5 * nir.nbytes / 1e6))
+
+    for name, func in [('legacy', legacy_summary_stats_series),
+                       ('fused', fused_summary_stats_series)]:
+        timings = []
+        for _ in range(repeat):
+            with warnings.catch_warnings():
+                warnings.filterwarnings('ignore')
+                timings.append(time_and_peak_memory(func, a_b_tuples))
+
+        elapsed, peak = min(timings)
+        print("{:>8}: {:8.3f} s  peak extra memory {:8.1f} MB".format(name, elapsed, peak / 1e6))
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -1,18 +1,30 @@
+import ast
+import collections
 import gc
 from glob import glob
+import json
 import os
+import sys
 import warnings
 
 import click
+from joblib import Parallel, delayed, effective_n_jobs
 import pandas as pd
 import numpy as np
 from tqdm import tqdm
 import rasterio as rio
+from rasterio import features, windows
+from rasterio.warp import transform_geom
+from rasterio.windows import Window
 
 import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 
+# the memory budget helpers are shared with the raster stages in src/data
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'data'))
+from memory_budget import available_memory, peak_rss, report_peak_rss
+
 
 RAW_DATA_ROOT = os.path.abspath(os.path.join(__file__,
                                              os.pardir,
@@ -24,6 +36,49 @@ RAW_DATA_ROOT = os.path.abspath(os.path.join(__file__,
 PLANET_DATA_ROOT = os.path.join(RAW_DATA_ROOT,
                                 'planet')
 
+WARDS_PATH = os.path.join(RAW_DATA_ROOT, 'Ward Shapefiles', 'ward.results.geojson')
+
+# band order of the 5-band RapidEye analytic assets
+BANDS = ['b', 'g', 'r', 're', 'nir']
+
+# spectral indices, as arithmetic expressions of the names in BANDS;
+# add new ones with `register_index`
+INDEX_REGISTRY = collections.OrderedDict()
+
+# the indices that end up in all_ward_data.csv by default
+INDEX_NAMES = ['re_ndvi', 'npcri', 're_ndwi']
+
+STATS_LABELS = ['mean', 'std', 'pct_likely']
+
+# very_likely % (> 0.25, on the range of the measure -1..1)
+LIKELY_THRESHOLD = 0.25
+
+# folder in the wards root where per ward results are cached
+CACHE_DIRNAME = 'ward_stats_cache'
+
+# fixed-bin histogram sketch kept for every ward and index; bins are
+# 0.01 wide over the range of the index, -1..1 for the normalized
+# differences (see `register_index`)
+HIST_RANGE = (-1.0, 1.0)
+HIST_BIN_WIDTH = 0.01
+
+# sketch range of every registered index
+INDEX_HIST_RANGES = dict()
+
+# colormaps and titles of the index maps; other indices use the
+# index name and RdYlGn
+INDEX_COLORMAPS = {'re_ndvi': 'PRGn', 'npcri': 'PiYG', 're_ndwi': 'BrBG'}
+INDEX_TITLES = {'re_ndvi': 'Vegetation', 'npcri': 'Chlorophyll', 're_ndwi': 'Water'}
+
+# longest side, in pixels, of the images the index maps are drawn from
+RENDER_MAX_SIZE = 512
+
+# size of the row strips the index kernel works through at a time
+CHUNK_PIXELS = 2 ** 20
+
+# rough size of the temporaries RunningStats.update makes per pixel
+ACCUMULATOR_BYTES_PER_PIXEL = 32
+
 
 def plot_normalized_indices(title, values, names, colormaps, output_folder=None, base_size=5):
     font = {'color': 'white'}
@@ -56,6 +111,19 @@ def plot_normalized_indices(title, values, names, colormaps, output_folder=None,
     plt.close()
 
 
+def hist_edges(value_range=HIST_RANGE):
+    """ The HIST_BIN_WIDTH wide bin edges of a sketch over `value_range`.
+    """
+    n_bins = int(round((value_range[1] - value_range[0]) / HIST_BIN_WIDTH))
+    return np.linspace(value_range[0], value_range[1], n_bins + 1)
+
+
+def index_hist_range(name):
+    """ The range of the histogram sketch of the index `name`.
+    """
+    return INDEX_HIST_RANGES.get(name, HIST_RANGE)
+
+
 def summary_stats(measure):
     mean = np.nanmean(measure)
     std = np.nanstd(measure)
@@ -63,100 +131,902 @@ def summary_stats(measure):
     not_nan_mask = ~np.isnan(measure)
     measure_no_nan = measure[not_nan_mask]
 
-    # very_likely % (> 0.25, on the range of the measure -1..1)
-    very_likely = (measure_no_nan > 0.25).sum() / not_nan_mask.sum()
+    very_likely = (measure_no_nan > LIKELY_THRESHOLD).sum() / not_nan_mask.sum()
 
     return mean, std, very_likely
 
 
+class RunningStats(object):
+    """ Accumulates the same statistics as `summary_stats` over a stream
+        of arrays, so a measure never has to be held in memory at once.
+
+        Stats are kept separately for `n_labels` zones; `update` takes an
+        optional array of integer labels with the zone of every value.
+        Means and variances are combined with the parallel algorithm of
+        Chan et al., so partial results can also be `merge`d.
+
+        A fixed-bin histogram over `hist_range` is kept alongside, so
+        other thresholds and quantiles can be answered later without
+        rereading the image (see `sketch_quantile` and
+        `sketch_fraction_above`). Values outside of `hist_range` are
+        counted in the edge bins.
+    """
+
+    def __init__(self, threshold=LIKELY_THRESHOLD, n_labels=1, hist_range=HIST_RANGE):
+        self.threshold = threshold
+        self.n_labels = n_labels
+        self.hist_range = tuple(hist_range)
+        self.hist_bins = len(hist_edges(hist_range)) - 1
+        self.count = np.zeros(n_labels, dtype=np.int64)
+        self.mean = np.zeros(n_labels, dtype=np.float64)
+        self.m2 = np.zeros(n_labels, dtype=np.float64)
+        self.n_likely = np.zeros(n_labels, dtype=np.int64)
+        self.hist = np.zeros((n_labels, self.hist_bins), dtype=np.int64)
+
+    def update(self, values, labels=None):
+        not_nan_mask = ~np.isnan(values)
+        count = np.count_nonzero(not_nan_mask)
+
+        if count == 0:
+            return self
+        elif count < values.size:
+            values = values[not_nan_mask]
+
+            if labels is not None:
+                labels = labels[not_nan_mask]
+
+        block = RunningStats(self.threshold, self.n_labels, self.hist_range)
+
+        bins = values - np.float32(self.hist_range[0])
+        bins *= np.float32(self.hist_bins / (self.hist_range[1] - self.hist_range[0]))
+        bins = np.clip(bins, 0, self.hist_bins - 1, out=bins).astype(np.intp)
+
+        if labels is None:
+            block.count[0] = count
+            block.mean[0] = values.mean(dtype=np.float64)
+            block.m2[0] = np.square(values - block.mean[0], dtype=np.float64).sum()
+            block.n_likely[0] = np.count_nonzero(values > self.threshold)
+            block.hist[0] = np.bincount(bins.ravel(), minlength=self.hist_bins)
+        else:
+            labels = labels.ravel()
+            values = values.ravel()
+
+            block.count = np.bincount(labels, minlength=self.n_labels)
+            sums = np.bincount(labels, weights=values, minlength=self.n_labels)
+            block.mean = sums / np.maximum(block.count, 1)
+            block.m2 = np.bincount(labels,
+                                   weights=np.square(values - block.mean[labels]),
+                                   minlength=self.n_labels)
+            block.n_likely = np.bincount(labels[values > self.threshold],
+                                         minlength=self.n_labels)
+            block.hist = np.bincount(labels * self.hist_bins + bins.ravel(),
+                                     minlength=self.n_labels * self.hist_bins)
+            block.hist = block.hist.reshape(self.n_labels, self.hist_bins)
+
+        return self.merge(block)
+
+    def merge(self, other):
+        count = self.count + other.count
+        has_data = count > 0
+
+        delta = other.mean - self.mean
+        weight = np.where(has_data, other.count / np.maximum(count, 1), 0)
+
+        self.mean = self.mean + delta * weight
+        self.m2 = self.m2 + other.m2 + delta ** 2 * self.count * weight
+        self.n_likely = self.n_likely + other.n_likely
+        self.hist = self.hist + other.hist
+        self.count = count
+
+        return self
+
+    def summaries(self):
+        """ Returns arrays of (mean, std, pct_likely) for every label;
+            labels without any values are NaN.
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            count = np.where(self.count > 0, self.count, np.nan)
+
+            return (np.where(self.count > 0, self.mean, np.nan),
+                    np.sqrt(self.m2 / count),
+                    self.n_likely / count)
+
+    def summary(self, label=0):
+        """ Returns (mean, std, pct_likely) like `summary_stats`.
+        """
+        return tuple(stat[label] for stat in self.summaries())
+
+
+class IndexEvaluator(object):
+    """ Compiles a set of (name, expression) spectral indices into one
+        vectorized program.
+
+        Identical subexpressions (e.g. `nir + re`, also as `re + nir`)
+        are only computed once per call, constants are folded, and the
+        intermediate results share the planes of a single float32
+        scratch buffer with `n_slots` planes.
+    """
+
+    _binary_ops = {ast.Add: np.add,
+                   ast.Sub: np.subtract,
+                   ast.Mult: np.multiply,
+                   ast.Div: np.true_divide}
+
+    def __init__(self, expressions):
+        self.names = [name for name, _ in expressions]
+
+        # nodes are ('band', name), ('const', value) or ('op', ufunc, args)
+        # in topological order; equal nodes are only added once
+        self._nodes = []
+        self._node_ids = dict()
+
+        self.outputs = [self._compile(ast.parse(expression.strip(), mode='eval').body)
+                        for _, expression in expressions]
+
+        self.bands = sorted(set(node[1] for node in self._nodes if node[0] == 'band'))
+
+        self._allocate_slots()
+
+    def _add(self, node):
+        if node not in self._node_ids:
+            self._node_ids[node] = len(self._nodes)
+            self._nodes.append(node)
+
+        return self._node_ids[node]
+
+    def _compile(self, node):
+        if isinstance(node, ast.Name):
+            return self._add(('band', node.id))
+
+        if isinstance(node, ast.Num):
+            return self._add(('const', float(node.n)))
+
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.UAdd, ast.USub)):
+            operand = self._compile(node.operand)
+
+            if isinstance(node.op, ast.UAdd):
+                return operand
+
+            return self._op(np.negative, (operand, ))
+
+        if isinstance(node, ast.BinOp) and type(node.op) in self._binary_ops:
+            ufunc = self._binary_ops[type(node.op)]
+            args = (self._compile(node.left), self._compile(node.right))
+
+            if ufunc in (np.add, np.multiply):
+                args = tuple(sorted(args))
+
+            return self._op(ufunc, args)
+
+        raise ValueError("Unsupported syntax in spectral index: {}".format(ast.dump(node)))
+
+    def _op(self, ufunc, args):
+        if all(self._nodes[a][0] == 'const' for a in args):
+            return self._add(('const', float(ufunc(*[self._nodes[a][1] for a in args]))))
+
+        return self._add(('op', ufunc, args))
+
+    def _allocate_slots(self):
+        """ Assigns every op a scratch plane that is reused as soon as
+            the last op reading it has run. Outputs are kept to the end.
+        """
+        last_use = dict()
+        for i, node in enumerate(self._nodes):
+            if node[0] == 'op':
+                for a in node[2]:
+                    last_use[a] = i
+
+        for out in self.outputs:
+            last_use[out] = len(self._nodes)
+
+        self._slots = dict()
+        free = []
+        self.n_slots = 0
+
+        for i, node in enumerate(self._nodes):
+            if node[0] != 'op':
+                continue
+
+            for a in set(node[2]):
+                if a in self._slots and last_use[a] == i:
+                    free.append(self._slots[a])
+
+            if free:
+                self._slots[i] = free.pop()
+            else:
+                self._slots[i] = self.n_slots
+                self.n_slots += 1
+
+    def evaluate(self, bands, scratch=None):
+        """ Evaluates every index over `bands`, a dict of equally shaped
+            arrays keyed by band name. Returns one float32 array per
+            index; they are views into `scratch` (shape
+            (n_slots, ...bands shape)), so they are only valid until the
+            next call with the same buffer.
+        """
+        shape = bands[self.bands[0]].shape if self.bands else ()
+
+        if scratch is None:
+            scratch = np.empty((self.n_slots, ) + shape, dtype=np.float32)
+
+        values = []
+        for i, node in enumerate(self._nodes):
+            if node[0] == 'band':
+                values.append(bands[node[1]])
+            elif node[0] == 'const':
+                values.append(node[1])
+            else:
+                _, ufunc, args = node
+
+                # compute in float32 so unsigned raw bands can't wrap around
+                values.append(ufunc(*[values[a] for a in args],
+                                    out=scratch[self._slots[i]],
+                                    dtype=np.float32))
+
+        return [np.broadcast_to(np.asarray(values[out], dtype=np.float32), shape)
+                for out in self.outputs]
+
+
+def register_index(name, expression, hist_range=HIST_RANGE):
+    """ Adds a spectral index to INDEX_REGISTRY. `expression` uses the
+        band names in BANDS, numbers, +, -, * and /, e.g.
+        '(nir - r) / (nir + r)'. `hist_range` is the range of its
+        histogram sketch; it should cover the values the index takes.
+
+        Register indices at import time (like the ones below) so they
+        also exist in the worker processes.
+    """
+    IndexEvaluator([(name, expression)])  # fail early on bad expressions
+    INDEX_REGISTRY[name] = expression
+    INDEX_HIST_RANGES[name] = tuple(hist_range)
+
+
+register_index('re_ndvi', '(nir - re) / (nir + re)')
+register_index('npcri', '(r - b) / (r + b)')
+register_index('re_ndwi', '(g - re) / (g + re)')
+register_index('ndvi', '(nir - r) / (nir + r)')
+register_index('gndvi', '(nir - g) / (nir + g)')
+
+# EVI and SAVI coefficients assume TOA reflectance (--reflectance)
+# and are not limited to -1..1 like the normalized differences; their
+# sketches span the gain of each index times -1..1
+register_index('evi', '2.5 * (nir - r) / (nir + 6 * r - 7.5 * b + 1)', hist_range=(-2.5, 2.5))
+register_index('savi', '1.5 * (nir - r) / (nir + r + 0.5)', hist_range=(-1.5, 1.5))
+
+
+def compile_indices(names=INDEX_NAMES):
+    """ Returns an `IndexEvaluator` for the registered indices `names`.
+    """
+    unknown = [n for n in names if n not in INDEX_REGISTRY]
+    if unknown:
+        raise ValueError("Unknown spectral indices {}. Registered: {}".format(unknown,
+                                                                            list(INDEX_REGISTRY)))
+
+    return IndexEvaluator([(n, INDEX_REGISTRY[n]) for n in names])
+
+
+def sketch_quantile(hist, q, value_range=HIST_RANGE):
+    """ Estimates the `q` quantile from histogram counts (the last axis
+        of `hist`), interpolating linearly within bins.
+    """
+    hist = np.asarray(hist, dtype=np.float64)
+    edges = np.linspace(value_range[0], value_range[1], hist.shape[-1] + 1)
+
+    def _quantile(counts):
+        cdf = np.concatenate([[0], np.cumsum(counts)])
+
+        if cdf[-1] == 0:
+            return np.nan
+
+        return np.interp(q * cdf[-1], cdf, edges)
+
+    return np.apply_along_axis(_quantile, -1, hist)
+
+
+def sketch_fraction_above(hist, threshold, value_range=HIST_RANGE):
+    """ Estimates the fraction of values above `threshold` from histogram
+        counts (the last axis of `hist`), interpolating linearly within
+        bins.
+    """
+    hist = np.asarray(hist, dtype=np.float64)
+    edges = np.linspace(value_range[0], value_range[1], hist.shape[-1] + 1)
+
+    def _fraction_above(counts):
+        cdf = np.concatenate([[0], np.cumsum(counts)])
+
+        if cdf[-1] == 0:
+            return np.nan
+
+        return 1 - np.interp(threshold, edges, cdf) / cdf[-1]
+
+    return np.apply_along_axis(_fraction_above, -1, hist)
+
+
+def index_stats(bands, evaluator, accumulators=None, chunk_pixels=CHUNK_PIXELS, labels=None):
+    """ Accumulates the stats of every index in `evaluator` over
+        `bands` (a dict of 2D arrays keyed by band name) into one
+        `RunningStats` per index.
+
+        All of the indices are computed together in one pass over row
+        strips of the bands; the only intermediate is a float32 scratch
+        buffer of about `chunk_pixels` pixels per evaluator slot that is
+        reused for every strip. `labels` optionally assigns every pixel
+        to a zone of the accumulators.
+    """
+    if accumulators is None:
+        accumulators = [RunningStats(hist_range=index_hist_range(n)) for n in evaluator.names]
+
+    height, width = bands[evaluator.bands[0]].shape
+    chunk_rows = max(1, min(height, chunk_pixels // width))
+
+    scratch = np.empty((evaluator.n_slots, chunk_rows, width), dtype=np.float32)
+
+    for start in range(0, height, chunk_rows):
+        stop = min(start + chunk_rows, height)
+
+        strip = {name: bands[name][start:stop] for name in evaluator.bands}
+        strip_labels = None if labels is None else labels[start:stop]
+
+        for acc, values in zip(accumulators, evaluator.evaluate(strip, scratch[:, :stop - start])):
+            acc.update(values, strip_labels)
+
+    return accumulators
+
+
+def fused_index_stats(a_b_tuples, accumulators=None, chunk_pixels=CHUNK_PIXELS, labels=None):
+    """ For each tuple (a, b) in a_b_tuples, accumulates the stats of
+        (a - b) / (a + b) into a `RunningStats`, with `index_stats`.
+    """
+    bands = dict()
+    expressions = []
+    for i, (a, b) in enumerate(a_b_tuples):
+        bands['a{}'.format(i)] = a
+        bands['b{}'.format(i)] = b
+        expressions.append((str(i), '(a{0} - b{0}) / (a{0} + b{0})'.format(i)))
+
+    return index_stats(bands,
+                       IndexEvaluator(expressions),
+                       accumulators=accumulators,
+                       chunk_pixels=chunk_pixels,
+                       labels=labels)
+
+
+def stats_to_series(ward, accumulators, names):
+    series = dict()
+    for n, acc in zip(names, accumulators):
+        for label, val in zip(STATS_LABELS, acc.summary()):
+            series["{}_{}".format(n, label)] = val
+
+    return pd.Series(series, name=ward)
+
+
+def hists_to_frame(ward_hists, names=INDEX_NAMES):
+    """ Takes (ward, {index name: histogram counts}) pairs and returns
+        one row per ward and index with a column per histogram bin
+        (labelled with the bin's lower edge). The columns span the
+        sketch ranges of all of the indices; bins outside of the range
+        of an index are 0 in its rows.
+    """
+    ranges = [index_hist_range(n) for n in names]
+    edges = hist_edges((min(r[0] for r in ranges), max(r[1] for r in ranges)))
+
+    offsets = dict()
+    for n, value_range in zip(names, ranges):
+        offsets[n] = int(round((value_range[0] - edges[0]) / HIST_BIN_WIDTH))
+
+    index = []
+    rows = []
+    for ward, hists in ward_hists:
+        for n in names:
+            row = np.zeros(len(edges) - 1, dtype=np.int64)
+            row[offsets[n]:offsets[n] + len(hists[n])] = hists[n]
+
+            index.append((ward, n))
+            rows.append(row)
+
+    return pd.DataFrame(rows,
+                        index=pd.MultiIndex.from_tuples(index, names=['ward', 'index']),
+                        columns=['{:.2f}'.format(e) for e in edges[:-1]])
+
+
 def summary_stats_series(ward, a_b_tuples, names):
     """ For each tuple (a, b) in a_b_tuples:
         calculates (a - b) / (a + b) and associated
         stats.
     """
+    with warnings.catch_warnings():
+        # ignore warnings from dividing by zero in nodata pixels
+        warnings.filterwarnings('ignore')
+
+        return stats_to_series(ward, fused_index_stats(a_b_tuples), names)
+
+
+def budget_chunk_pixels(memory_budget, n_slots, labelled=False):
+    """ Returns how many pixels the raster windows of one process can
+        have to stay within `memory_budget` (MB, or None for the default
+        CHUNK_PIXELS), on top of what the process is using now.
+    """
+    if memory_budget is None:
+        return CHUNK_PIXELS
+
+    # the bands as read plus the evaluator scratch and the temporaries
+    # in RunningStats.update; labels add the label raster and its copies
+    bytes_per_pixel = 8 * len(BANDS) + 4 * n_slots + ACCUMULATOR_BYTES_PER_PIXEL
+    if labelled:
+        bytes_per_pixel += 2 * ACCUMULATOR_BYTES_PER_PIXEL
+
+    return max(1, int(available_memory(memory_budget) // bytes_per_pixel))
+
+
+def stream_windows(src, chunk_pixels=CHUNK_PIXELS):
+    """ Yields full width windows over `src` made of whole rows of its
+        internal blocks, with about `chunk_pixels` pixels each (but at
+        least one row of blocks).
+    """
+    block_height = src.block_shapes[0][0]
+    rows = max(1, chunk_pixels // (src.width * block_height)) * block_height
+
+    for row_off in range(0, src.height, rows):
+        yield Window(0, row_off, src.width, min(rows, src.height - row_off))
+
+
+def summary_stats_streaming(ward, analytic_file, names=INDEX_NAMES, memory_budget=None):
+    """ Calculates the same stats as `summary_stats_series`, but walks
+        the internal blocks of `analytic_file` and only keeps running
+        accumulators in memory, so peak memory is bounded by one block
+        regardless of the size of the ward.
+    """
+    return stats_to_series(ward,
+                           streaming_index_stats(analytic_file, names, memory_budget),
+                           names)
+
+
+def streaming_index_stats(analytic_file, names=INDEX_NAMES, memory_budget=None):
+    """ Returns a `RunningStats` for each of the indices `names`,
+        accumulated over the blocks of `analytic_file` in windows sized
+        to stay within `memory_budget` (MB).
+    """
+    evaluator = compile_indices(names)
+    accumulators = [RunningStats(hist_range=index_hist_range(n)) for n in names]
+
+    chunk_pixels = budget_chunk_pixels(memory_budget, evaluator.n_slots)
+
+    with warnings.catch_warnings():
+        # ignore warnings from dividing by zero in nodata pixels
+        warnings.filterwarnings('ignore')
+
+        with rio.open(analytic_file) as data:
+            for window in stream_windows(data, chunk_pixels):
+                bands = dict(zip(BANDS, data.read(window=window)))
+
+                index_stats(bands, evaluator, accumulators, chunk_pixels=chunk_pixels)
+
+    return accumulators
+
+
+def ward_cache_key(analytic_file, names=INDEX_NAMES):
+    """ Everything the stats for a ward depend on; a cached result is
+        only reused if its key matches exactly.
+    """
+    stat = os.stat(analytic_file)
+
+    return {'path': os.path.abspath(analytic_file),
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'indices': [[n, INDEX_REGISTRY[n]] for n in names],
+            'likely_threshold': LIKELY_THRESHOLD,
+            'hist_ranges': [list(index_hist_range(n)) for n in names],
+            'hist_bin_width': HIST_BIN_WIDTH}
+
+
+def read_cached_ward(cache_dir, ward, key):
+    """ Returns the cached (stats, histograms) for `ward` or None if
+        there are none for this `key`.
+    """
     try:
-        measure_arr = np.zeros_like(a_b_tuples[0][0])
+        with open(os.path.join(cache_dir, ward + '.json'), 'r') as cache_file:
+            cached = json.load(cache_file)
+    except (IOError, ValueError):
+        return None
 
-        with warnings.catch_warnings():
-            # ignore warnings that some arrays are all NaNs
-            warnings.filterwarnings('ignore')
+    if cached.get('key') != key:
+        return None
 
-            stats_labels = ['mean', 'std', 'pct_likely']
+    return pd.Series(cached['stats'], name=ward), cached['hists']
 
-            series = dict()
-            for n, a_b in zip(names, a_b_tuples):
-                a, b = a_b
-                np.true_divide((a - b), (a + b), measure_arr)
 
-                for label, val in zip(stats_labels, summary_stats(measure_arr)):
-                    series["{}_{}".format(n, label)] = val
+def write_cached_ward(cache_dir, ward, key, ward_data, ward_hists):
+    """ Writes the stats and histograms for `ward` to a temp file and renames it into
+        place, so an interrupted run never leaves a partial cache entry.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
 
-            return pd.Series(series, name=ward)
+    cache_path = os.path.join(cache_dir, ward + '.json')
+    tmp_path = '{}.{}.tmp'.format(cache_path, os.getpid())
 
-    except MemoryError:
-        return pd.Series([], name=ward)
+    with open(tmp_path, 'w') as cache_file:
+        json.dump({'key': key, 'stats': ward_data.to_dict(), 'hists': ward_hists}, cache_file)
 
+    os.replace(tmp_path, cache_path)
 
-def process_wards_normalized_indices(root_folder, plot=False):
 
-    all_ward_data = []
+def ward_analytic_file(ward_folder):
+    """ Returns the ward name and the path of its analytic image.
+    """
+    ward = ward_folder.split(str(os.path.sep))[-1].split("_")[0]
+    return ward, os.path.join(ward_folder, "{}_fall_analytic.tif".format(ward))
 
-    i = 0
 
-    for f in tqdm(glob(os.path.join(root_folder, '*_fall'))):
-        ward = f.split(str(os.path.sep))[-1].split("_")[0]
+def ward_normalized_indices(ward_folder, streaming=True, cache_dir=None, names=INDEX_NAMES,
+                            memory_budget=None):
+    """ Calculates the normalized index stats and histograms for the
+        ward stored in `ward_folder`. Returns None if the ward has no
+        analytic image. See `ward_stats` for `memory_budget`.
 
-        # i += 1
-        # if i > 130:
-        #     break
+        If `cache_dir` is set, results are written there as soon as they
+        are calculated and reused while the analytic image and the index
+        definitions are unchanged.
+    """
+    ward, analytic_file = ward_analytic_file(ward_folder)
+
+    if not os.path.exists(analytic_file):
+        print("DOES NOT EXIST: ", analytic_file)
+        return None
+
+    if cache_dir is None:
+        return ward_stats(ward, analytic_file, streaming, names, memory_budget)
+
+    key = ward_cache_key(analytic_file, names)
+
+    cached = read_cached_ward(cache_dir, ward, key)
+
+    if cached is not None:
+        return cached
+
+    ward_data, ward_hists = ward_stats(ward, analytic_file, streaming, names, memory_budget)
+    write_cached_ward(cache_dir, ward, key, ward_data, ward_hists)
+
+    return ward_data, ward_hists
+
+
+def ward_stats(ward, analytic_file, streaming=True, names=INDEX_NAMES, memory_budget=None):
+    """ Returns the stats Series for the ward and a dict with the
+        histogram counts of each index.
+
+        Wards are streamed in windows that fit in `memory_budget` (MB);
+        without `streaming`, wards are only read whole if they fit.
+    """
+    if not streaming and memory_budget is not None:
+        with rio.open(analytic_file) as data:
+            n_pixels = data.width * data.height
+
+        if n_pixels > budget_chunk_pixels(memory_budget, compile_indices(names).n_slots):
+            print("{} does not fit in the memory budget; streaming it instead.".format(ward))
+            streaming = True
+
+    if streaming:
+        accumulators = streaming_index_stats(analytic_file, names, memory_budget)
+    else:
+        accumulators = in_memory_index_stats(analytic_file, names)
 
-        if ward != 'failed':
-            analytic_file = os.path.join(f, "{}_fall_analytic.tif".format(ward))
+    ward_hists = {n: acc.hist[0].tolist() for n, acc in zip(names, accumulators)}
 
-            try:
-                if os.path.exists(analytic_file):
-                    data = rio.open(analytic_file)
+    return stats_to_series(ward, accumulators, names), ward_hists
 
-                    b, g, r, re, nir = data.read()
 
-                    ward_data = summary_stats_series(ward,
-                                                     [(nir, re), (r, b), (g, re)],
-                                                     ['re_ndvi', 'npcri', 're_ndwi'])
+def ward_normalized_indices_task(*args, **kwargs):
+    """ Runs `ward_normalized_indices` in a worker and also returns the
+        peak RSS of the worker process.
+    """
+    return ward_normalized_indices(*args, **kwargs), peak_rss()
+
+
+def in_memory_index_stats(analytic_file, names=INDEX_NAMES):
+    with warnings.catch_warnings():
+        # ignore warnings from dividing by zero in nodata pixels
+        warnings.filterwarnings('ignore')
+
+        with rio.open(analytic_file) as data:
+            b, g, r, re, nir = data.read()
 
-                    # Default GC is not aggressive enough.
-                    # We force GC here and trade computational performance
-                    # for getting our memory back.
-                    del(r)
-                    del(g)
-                    del(b)
-                    del(nir)
-                    del(re)
-                    gc.collect()
+        accumulators = index_stats(dict(zip(BANDS, [b, g, r, re, nir])),
+                                   compile_indices(names))
 
-                    all_ward_data.append(ward_data)
+        # Default GC is not aggressive enough.
+        # We force GC here and trade computational performance
+        # for getting our memory back.
+        del(r)
+        del(g)
+        del(b)
+        del(nir)
+        del(re)
+        gc.collect()
 
-                    # if plot:
-                    #     plot_normalized_indices(ward,
-                    #                             [re_ndvi, npcri, re_ndwi],
-                    #                             ['Vegetation', 'Chlorophyll', 'Water'],
-                    #                             [plt.cm.PRGn, plt.cm.PiYG, plt.cm.BrBG],
-                    #                             output_folder=os.path.join(root_folder, 'ward_visualization'),
-                    #                             base_size=2.5)
+    return accumulators
 
-                else:
-                    pass
-                    print("DOES NOT EXIST: ", analytic_file)
 
-            except MemoryError:
-                all_ward_data.append(pd.Series([], name=ward))
+def process_wards_normalized_indices(root_folder, plot=False, streaming=True, n_jobs=1,
+                                     use_cache=True, names=INDEX_NAMES, memory_budget=None):
+    """ Writes the normalized index stats for every ward folder in
+        `root_folder` to all_ward_data.csv and their histograms to
+        all_ward_histograms.csv. Wards are processed by
+        `n_jobs` worker processes and the results are merged in sorted
+        ward order, so the output does not depend on `n_jobs`.
+
+        With `use_cache`, per ward results are kept in
+        `root_folder`/ward_stats_cache, so reruns only recompute wards
+        whose inputs changed and an interrupted run resumes where it
+        stopped.
+
+        With `plot`, maps of the indices are also rendered to
+        `root_folder`/ward_visualization with `render_wards`.
+
+        `memory_budget` (MB) is split evenly between the workers, which
+        size their read windows to stay within their share.
+    """
+    cache_dir = os.path.join(root_folder, CACHE_DIRNAME) if use_cache else None
 
-    ward_df = pd.DataFrame(all_ward_data)
+    ward_folders = [f for f in glob(os.path.join(root_folder, '*_fall'))
+                    if os.path.basename(f).split("_")[0] != 'failed']
+
+    ward_folders = sorted(ward_folders, key=lambda f: os.path.basename(f).split("_")[0])
+
+    worker_budget = None
+    if memory_budget is not None:
+        worker_budget = memory_budget / effective_n_jobs(n_jobs)
+
+    with Parallel(n_jobs=n_jobs) as parallel:
+        results = parallel(delayed(ward_normalized_indices_task)(f,
+                                                                 streaming=streaming,
+                                                                 cache_dir=cache_dir,
+                                                                 names=names,
+                                                                 memory_budget=worker_budget)
+                           for f in tqdm(ward_folders))
+
+    report_peak_rss('normalized indices (per worker)',
+                    worker_budget,
+                    rss=max([rss for _, rss in results] + [peak_rss()]))
+
+    all_ward_data = [ward_data for ward_data, _ in results if ward_data is not None]
+
+    ward_df = pd.DataFrame([ward_data for ward_data, _ in all_ward_data])
     ward_df.to_csv(os.path.join(root_folder, 'all_ward_data.csv'))
 
+    hist_df = hists_to_frame([(ward_data.name, ward_hists)
+                              for ward_data, ward_hists in all_ward_data
+                              if ward_hists],
+                             names)
+    hist_df.to_csv(os.path.join(root_folder, 'all_ward_histograms.csv'))
+
+    if plot:
+        render_wards(ward_folders,
+                     os.path.join(root_folder, 'ward_visualization'),
+                     names=names,
+                     n_jobs=n_jobs)
+
+
+def read_overview(analytic_file, max_size=RENDER_MAX_SIZE):
+    """ Reads the bands of `analytic_file` decimated so that the longest
+        side is at most `max_size` pixels. GDAL uses the internal
+        overviews for this if the image has them.
+    """
+    with rio.open(analytic_file) as data:
+        scale = max(1.0, max(data.height, data.width) / float(max_size))
+        out_shape = (data.count,
+                     max(1, int(round(data.height / scale))),
+                     max(1, int(round(data.width / scale))))
+
+        return dict(zip(BANDS, data.read(out_shape=out_shape)))
+
+
+class IndexRenderer(object):
+    """ Draws the same maps as `plot_normalized_indices`, but builds the
+        figure once and only swaps the image data for every ward, which
+        is much cheaper than a new figure per ward.
+    """
+
+    def __init__(self, names=INDEX_NAMES, base_size=2.5):
+        self.fig, axes = plt.subplots(1,
+                                      len(names),
+                                      facecolor='black',
+                                      figsize=(base_size * len(names), base_size),
+                                      squeeze=False)
+
+        self.title = self.fig.suptitle('', color='white')
+
+        self.images = []
+        for ax, name in zip(axes[0], names):
+            im = ax.imshow(np.zeros((1, 1)),
+                           cmap=INDEX_COLORMAPS.get(name, 'RdYlGn'),
+                           alpha=0.9,
+                           vmin=-1,
+                           vmax=1)
+            self.fig.colorbar(im, ax=ax, orientation='horizontal', ticks=[])
+
+            ax.set_title(INDEX_TITLES.get(name, name), color='white')
+            ax.axis('off')
+
+            self.images.append(im)
+
+    def render(self, title, values, output_path):
+        self.title.set_text(title)
+
+        for im, val in zip(self.images, values):
+            height, width = val.shape
+            im.set_data(val)
+            im.set_extent((-0.5, width - 0.5, height - 0.5, -0.5))
+
+        self.fig.savefig(output_path, facecolor=self.fig.get_facecolor())
+
+    def close(self):
+        plt.close(self.fig)
+
+
+def render_ward_batch(ward_folders, output_folder, names=INDEX_NAMES, max_size=RENDER_MAX_SIZE):
+    """ Renders the index maps of `ward_folders` to `output_folder`
+        with a single `IndexRenderer`.
+    """
+    evaluator = compile_indices(names)
+    renderer = IndexRenderer(names)
+
+    try:
+        for ward_folder in ward_folders:
+            ward, analytic_file = ward_analytic_file(ward_folder)
+
+            if not os.path.exists(analytic_file):
+                continue
+
+            with np.errstate(divide='ignore', invalid='ignore'):
+                values = evaluator.evaluate(read_overview(analytic_file, max_size))
+
+            renderer.render(ward, values, os.path.join(output_folder, ward + '.png'))
+    finally:
+        renderer.close()
+
+
+def render_wards(ward_folders, output_folder, names=INDEX_NAMES, n_jobs=1,
+                 max_size=RENDER_MAX_SIZE):
+    """ Renders index maps for every ward from downsampled reads of the
+        analytic images. The wards are split into one batch per worker
+        so that every worker reuses a single figure.
+    """
+    os.makedirs(output_folder, exist_ok=True)
+
+    n_workers = min(effective_n_jobs(n_jobs), max(1, len(ward_folders)))
+    batches = [ward_folders[i::n_workers] for i in range(n_workers)]
+
+    with Parallel(n_jobs=n_workers) as parallel:
+        parallel(delayed(render_ward_batch)(batch, output_folder, names, max_size)
+                 for batch in batches)
+
+
+def ward_aois(wards_path=WARDS_PATH):
+    """ Loads the ward polygons with the same ids that
+        `get_ward_aois` in src/data/download_planet.py gives them.
+    """
+    with open(wards_path, 'r') as wards_file:
+        aois = json.load(wards_file)['features']
+
+    for aoi in aois:
+        aoi_name = aoi['properties']["NAME"]
+
+        for old, new in [('/', '-'), ("\\", "-"), ("'", ''), (" ", "-")]:
+            aoi_name = aoi_name.replace(old, new)
+
+        aoi['id'] = aoi_name
+
+    return aois
+
+
+def zonal_stats(mosaic_path, aois, names=INDEX_NAMES, aois_crs='EPSG:4326', memory_budget=None):
+    """ Calculates the normalized index stats for every ward in `aois`
+        in a single pass over one mosaic, instead of clipping and then
+        reading a separate image per ward.
+
+        Each window of the mosaic is labelled by rasterizing the ward
+        polygons that overlap it (1 + the ward's index; 0 is outside of
+        every ward) and the stats of all wards are accumulated together
+        with `bincount`. Wards that have no valid pixels are left out.
+
+        Returns the stats and the histograms of every ward, like
+        all_ward_data.csv and all_ward_histograms.csv. Windows are sized
+        to stay within `memory_budget` (MB).
+    """
+    evaluator = compile_indices(names)
+    chunk_pixels = budget_chunk_pixels(memory_budget, evaluator.n_slots, labelled=True)
+
+    n_labels = len(aois) + 1
+    accumulators = [RunningStats(n_labels=n_labels, hist_range=index_hist_range(n)) for n in names]
+
+    with warnings.catch_warnings():
+        # ignore warnings from dividing by zero in nodata pixels
+        warnings.filterwarnings('ignore')
+
+        with rio.open(mosaic_path) as data:
+            geoms = [transform_geom(aois_crs, data.crs, aoi['geometry']) for aoi in aois]
+            geom_bounds = np.array([features.bounds(g) for g in geoms]).reshape(-1, 4)
+
+            for window in tqdm(list(stream_windows(data, chunk_pixels))):
+                left, bottom, right, top = windows.bounds(window, data.transform)
+
+                overlapping = np.flatnonzero((geom_bounds[:, 0] < right) &
+                                             (geom_bounds[:, 2] > left) &
+                                             (geom_bounds[:, 1] < top) &
+                                             (geom_bounds[:, 3] > bottom))
+
+                if overlapping.size == 0:
+                    continue
+
+                labels = features.rasterize([(geoms[i], i + 1) for i in overlapping],
+                                            out_shape=(int(window.height), int(window.width)),
+                                            transform=data.window_transform(window),
+                                            fill=0,
+                                            dtype='uint32')
+
+                if not labels.any():
+                    continue
+
+                bands = dict(zip(BANDS, data.read(window=window)))
+
+                index_stats(bands,
+                            evaluator,
+                            accumulators,
+                            chunk_pixels=chunk_pixels,
+                            labels=labels.astype(np.intp))
+
+    report_peak_rss('zonal stats', memory_budget)
+
+    wards = [aoi['id'].split("_")[0] for aoi in aois]
+
+    # (ward, label) of the wards that have data, in ward order
+    ward_labels = sorted((ward, i + 1) for i, ward in enumerate(wards)
+                         if accumulators[0].count[i + 1] > 0)
+    labels = [label for _, label in ward_labels]
+
+    columns = dict()
+    for n, acc in zip(names, accumulators):
+        for stat, vals in zip(STATS_LABELS, acc.summaries()):
+            columns["{}_{}".format(n, stat)] = vals[labels]
+
+    ward_df = pd.DataFrame(columns, index=[ward for ward, _ in ward_labels])
+
+    hist_df = hists_to_frame([(ward, {n: acc.hist[label].tolist()
+                                      for n, acc in zip(names, accumulators)})
+                              for ward, label in ward_labels],
+                             names)
+
+    return ward_df, hist_df
+
 
 @click.command()
-def process_wards():
-    process_wards_normalized_indices(os.path.join(PLANET_DATA_ROOT, 'wards'))
+@click.option('--streaming/--in-memory', default=True, help="Walk the raster blocks of each ward instead of reading whole images.")
+@click.option('--n_jobs', default=1, type=int, help="Number of jobs. default=1, use -1 for all cores.")
+@click.option('--cache/--no-cache', default=True, help="Reuse per ward results from previous runs when the inputs are unchanged.")
+@click.option('--mosaic', default=None, type=click.Path(exists=True), help="Compute zonal stats for every ward over this single mosaic (e.g. a gdalbuildvrt of all scenes) instead of the per ward tifs.")
+@click.option('--wards_path', default=WARDS_PATH, type=click.Path(exists=True), help="GeoJSON with the ward polygons for --mosaic.")
+@click.option('--plot', is_flag=True, help="Also render maps of the indices for every ward to ward_visualization.")
+@click.option('--memory_budget', default=None, type=float, help="Memory budget in MB shared by all of the workers; read windows are sized to fit.")
+@click.option('--index', 'indices', multiple=True, default=INDEX_NAMES, type=click.Choice(list(INDEX_REGISTRY)), help="Spectral index to calculate; can be repeated.")
+def process_wards(streaming, n_jobs, cache, mosaic, wards_path, plot, memory_budget, indices):
+    root_folder = os.path.join(PLANET_DATA_ROOT, 'wards')
+    indices = list(indices)
+
+    if mosaic is not None:
+        ward_df, hist_df = zonal_stats(mosaic,
+                                       ward_aois(wards_path),
+                                       names=indices,
+                                       memory_budget=memory_budget)
+        ward_df.to_csv(os.path.join(root_folder, 'all_ward_data.csv'))
+        hist_df.to_csv(os.path.join(root_folder, 'all_ward_histograms.csv'))
+        return
+
+    process_wards_normalized_indices(root_folder,
+                                     streaming=streaming,
+                                     n_jobs=n_jobs,
+                                     use_cache=cache,
+                                     names=indices,
+                                     plot=plot,
+                                     memory_budget=memory_budget)
 
 
 if __name__ == '__main__':
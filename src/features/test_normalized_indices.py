@@ -0,0 +1,261 @@
+import os
+
+import numpy as np
+import pytest
+import rasterio as rio
+from affine import Affine
+
+import normalized_indices as ni
+from memory_budget import MemoryBudgetWarning, resident_memory
+
+
+def write_analytic_tif(path, bands, blocksize=16):
+    profile = dict(driver='GTiff',
+                   width=bands.shape[2],
+                   height=bands.shape[1],
+                   count=bands.shape[0],
+                   dtype='float32',
+                   crs='EPSG:32637',
+                   transform=Affine(5, 0, 0, 0, -5, 0),
+                   tiled=True,
+                   blockxsize=blocksize,
+                   blockysize=blocksize)
+
+    with rio.open(path, 'w', **profile) as dst:
+        dst.write(bands)
+
+
+@pytest.fixture
+def analytic_bands():
+    rng = np.random.RandomState(0)
+    bands = rng.uniform(0, 1, size=(5, 70, 45)).astype(np.float32)
+
+    # nodata outside of the cutline
+    bands[:, :10, :] = 0
+    return bands
+
+
+def test_streaming_matches_in_memory(tmpdir, analytic_bands):
+    path = str(tmpdir.join('ward_fall_analytic.tif'))
+    write_analytic_tif(path, analytic_bands)
+
+    b, g, r, re, nir = analytic_bands
+    in_memory = ni.summary_stats_series('ward',
+                                        [(nir, re), (r, b), (g, re)],
+                                        ni.INDEX_NAMES)
+    streamed = ni.summary_stats_streaming('ward', path)
+
+    assert list(streamed.index) == list(in_memory.index)
+    np.testing.assert_allclose(streamed.values, in_memory.values, rtol=1e-5)
+
+
+def test_fused_kernel_matches_summary_stats(analytic_bands):
+    b, g, r, re, nir = analytic_bands
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        expected = [ni.summary_stats((x - y) / (x + y))
+                    for x, y in [(nir, re), (r, b), (g, re)]]
+
+        # small chunks so the strips don't line up with the image
+        accumulators = ni.fused_index_stats([(nir, re), (r, b), (g, re)],
+                                            chunk_pixels=45 * 7 + 3)
+
+    np.testing.assert_allclose([acc.summary() for acc in accumulators],
+                               expected,
+                               rtol=1e-5)
+
+
+def test_running_stats_merge_empty():
+    acc = ni.RunningStats()
+    acc.update(np.array([np.nan, np.nan]))
+
+    assert np.isnan(acc.summary()).all()
+
+    acc.merge(ni.RunningStats().update(np.array([0.5, -0.5])))
+    assert acc.summary() == (0.0, 0.5, 0.5)
+
+
+def test_process_wards_output_independent_of_n_jobs(tmpdir, analytic_bands):
+    for i, ward in enumerate(['Kiamokama', 'Bomariba', 'Kabondo-East']):
+        ward_dir = tmpdir.mkdir('{}_fall'.format(ward))
+        write_analytic_tif(str(ward_dir.join('{}_fall_analytic.tif'.format(ward))),
+                           analytic_bands[:, i:, :])
+
+    csv_path = str(tmpdir.join('all_ward_data.csv'))
+
+    ni.process_wards_normalized_indices(str(tmpdir), n_jobs=1, use_cache=False)
+    with open(csv_path, 'rb') as f:
+        serial = f.read()
+
+    ni.process_wards_normalized_indices(str(tmpdir), n_jobs=2, use_cache=False)
+    with open(csv_path, 'rb') as f:
+        parallel = f.read()
+
+    assert serial == parallel
+    assert serial.splitlines()[1].startswith(b'Bomariba,')
+
+
+def test_process_wards_reuses_cached_wards(tmpdir, analytic_bands, monkeypatch):
+    ward_dir = tmpdir.mkdir('Kiamokama_fall')
+    analytic_path = str(ward_dir.join('Kiamokama_fall_analytic.tif'))
+    write_analytic_tif(analytic_path, analytic_bands)
+
+    csv_path = str(tmpdir.join('all_ward_data.csv'))
+
+    ni.process_wards_normalized_indices(str(tmpdir))
+    with open(csv_path, 'rb') as f:
+        first_run = f.read()
+
+    assert tmpdir.join(ni.CACHE_DIRNAME, 'Kiamokama.json').check()
+
+    def fail(*args, **kwargs):
+        raise AssertionError("ward should have been read from the cache")
+
+    monkeypatch.setattr(ni, 'ward_stats', fail)
+    ni.process_wards_normalized_indices(str(tmpdir))
+
+    with open(csv_path, 'rb') as f:
+        assert f.read() == first_run
+
+    # changing the input invalidates the cache
+    write_analytic_tif(analytic_path, analytic_bands[:, 5:, :])
+    with pytest.raises(AssertionError):
+        ni.process_wards_normalized_indices(str(tmpdir))
+
+
+def square(x0, y0, size):
+    return {'type': 'Polygon',
+            'coordinates': [[(x0, y0), (x0 + size, y0), (x0 + size, y0 - size),
+                             (x0, y0 - size), (x0, y0)]]}
+
+
+def test_zonal_stats_matches_per_ward_stats(tmpdir, analytic_bands):
+    path = str(tmpdir.join('mosaic.tif'))
+    write_analytic_tif(path, analytic_bands)
+
+    # pixels are 5 units wide, starting at (0, 0) and going down
+    aois = [{'id': 'Kiamokama_fall', 'geometry': square(0, 0, 100)},
+            {'id': 'Bomariba_fall', 'geometry': square(100, -50, 80)},
+            {'id': 'Nowhere_fall', 'geometry': square(1000, 1000, 10)}]
+
+    zonal, hists = ni.zonal_stats(path, aois, aois_crs='EPSG:32637')
+
+    assert list(zonal.index) == ['Bomariba', 'Kiamokama']
+
+    for ward, (rows, cols) in [('Kiamokama', (slice(0, 20), slice(0, 20))),
+                               ('Bomariba', (slice(10, 26), slice(20, 36)))]:
+        b, g, r, re, nir = analytic_bands[:, rows, cols]
+        expected = ni.summary_stats_series(ward,
+                                           [(nir, re), (r, b), (g, re)],
+                                           ni.INDEX_NAMES)
+
+        assert list(zonal.columns) == list(expected.index)
+        np.testing.assert_allclose(zonal.loc[ward].values, expected.values, rtol=1e-5)
+
+
+def test_histogram_sketches_merge_and_answer_queries():
+    rng = np.random.RandomState(1)
+    values = rng.uniform(-1, 1, size=(2, 20000)).astype(np.float32)
+
+    merged = ni.RunningStats().update(values[0])
+    merged.merge(ni.RunningStats().update(values[1]))
+
+    whole = ni.RunningStats().update(values)
+    np.testing.assert_array_equal(merged.hist, whole.hist)
+
+    for q in [0.1, 0.5, 0.9]:
+        assert abs(ni.sketch_quantile(merged.hist[0], q) - np.quantile(values, q)) < 0.01
+
+    assert abs(ni.sketch_fraction_above(merged.hist[0], ni.LIKELY_THRESHOLD) -
+               merged.summary()[2]) < 1e-3
+
+
+def test_index_evaluator_shares_subexpressions(analytic_bands):
+    bands = dict(zip(ni.BANDS, analytic_bands))
+    b, g, r, re, nir = analytic_bands
+
+    evaluator = ni.compile_indices(['ndvi', 'evi', 'savi'])
+
+    # 16 ops written out, but nir - r is shared by all three and
+    # r + nir by ndvi and savi
+    n_ops = sum(1 for node in evaluator._nodes if node[0] == 'op')
+    assert n_ops == 13
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        expected = [(nir - r) / (nir + r),
+                    2.5 * (nir - r) / (nir + 6 * r - 7.5 * b + 1),
+                    1.5 * (nir - r) / (nir + r + 0.5)]
+
+        for values, exp in zip(evaluator.evaluate(bands), expected):
+            np.testing.assert_allclose(values, exp, rtol=1e-5)
+
+
+def test_indices_beyond_unit_range_get_their_own_sketch():
+    # raw digital numbers, where savi is about 1.5 times ndvi
+    bands = {'b': np.full((4, 4), 100.0), 'g': np.full((4, 4), 100.0),
+             'r': np.full((4, 4), 100.0), 're': np.full((4, 4), 100.0),
+             'nir': np.linspace(1000, 4000, 16).reshape(4, 4)}
+
+    ndvi, savi = ni.index_stats(bands, ni.compile_indices(['ndvi', 'savi']))
+    values = 1.5 * (bands['nir'] - 100) / (bands['nir'] + 100 + 0.5)
+
+    assert savi.hist_range == (-1.5, 1.5)
+    assert abs(ni.sketch_quantile(savi.hist[0], 0.5, savi.hist_range) - np.median(values)) < 0.05
+    assert savi.hist[0, -1] == 0
+
+    frame = ni.hists_to_frame([('ward', {'ndvi': ndvi.hist[0].tolist(),
+                                         'savi': savi.hist[0].tolist()})],
+                              ['ndvi', 'savi'])
+
+    assert frame.columns[0] == '-1.50' and frame.columns[-1] == '1.49'
+    assert frame.loc[('ward', 'ndvi')].sum() == frame.loc[('ward', 'savi')].sum() == 16
+    assert frame.loc[('ward', 'ndvi'), '-1.50':'-1.01'].sum() == 0
+    assert frame.loc[('ward', 'savi'), '1.00':].sum() > 0
+
+
+def test_register_index_rejects_bad_expressions():
+    with pytest.raises(ValueError):
+        ni.register_index('bad', 'nir ** 2')
+
+    assert 'bad' not in ni.INDEX_REGISTRY
+
+
+def test_render_wards_writes_a_png_per_ward(tmpdir, analytic_bands):
+    ward_folders = []
+    for ward in ['Kiamokama', 'Bomariba', 'Kabondo-East']:
+        ward_dir = tmpdir.mkdir('{}_fall'.format(ward))
+        write_analytic_tif(str(ward_dir.join('{}_fall_analytic.tif'.format(ward))),
+                           analytic_bands)
+        ward_folders.append(str(ward_dir))
+
+    output_folder = str(tmpdir.join('ward_visualization'))
+    ni.render_wards(ward_folders, output_folder, n_jobs=2, max_size=32)
+
+    assert sorted(os.listdir(output_folder)) == ['Bomariba.png',
+                                                 'Kabondo-East.png',
+                                                 'Kiamokama.png']
+
+
+def test_memory_budget_only_changes_the_windows(tmpdir, analytic_bands):
+    path = str(tmpdir.join('ward_fall_analytic.tif'))
+    write_analytic_tif(path, analytic_bands)
+
+    default = ni.summary_stats_streaming('ward', path)
+
+    # below what the process already uses, so windows are one block row
+    with pytest.warns(MemoryBudgetWarning):
+        budgeted = ni.summary_stats_streaming('ward', path, memory_budget=1)
+
+    np.testing.assert_allclose(budgeted.values, default.values, rtol=1e-6)
+
+
+def test_memory_budget_is_on_top_of_current_usage(recwarn):
+    # a high-water mark above the budget does not shrink the windows
+    # once the memory has been given back
+    rss = resident_memory()
+    budget = rss / 2 ** 20 + 64
+    peak = np.ones(int(128 * 2 ** 20 / 8))
+    del peak
+
+    assert ni.budget_chunk_pixels(budget, n_slots=2) > 1000
+    assert not recwarn.list